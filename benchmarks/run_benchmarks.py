@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import resource
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Add the core logic path to the system path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+core_path = os.path.join(project_root, 'phyto_discover_core')
+sys.path.insert(0, core_path)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_data import (make_library_spectra, make_query_spectra, write_mgf, write_mzml,
+                            write_spectra_library)
+
+SUITES = ['search', 'ingest', 'scoring', 'api']
+
+# Regressions larger than this fraction are flagged by --compare
+REGRESSION_THRESHOLD = 0.10
+
+# Metrics compared by --compare: throughputs, latencies, durations and memory.
+# Counts such as sparse_pairs_scored describe the workload, not its speed, and are left out.
+COMPARED_SUFFIXES = ('_per_s', '_ms', '_s', '_mb')
+
+def latency_summary(seconds):
+    """Returns the mean and p50/p95/p99 of a list of latencies in milliseconds."""
+    ms = np.asarray(seconds) * 1000
+    return {
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+    }
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is in KB on Linux, bytes on macOS)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def bench_search(params, workdir):
+    """Library load time, per-query latency of search_spectrum and batch throughput of search_spectra."""
+    from core_search import SpectralLibrary, search_spectrum, search_spectra
+
+    library_spectra = make_library_spectra(params['library_size'], params['peaks'], params['seed'])
+    queries = make_query_spectra(library_spectra, params['queries'], seed=params['seed'] + 1)
+    db_path = os.path.join(workdir, 'search_library.db')
+    write_spectra_library(library_spectra, db_path)
+    del library_spectra
+
+    library, load_seconds = timed(SpectralLibrary.from_sqlite, db_path)
+    latencies = [timed(search_spectrum, q, library=library, top_k=10)[1] for q in queries]
+    _, batch_seconds = timed(search_spectra, queries, library=library, top_k=10)
+    _, window_seconds = timed(search_spectra, queries, library=library, top_k=10, precursor_tolerance=10)
+    return {
+        'library_load_s': load_seconds,
+        'single_query': latency_summary(latencies),
+        'single_query_per_s': len(queries) / sum(latencies),
+        'batch_queries_per_s': len(queries) / batch_seconds,
+        'batch_10ppm_window_queries_per_s': len(queries) / window_seconds,
+    }
+
+def bench_ingest(params, workdir):
+    """Throughput of build_food_safety_library on a synthetic MGF file."""
+    try:
+        from food_safety_library_manager import build_food_safety_library
+    except ImportError as e:
+        return {'skipped': f"food safety library builder unavailable: {e}"}
+
+    mgf_path = os.path.join(workdir, 'ingest_library.mgf')
+    db_path = os.path.join(workdir, 'ingest_library.db')
+    write_mgf(make_library_spectra(params['library_size'], params['peaks'], params['seed']), mgf_path)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    _, seconds = timed(build_food_safety_library, mgf_path, db_path)
+    return {
+        'build_s': seconds,
+        'spectra_per_s': params['library_size'] / seconds,
+        'library_mb': os.path.getsize(db_path) / (1024 * 1024),
+    }
+
+def bench_scoring(params, workdir):
+    """Throughput of the run_full_analysis scorers (dense, sparse and two-stage) on a streamed mzML run."""
+    from mzml_stream import iter_query_spectra
+    from sparse_scoring import score_dense, score_sparse
+    from two_stage_search import TwoStageSearch
+
+    references = make_library_spectra(params['scoring_references'], params['peaks'], params['seed'])
+    mzml_path = os.path.join(workdir, 'scoring_queries.mzML')
+    write_mzml(make_query_spectra(references, params['queries'], seed=params['seed'] + 1), mzml_path)
+
+    queries, parse_seconds = timed(lambda: list(iter_query_spectra(mzml_path)))
+    # Warm up the numba-compiled matchms kernels so compilation is not timed
+    score_dense(queries[:1], references[:1])
+    _, dense_seconds = timed(score_dense, queries, references)
+    sparse, sparse_seconds = timed(score_sparse, queries, references, 0.02, 'Da')
+    two_stage, setup_seconds = timed(TwoStageSearch, references, 'modified_cosine')
+    _, two_stage_seconds = timed(two_stage.best_per_query, queries, n_candidates=20)
+    return {
+        'mzml_parse_spectra_per_s': len(queries) / parse_seconds,
+        'dense_queries_per_s': len(queries) / dense_seconds,
+        'dense_pairs_per_s': len(queries) * len(references) / dense_seconds,
+        'sparse_queries_per_s': len(queries) / sparse_seconds,
+        'sparse_pairs_scored': len(sparse),
+        'two_stage_setup_s': setup_seconds,
+        'two_stage_queries_per_s': len(queries) / two_stage_seconds,
+    }
+
+def bench_api(params, workdir):
+    """Latency of POST /api/search through the FastAPI app, with a cold and a warm result cache."""
+    try:
+        # Keep the backend's cache, user libraries and jobs inside the workdir, away from data/ and reports/
+        os.environ['PHYTODISCOVER_CACHE_DIR'] = os.path.join(workdir, 'api_cache')
+        os.environ['PHYTODISCOVER_USER_LIBRARIES'] = os.path.join(workdir, 'api_user_libraries')
+        os.environ['PHYTODISCOVER_JOBS_DB'] = os.path.join(workdir, 'api_jobs.db')
+        os.environ['PHYTODISCOVER_REPORTS_DIR'] = os.path.join(workdir, 'api_reports')
+        sys.path.insert(0, os.path.join(project_root, 'webapp', 'backend'))
+        from fastapi.testclient import TestClient
+        import main
+    except ImportError as e:
+        return {'skipped': f"backend dependencies unavailable: {e}"}
+
+    library_spectra = make_library_spectra(params['library_size'], params['peaks'], params['seed'])
+    db_path = os.path.join(workdir, 'api_library.db')
+    mzml_path = os.path.join(workdir, 'api_queries.mzML')
+    write_spectra_library(library_spectra, db_path)
+    write_mzml(make_query_spectra(library_spectra, params['queries'], seed=params['seed'] + 1), mzml_path)
+    del library_spectra
+
+    # Point every module at the synthetic files instead of data/
+    main.get_db_path = lambda module: db_path
+    main.get_mzml_path = lambda filename: mzml_path
+    request = {'module': 'Clinical Diagnostics', 'compound_name': 'Synthetic', 'mzml_file': 'queries.mzML', 'top_k': 10}
+
+    cold, warm = [], []
+    with TestClient(main.app) as client:
+        for _ in range(params['api_requests']):
+            main.result_cache.clear()
+            response, seconds = timed(client.post, '/api/search', json=request)
+            response.raise_for_status()
+            cold.append(seconds)
+        for _ in range(params['api_requests']):
+            response, seconds = timed(client.post, '/api/search', json=request)
+            response.raise_for_status()
+            warm.append(seconds)
+    return {'uncached': latency_summary(cold), 'cached': latency_summary(warm)}
+
+BENCHMARKS = {
+    'search': bench_search,
+    'ingest': bench_ingest,
+    'scoring': bench_scoring,
+    'api': bench_api,
+}
+
+def run_suite(name, params, workdir):
+    """Runs one suite; executed in a fresh process so its peak RSS is measured on its own."""
+    result, seconds = timed(BENCHMARKS[name], params, workdir)
+    result['wall_s'] = seconds
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def flatten(results, prefix=''):
+    """Flattens nested result dicts into {'suite.metric': value} for numeric values."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare(current, baseline_path):
+    """Prints every metric next to its value in an earlier results file and flags regressions."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\n--- Comparison with {baseline_path} (commit {baseline.get('commit')}) ---")
+    old, new = flatten(baseline['results']), flatten(current['results'])
+    n_regressions = 0
+    for key in sorted(set(old) & set(new)):
+        if old[key] == 0 or not key.endswith(COMPARED_SUFFIXES):
+            continue
+        change = (new[key] - old[key]) / abs(old[key])
+        # Throughputs should go up; latencies, durations and memory should go down
+        higher_is_better = key.endswith('_per_s')
+        regressed = change < -REGRESSION_THRESHOLD if higher_is_better else change > REGRESSION_THRESHOLD
+        n_regressions += regressed
+        print(f"{key:55s} {old[key]:12.4g} -> {new[key]:12.4g} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    print(f"{n_regressions} regressions above {REGRESSION_THRESHOLD:.0%}.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the search, ingest, scoring and webapp paths.')
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=SUITES, help='Benchmarks to run.')
+    parser.add_argument('--library_size', type=int, default=10000, help='Number of synthetic library spectra.')
+    parser.add_argument('--peaks', type=int, default=50, help='Peaks per synthetic spectrum.')
+    parser.add_argument('--queries', type=int, default=500, help='Number of query spectra.')
+    parser.add_argument('--scoring_references', type=int, default=200, help='Reference spectra for the all-pairs scoring benchmark.')
+    parser.add_argument('--api_requests', type=int, default=20, help='Requests per /api/search measurement.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic data.')
+    parser.add_argument('-o', '--output', help='Path of the JSON results (default: benchmarks/results/<commit>-<time>.json).')
+    parser.add_argument('--compare', help='Earlier JSON results to compare against.')
+    args = parser.parse_args()
+
+    params = {key: getattr(args, key) for key in
+              ('library_size', 'peaks', 'queries', 'scoring_references', 'api_requests', 'seed')}
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'params': params,
+        'results': {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix='phytodiscover_bench_') as workdir:
+        for name in args.suites:
+            print(f"--- Running {name} benchmark ---")
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(run_suite, name, params, workdir).result()
+            report['results'][name] = result
+            print(json.dumps(result, indent=2))
+
+    output = args.output or os.path.join(project_root, 'benchmarks', 'results',
+                                         f"{report['commit']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"--- Results saved to {output} ---")
+
+    if args.compare:
+        compare(report, args.compare)
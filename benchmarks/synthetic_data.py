@@ -0,0 +1,186 @@
+import os
+import sys
+import base64
+import sqlite3
+import argparse
+import numpy as np
+from matchms import Spectrum
+
+# Add the core logic path to the system path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+core_path = os.path.join(project_root, 'phyto_discover_core')
+sys.path.insert(0, core_path)
+
+from core_search import embed_spectra
+
+# Intensity of the noise peaks, like the ~200 counts floor of data/pesticides.mgf
+NOISE_INTENSITY = 200.0
+
+def make_library_spectra(n_spectra, n_peaks=50, seed=0):
+    """
+    Generates `n_spectra` random reference spectra with `n_peaks` peaks each.
+    Precursors are spread over 100-1000 m/z and fragments lie below their precursor.
+    """
+    rng = np.random.default_rng(seed)
+    spectra = []
+    for i in range(n_spectra):
+        precursor_mz = rng.uniform(100, 1000)
+        mz = np.sort(rng.uniform(50, precursor_mz, n_peaks))
+        intensities = NOISE_INTENSITY + rng.lognormal(mean=7, sigma=1.5, size=n_peaks)
+        spectra.append(Spectrum(mz=mz, intensities=intensities, metadata={
+            'precursor_mz': round(precursor_mz, 4),
+            'compound_name': f'Synthetic_{i}',
+            'spectrum_id': f'SYNTHLIB{i:08d}',
+        }))
+    return spectra
+
+def make_query_spectra(library_spectra, n_queries, noise_peaks=10, seed=1):
+    """
+    Generates `n_queries` noisy copies of random library spectra: fragment m/z are
+    jittered by a few mDa, intensities are rescaled and noise peaks are added.
+    """
+    rng = np.random.default_rng(seed)
+    queries = []
+    for i, source in enumerate(rng.integers(0, len(library_spectra), n_queries)):
+        reference = library_spectra[source]
+        precursor_mz = reference.get('precursor_mz')
+        mz = np.concatenate([reference.peaks.mz + rng.normal(0, 0.002, len(reference.peaks.mz)),
+                             rng.uniform(50, precursor_mz, noise_peaks)])
+        intensities = np.concatenate([reference.peaks.intensities * rng.uniform(0.7, 1.3, len(reference.peaks.mz)),
+                                      NOISE_INTENSITY * rng.uniform(0.9, 1.1, noise_peaks)])
+        order = np.argsort(mz)
+        queries.append(Spectrum(mz=mz[order], intensities=intensities[order], metadata={
+            'precursor_mz': precursor_mz,
+            'id': str(i + 1),
+            'source_index': int(source),
+        }))
+    return queries
+
+def write_mgf(spectra, path):
+    """Writes spectra as BEGIN IONS blocks in the layout of data/pesticides.mgf."""
+    with open(path, 'w') as f:
+        for i, spectrum in enumerate(spectra):
+            f.write('BEGIN IONS\n')
+            f.write(f"PEPMASS={spectrum.get('precursor_mz')}\n")
+            f.write('CHARGE=1\nMSLEVEL=2\n')
+            f.write(f"NAME={spectrum.get('compound_name')}\n")
+            f.write(f"SPECTRUMID={spectrum.get('spectrum_id')}\n")
+            f.write(f"SCANS={i + 1}\n")
+            f.writelines(f"{mz:.6f}\t{intensity:.6f}\n" for mz, intensity in zip(spectrum.peaks.mz, spectrum.peaks.intensities))
+            f.write('END IONS\n\n')
+
+MZML_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0" id="PhytoDiscover_benchmark">
+  <cvList count="2">
+    <cv id="MS" fullName="Mass Spectrometry Ontology" version="4.1.12" URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>
+    <cv id="UO" fullName="Unit Ontology" version="09:04:2014" URI="http://obo.cvs.sourceforge.net/viewvc/obo/obo/ontology/phenotype/unit.obo"/>
+  </cvList>
+  <fileDescription>
+    <fileContent>
+      <cvParam cvRef="MS" accession="MS:1000580" name="MSn spectrum"/>
+    </fileContent>
+  </fileDescription>
+  <softwareList count="1">
+    <software id="PhytoDiscover_Generator" version="1.0">
+      <cvParam cvRef="MS" accession="MS:1000799" name="custom unreleased software tool"/>
+    </software>
+  </softwareList>
+  <instrumentConfigurationList count="1">
+    <instrumentConfiguration id="IC1">
+      <cvParam cvRef="MS" accession="MS:1000031" name="instrument model"/>
+    </instrumentConfiguration>
+  </instrumentConfigurationList>
+  <dataProcessingList count="1">
+    <dataProcessing id="DP1">
+      <processingMethod order="1" softwareRef="PhytoDiscover_Generator">
+        <cvParam cvRef="MS" accession="MS:1000544" name="Conversion to mzML"/>
+      </processingMethod>
+    </dataProcessing>
+  </dataProcessingList>
+  <run id="run1" defaultInstrumentConfigurationRef="IC1">
+    <spectrumList count="{count}" defaultDataProcessingRef="DP1">
+'''
+
+MZML_SPECTRUM = '''      <spectrum index="{index}" id="scan={scan}" defaultArrayLength="{length}">
+        <cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="2"/>
+        <precursorList count="1">
+          <precursor>
+            <selectedIonList count="1">
+              <selectedIon>
+                <cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="{precursor_mz}" unitAccession="MS:1000040" unitName="m/z"/>
+              </selectedIon>
+            </selectedIonList>
+          </precursor>
+        </precursorList>
+        <binaryDataArrayList count="2">
+          <binaryDataArray encodedLength="{mz_length}">
+            <cvParam cvRef="MS" accession="MS:1000514" name="m/z array" unitAccession="MS:1000040" unitName="m/z"/>
+            <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float"/>
+            <cvParam cvRef="MS" accession="MS:1000576" name="no compression"/>
+            <binary>{mz}</binary>
+          </binaryDataArray>
+          <binaryDataArray encodedLength="{intensity_length}">
+            <cvParam cvRef="MS" accession="MS:1000515" name="intensity array" unitAccession="MS:1000131" unitName="number of detector counts"/>
+            <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float"/>
+            <cvParam cvRef="MS" accession="MS:1000576" name="no compression"/>
+            <binary>{intensities}</binary>
+          </binaryDataArray>
+        </binaryDataArrayList>
+      </spectrum>
+'''
+
+MZML_FOOTER = '''    </spectrumList>
+  </run>
+</mzML>
+'''
+
+def write_mzml(spectra, path):
+    """Writes MS2 spectra as an uncompressed 64-bit mzML file like data/synthetic_data.mzML."""
+    with open(path, 'w') as f:
+        f.write(MZML_HEADER.replace('{count}', str(len(spectra))))
+        for i, spectrum in enumerate(spectra):
+            mz = base64.b64encode(np.asarray(spectrum.peaks.mz, dtype='<f8').tobytes()).decode()
+            intensities = base64.b64encode(np.asarray(spectrum.peaks.intensities, dtype='<f8').tobytes()).decode()
+            f.write(MZML_SPECTRUM.format(
+                index=i, scan=i + 1, length=len(spectrum.peaks.mz), precursor_mz=spectrum.get('precursor_mz'),
+                mz_length=len(mz), mz=mz, intensity_length=len(intensities), intensities=intensities
+            ))
+        f.write(MZML_FOOTER)
+
+def write_spectra_library(spectra, db_path):
+    """Writes an SQLite library with the 'spectra' table searched by core_search and the backend."""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute('''
+        CREATE TABLE spectra (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            compound_name TEXT,
+            precursor_mz REAL,
+            embedding array
+        )
+    ''')
+    embeddings = embed_spectra(spectra)
+    conn.executemany(
+        "INSERT INTO spectra (compound_name, precursor_mz, embedding) VALUES (?, ?, ?)",
+        [(s.get('compound_name'), s.get('precursor_mz'), embedding) for s, embedding in zip(spectra, embeddings)]
+    )
+    conn.commit()
+    conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic spectral library and query run.')
+    parser.add_argument('output_dir', help='Directory for library.mgf, library.db and queries.mzML.')
+    parser.add_argument('--library_size', type=int, default=10000, help='Number of library spectra.')
+    parser.add_argument('--peaks', type=int, default=50, help='Peaks per library spectrum.')
+    parser.add_argument('--queries', type=int, default=1000, help='Number of query spectra in the mzML run.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    library = make_library_spectra(args.library_size, args.peaks, args.seed)
+    queries = make_query_spectra(library, args.queries, seed=args.seed + 1)
+    write_mgf(library, os.path.join(args.output_dir, 'library.mgf'))
+    write_spectra_library(library, os.path.join(args.output_dir, 'library.db'))
+    write_mzml(queries, os.path.join(args.output_dir, 'queries.mzML'))
+    print(f"Wrote {len(library)} library spectra and {len(queries)} queries to {args.output_dir}.")
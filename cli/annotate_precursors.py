@@ -0,0 +1,33 @@
+import os
+import sys
+import csv
+import argparse
+
+# Add the core logic path to the system path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+core_path = os.path.join(project_root, 'phyto_discover_core')
+sys.path.insert(0, core_path)
+
+from library_manager import ADDUCTS, MassIndex, annotate_precursors
+
+# Columns of the CSV report written by annotate_precursors
+REPORT_FIELDS = ['query_id', 'query_mz', 'compound_name', 'formula', 'adduct', 'ion_mz', 'ppm_error']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Annotate every precursor m/z of an mzML run by exact mass.')
+    parser.add_argument('-f', '--mzml_file', required=True, help='Path to the input mzML file.')
+    parser.add_argument('-d', '--db_path', default=os.path.join(project_root, 'data', 'pesticide_library.db'), help="Compound database with a 'compounds' table.")
+    parser.add_argument('-o', '--output', default='mass_annotations.csv', help='Path for the output CSV report.')
+    parser.add_argument('--ppm', type=float, default=10, help='Mass tolerance in ppm.')
+    parser.add_argument('--adducts', nargs='+', choices=list(ADDUCTS), help='Adducts to consider (default: all).')
+    args = parser.parse_args()
+
+    mass_index = MassIndex.from_db(args.db_path, args.adducts)
+    print(f"Indexed {len(mass_index)} ions of {len(mass_index.names)} compounds.")
+    rows = annotate_precursors(args.mzml_file, mass_index, args.ppm)
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Found {len(rows)} mass matches. Report saved to {args.output}.")
@@ -7,7 +7,7 @@ core_path = os.path.join(project_root, 'phyto_discover_core')
 sys.path.insert(0, core_path)
 
 # Import the correct functions from the user's library manager
-from library_manager import build_database, add_compound_to_db
+from library_manager import build_database, add_compounds_to_db
 
 # Define the list of pesticides to add
 PESTICIDES = {
@@ -25,8 +25,7 @@ if __name__ == '__main__':
     # Create a new, empty database
     build_database(db_path)
 
-    # Add each pesticide to the database
-    for name, formula in PESTICIDES.items():
-        add_compound_to_db(db_path, name, formula)
+    # Add all pesticides in a single transaction
+    add_compounds_to_db(db_path, PESTICIDES.items())
 
     print("\n--- Food Safety database build complete. ---")
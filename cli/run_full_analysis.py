@@ -1,94 +1,243 @@
-import re
+import os
+import sys
 import csv
+import time
 import argparse
-import pymzml.run
 from matchms import Spectrum
-from matchms.similarity import ModifiedCosine
 import numpy as np
 
+# Add the core logic path to the system path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+core_path = os.path.join(project_root, 'phyto_discover_core')
+sys.path.insert(0, core_path)
+
+from sparse_scoring import score_sparse, score_dense
+from parallel_search import ParallelScorer
+from precursor_index import PrecursorIndex
+from mzml_stream import iter_query_batches
+from peak_store import PeakStore
+from spectrum_index import SpectrumIndex
+from spectrum_parsers import iter_records, MASSBANK
+from two_stage_search import TwoStageSearch, DEFAULT_CANDIDATES, load_reference_spectra, load_prefilter_index
+from preprocessing import DEFAULT_PREPROCESSING, preprocess_spectra, load_preprocessing_config, config_to_json
+from instrumentation import metrics, stage, count, timed_iter, format_breakdown, start_profiler, print_profile
+from result_cache import ResultCache, DEFAULT_CACHE_DIR, file_content_hash, library_version, make_key
+
 def get_lsd_spectrum(record_file):
-    with open(record_file, 'r') as f:
-        content = f.read()
-    precursor_match = re.search(r'PRECURSOR_M/Z (\d+\.\d+)', content)
-    peak_matches = re.findall(r'(\d+\.\d+)\s+(\d+\.?\d*)\s+(\d+)', content)
-    if not precursor_match or not peak_matches:
+    record = next(iter_records(record_file, MASSBANK), None)
+    if record is None:
+        return None
+    mzs, intensities, metadata = record
+    if metadata.get('precursor_mz') is None or len(mzs) == 0:
+        return None
+    return Spectrum(mz=mzs, intensities=intensities, metadata={'precursor_mz': metadata['precursor_mz'], 'compound_name': 'LSD'})
+
+def get_reference_peptide_spectrum(mzml_file, target_mz=725.36, tolerance=0.02, index=None):
+    if index is None:
+        index = SpectrumIndex.open(mzml_file)
+    positions = index.in_precursor_window(target_mz, tolerance, unit='Da')
+    if len(positions) == 0:
         return None
-    precursor_mz = float(precursor_match.group(1))
-    mzs = [float(match[0]) for match in peak_matches]
-    intensities = [float(match[1]) for match in peak_matches]
-    return Spectrum(mz=np.array(mzs), intensities=np.array(intensities), metadata={'precursor_mz': precursor_mz, 'compound_name': 'LSD'})
-
-def get_reference_peptide_spectrum(mzml_file, target_mz=725.36, tolerance=0.02):
-    run = pymzml.run.Reader(mzml_file)
-    for spec in run:
-        if spec.ms_level == 2 and spec.selected_precursors:
-            precursor_mz = float(spec.selected_precursors[0].get('mz'))
-            if abs(precursor_mz - target_mz) <= tolerance:
-                return Spectrum(mz=np.array(spec.mz), intensities=np.array(spec.i), metadata={'precursor_mz': precursor_mz, 'compound_name': 'Reference_Peptide_725'})
-    return None
-
-def load_query_spectra(mzml_file):
-    run = pymzml.run.Reader(mzml_file)
-    queries = []
-    for spec in run:
-        if spec.ms_level == 2 and len(spec.mz) > 0 and spec.selected_precursors:
-            try:
-                queries.append(Spectrum(mz=np.array(spec.mz), intensities=np.array(spec.i), metadata={'precursor_mz': float(spec.selected_precursors[0].get('mz')), 'id': str(spec.ID)}))
-            except (IndexError, TypeError):
-                continue
-    return queries
+    spectrum = index.read(positions[0])
+    return Spectrum(mz=spectrum.peaks.mz, intensities=spectrum.peaks.intensities, metadata={'precursor_mz': spectrum.get('precursor_mz'), 'compound_name': 'Reference_Peptide_725'})
+
+# Columns of the CSV report written by run_full_analysis
+REPORT_FIELDS = ['query_id', 'query_mz', 'match_compound_name', 'match_mz', 'similarity_score']
+
+def collect_hits(query_spectra, reference_spectra, best_indices, best_scores, threshold):
+    """Formats every query whose best score reaches `threshold` as a report row."""
+    hits = []
+    for i in np.flatnonzero(best_scores >= threshold):
+        query_spec = query_spectra[i]
+        best_match_ref = reference_spectra[best_indices[i]]
+        hits.append({
+            'query_id': query_spec.get('id'),
+            'query_mz': f"{query_spec.get('precursor_mz'):.4f}",
+            'match_compound_name': best_match_ref.get('compound_name'),
+            'match_mz': f"{best_match_ref.get('precursor_mz'):.4f}",
+            'similarity_score': f"{best_scores[i]:.4f}"
+        })
+    return hits
+
+class ReportWriter:
+    """
+    Appends hits to the CSV report as they are found.
+    The file is only created once the first hit arrives.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.n_hits = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, hits):
+        if not hits:
+            return
+        if self._writer is None:
+            self._file = open(self.output_path, 'w', newline='')
+            self._writer = csv.DictWriter(self._file, fieldnames=REPORT_FIELDS)
+            self._writer.writeheader()
+        self._writer.writerows(hits)
+        self._file.flush()
+        self.n_hits += len(hits)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+def run_analysis(args, preprocessing, cache=None, cache_key=None):
+    """Builds the reference library, streams and scores the query spectra and writes the report."""
+    library_start = time.perf_counter()
+    if args.library:
+        print(f"--- Loading Reference Library {args.library} ---")
+        reference_spectra = load_reference_spectra(args.library)
+        print(f"Loaded {len(reference_spectra)} reference spectra.")
+    else:
+        print("--- Building In-Memory Reference Library ---")
+        reference_spectra = []
+        lsd_spec = get_lsd_spectrum('lsd_record.txt')
+        if lsd_spec: reference_spectra.append(lsd_spec); print("Loaded LSD spectrum.")
+        spectrum_index = SpectrumIndex.open(args.mzml_file)
+        ref_pep_spec = get_reference_peptide_spectrum(args.mzml_file, index=spectrum_index)
+        if ref_pep_spec: reference_spectra.append(ref_pep_spec); print("Loaded Reference_Peptide_725 spectrum.")
+        reference_spectra = preprocess_spectra(PeakStore.from_spectra(reference_spectra), preprocessing)
+
+    if not reference_spectra:
+        print("\nError: Could not build library. Exiting.")
+        return
+    reference_index = PrecursorIndex(reference_spectra.precursor_mzs)
+    metrics.record('library_build', time.perf_counter() - library_start)
+
+    print(f"\n--- Streaming Query Spectra from {args.mzml_file} (score > {args.threshold}) ---")
+    report = ReportWriter(args.output)
+    two_stage = None
+    if args.scoring == 'two_stage':
+        ann_index = load_prefilter_index(args.library, len(reference_spectra)) if args.library else None
+        two_stage = TwoStageSearch(reference_spectra, similarity='modified_cosine', ann_index=ann_index)
+    scorer = ParallelScorer(reference_spectra, args.workers) if args.workers > 1 else None
+    all_hits = []
+    n_queries = 0
+    n_pairs = 0
+    start_time = time.perf_counter()
+    try:
+        for batch in timed_iter(iter_query_batches(args.mzml_file, args.batch_size), 'mzml_parse'):
+            with stage('preprocessing'):
+                batch = preprocess_spectra(batch, preprocessing)
+            with stage('scoring'):
+                if two_stage:
+                    n_pairs += len(batch) * min(args.candidates, len(reference_spectra))
+                    best_indices, best_scores = two_stage.best_per_query(batch, n_candidates=args.candidates)
+                elif args.scoring == 'sparse':
+                    if scorer:
+                        sparse_scores = scorer.score_sparse(batch, args.precursor_tolerance, args.tolerance_unit)
+                    else:
+                        sparse_scores = score_sparse(batch, reference_spectra, args.precursor_tolerance,
+                                                     args.tolerance_unit, reference_index=reference_index)
+                    n_pairs += len(sparse_scores)
+                    best_indices, best_scores = sparse_scores.best_per_query()
+                else:
+                    n_pairs += len(batch) * len(reference_spectra)
+                    if scorer:
+                        best_indices, best_scores = scorer.score_dense(batch)
+                    else:
+                        best_indices, best_scores = score_dense(batch, reference_spectra)
+
+            hits = collect_hits(batch, reference_spectra, best_indices, best_scores, args.threshold)
+            with stage('report_write'):
+                report.write(hits)
+            count('query_spectra', len(batch))
+            count('hits', len(hits))
+            if cache:
+                all_hits.extend(hits)
+            n_queries += len(batch)
+            elapsed = time.perf_counter() - start_time
+            print(f"Processed {n_queries} query spectra ({n_queries / elapsed:.1f} spectra/s), {report.n_hits} hits so far.")
+    finally:
+        report.close()
+        if scorer:
+            scorer.close()
+
+    if n_queries == 0:
+        print("\nError: Could not load query spectra. Exiting.")
+        return
+
+    if cache:
+        cache.put(cache_key, all_hits)
+
+    count('pairs_scored', n_pairs)
+    print(f"Scored {n_pairs} query/reference pairs.")
+    print(f"Found {report.n_hits} high-confidence hits.")
+
+    if report.n_hits:
+        print(f"--- Final report saved to {args.output} ---")
+    else:
+        print("--- No significant matches found. ---")
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Run a full, in-memory analysis.')
+    parser = argparse.ArgumentParser(description='Run a full analysis, streaming query spectra in batches.')
     parser.add_argument('-f', '--mzml_file', required=True, help='Path to the input mzML file.')
     parser.add_argument('-o', '--output', default='final_report.csv', help='Path for the output CSV report.')
     parser.add_argument('-t', '--threshold', type=float, default=0.85, help='Similarity score threshold.')
+    parser.add_argument('--scoring', choices=['dense', 'sparse', 'two_stage'], default='dense', help='Score all pairs (dense), only pairs within the precursor tolerance (sparse), or only the best embedding candidates of each query (two_stage).')
+    parser.add_argument('--library', help='Screen against this stored library (columnar directory or SQLite with reference_spectra) instead of the built-in references.')
+    parser.add_argument('--candidates', type=int, default=DEFAULT_CANDIDATES, help='Embedding candidates per query rescored by two_stage scoring.')
+    parser.add_argument('--precursor_tolerance', type=float, default=0.02, help='Precursor m/z tolerance used by sparse scoring.')
+    parser.add_argument('--tolerance_unit', choices=['Da', 'ppm'], default='Da', help='Unit of --precursor_tolerance.')
+    parser.add_argument('--batch_size', type=int, default=1000, help='Number of query spectra parsed and scored at a time.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes used for dense or sparse scoring (two_stage scoring runs in one process).')
+    parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR, help='Directory of the result cache.')
+    parser.add_argument('--no_cache', action='store_true', help='Always rescore instead of reusing cached results.')
+    parser.add_argument('--no_preprocessing', action='store_true', help='Score the raw peaks instead of the filtered ones.')
+    parser.add_argument('--profile', action='store_true', help='Print the time spent in each pipeline stage.')
+    parser.add_argument('--cprofile', action='store_true', help='Also run under cProfile and print the most expensive functions.')
     args = parser.parse_args()
+    if args.workers > 1 and args.scoring == 'two_stage':
+        parser.error('--workers is only supported with dense or sparse scoring, not two_stage.')
+    profiler = start_profiler() if args.cprofile else None
 
-    print("--- Building In-Memory Reference Library ---")
-    reference_spectra = []
-    lsd_spec = get_lsd_spectrum('lsd_record.txt')
-    if lsd_spec: reference_spectra.append(lsd_spec); print("Loaded LSD spectrum.")
-    ref_pep_spec = get_reference_peptide_spectrum(args.mzml_file)
-    if ref_pep_spec: reference_spectra.append(ref_pep_spec); print("Loaded Reference_Peptide_725 spectrum.")
-
-    print(f"\n--- Loading Query Spectra from {args.mzml_file} ---")
-    query_spectra = load_query_spectra(args.mzml_file)
-    print(f"Loaded {len(query_spectra)} query spectra.")
+    # A stored library was preprocessed when it was built, so its queries get the same config
+    if args.no_preprocessing:
+        preprocessing = None
+    elif args.library:
+        preprocessing = load_preprocessing_config(args.library)
+    else:
+        preprocessing = DEFAULT_PREPROCESSING
 
-    if not reference_spectra or not query_spectra:
-        print("\nError: Could not build library or load queries. Exiting.")
-        exit()
+    cache = None if args.no_cache else ResultCache(args.cache_dir)
+    cache_key = cached_hits = None
+    if cache:
+        # The built-in reference library comes from lsd_record.txt and the mzML file itself
+        if args.library:
+            reference_version = library_version(args.library)
+        elif os.path.exists('lsd_record.txt'):
+            reference_version = file_content_hash('lsd_record.txt')
+        else:
+            reference_version = None
+        cache_key = make_key(
+            kind='run_full_analysis', mzml_hash=file_content_hash(args.mzml_file), library_version=reference_version,
+            method=args.scoring, tolerance=[args.precursor_tolerance, args.tolerance_unit] if args.scoring == 'sparse' else None,
+            candidates=args.candidates if args.scoring == 'two_stage' else None, threshold=args.threshold,
+            preprocessing=config_to_json(preprocessing)
+        )
+        cached_hits = cache.get(cache_key)
 
-    print(f"\n--- Searching for matches with score > {args.threshold} ---")
-    similarity = ModifiedCosine()
-    scores = similarity.matrix(query_spectra, reference_spectra)
-    hits = []
-    for i, query_spec in enumerate(query_spectra):
-        # Corrected logic for handling the 2D array of tuples
-        similarity_scores = [s[0] for s in scores[i, :]]
-        if not similarity_scores:
-            continue
-        best_match_idx = np.argmax(similarity_scores)
-        best_score = similarity_scores[best_match_idx]
-        
-        if best_score >= args.threshold:
-            best_match_ref = reference_spectra[best_match_idx]
-            hits.append({
-                'query_id': query_spec.get('id'),
-                'query_mz': f"{query_spec.get('precursor_mz'):.4f}",
-                'match_compound_name': best_match_ref.get('compound_name'),
-                'match_mz': f"{best_match_ref.get('precursor_mz'):.4f}",
-                'similarity_score': f"{best_score:.4f}"
-            })
-
-    print(f"Found {len(hits)} high-confidence hits.")
-
-    if hits:
-        with open(args.output, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=hits[0].keys())
-            writer.writeheader()
-            writer.writerows(hits)
-        print(f"--- Final report saved to {args.output} ---")
+    if cached_hits is not None:
+        print(f"\n--- Reusing cached results for {args.mzml_file} ---")
+        report = ReportWriter(args.output)
+        with stage('report_write'):
+            report.write(cached_hits)
+        report.close()
+        count('cached_analyses')
+        count('hits', report.n_hits)
+        print(f"Found {report.n_hits} high-confidence hits.")
+        print(f"--- Final report saved to {args.output} ---" if report.n_hits else "--- No significant matches found. ---")
     else:
-        print("--- No significant matches found. ---")
+        run_analysis(args, preprocessing, cache, cache_key)
+
+    if args.profile:
+        print("\n--- Stage Breakdown ---")
+        print(format_breakdown())
+    if profiler:
+        print("\n--- cProfile: Most Expensive Functions ---")
+        print_profile(profiler)
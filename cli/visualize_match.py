@@ -1,40 +1,46 @@
-import re
+import os
+import sys
 import argparse
-import pymzml.run
 from matchms import Spectrum
 from matchms.similarity import ModifiedCosine
-import numpy as np
 import matplotlib.pyplot as plt
 
+# Add the core logic path to the system path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+core_path = os.path.join(project_root, 'phyto_discover_core')
+sys.path.insert(0, core_path)
+
+from spectrum_index import SpectrumIndex
+from spectrum_parsers import iter_records, MASSBANK
+
 # --- Data Loading Functions (reused and adapted) ---
 
 def get_lsd_spectrum(record_file='lsd_record.txt'):
-    with open(record_file, 'r') as f:
-        content = f.read()
-    precursor_match = re.search(r'PRECURSOR_M/Z (\\d+\\.\\d+)', content)
-    peak_matches = re.findall(r'(\\d+\\.\\d+)\\s+(\\d+\\.?\\d*)\\s+(\\d+)', content)
-    if not precursor_match or not peak_matches:
+    record = next(iter_records(record_file, MASSBANK), None)
+    if record is None:
+        return None
+    mzs, intensities, metadata = record
+    if metadata.get('precursor_mz') is None or len(mzs) == 0:
+        return None
+    return Spectrum(mz=mzs, intensities=intensities, metadata={'precursor_mz': metadata['precursor_mz'], 'compound_name': 'LSD'})
+
+def get_reference_peptide_spectrum(mzml_file, target_mz=725.36, tolerance=0.02, index=None):
+    if index is None:
+        index = SpectrumIndex.open(mzml_file)
+    positions = index.in_precursor_window(target_mz, tolerance, unit='Da')
+    if len(positions) == 0:
+        return None
+    spectrum = index.read(positions[0])
+    return Spectrum(mz=spectrum.peaks.mz, intensities=spectrum.peaks.intensities, metadata={'precursor_mz': spectrum.get('precursor_mz'), 'compound_name': 'Reference_Peptide_725'})
+
+def get_query_spectrum_by_id(mzml_file, query_id, index=None):
+    if index is None:
+        index = SpectrumIndex.open(mzml_file)
+    position = index.find(query_id)
+    if position is None:
         return None
-    precursor_mz = float(precursor_match.group(1))
-    mzs = [float(match[0]) for match in peak_matches]
-    intensities = [float(match[1]) for match in peak_matches]
-    return Spectrum(mz=np.array(mzs), intensities=np.array(intensities), metadata={'precursor_mz': precursor_mz, 'compound_name': 'LSD'})
-
-def get_reference_peptide_spectrum(mzml_file, target_mz=725.36, tolerance=0.02):
-    run = pymzml.run.Reader(mzml_file)
-    for spec in run:
-        if spec.ms_level == 2 and spec.selected_precursors:
-            precursor_mz = float(spec.selected_precursors[0].get('mz'))
-            if abs(precursor_mz - target_mz) <= tolerance:
-                return Spectrum(mz=np.array(spec.mz), intensities=np.array(spec.i), metadata={'precursor_mz': precursor_mz, 'compound_name': 'Reference_Peptide_725'})
-    return None
-
-def get_query_spectrum_by_id(mzml_file, query_id):
-    run = pymzml.run.Reader(mzml_file)
-    for spec in run:
-        if str(spec.ID) == query_id:
-            return Spectrum(mz=np.array(spec.mz), intensities=np.array(spec.i), metadata={'precursor_mz': float(spec.selected_precursors[0].get('mz')), 'id': str(spec.ID)})
-    return None
+    spectrum = index.read(position)
+    return Spectrum(mz=spectrum.peaks.mz, intensities=spectrum.peaks.intensities, metadata={'precursor_mz': spectrum.get('precursor_mz'), 'id': spectrum.get('id')})
 
 # --- Plotting Function ---
 
@@ -77,13 +83,14 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     print("--- Loading Spectra ---")
-    query_spec = get_query_spectrum_by_id(args.mzml_file, args.query_id)
+    spectrum_index = SpectrumIndex.open(args.mzml_file)
+    query_spec = get_query_spectrum_by_id(args.mzml_file, args.query_id, index=spectrum_index)
     
     reference_spec = None
     if args.reference_name == 'LSD':
         reference_spec = get_lsd_spectrum()
     elif args.reference_name == 'Reference_Peptide_725':
-        reference_spec = get_reference_peptide_spectrum(args.mzml_file)
+        reference_spec = get_reference_peptide_spectrum(args.mzml_file, index=spectrum_index)
 
     if query_spec and reference_spec:
         print("--- Generating Plot ---")
@@ -0,0 +1,261 @@
+import os
+import argparse
+import numpy as np
+from matchms.similarity import CosineGreedy
+from core_search import load_library, normalize_rows, top_k_indices
+
+# Bump whenever the layout of the saved index changes
+ANN_INDEX_VERSION = 1
+
+# File name of the index inside a columnar library, or suffix beside an SQLite library
+ANN_INDEX_FILE = 'ann_index.npz'
+ANN_INDEX_SUFFIX = '.ann.npz'
+
+# Defaults for the recall/latency trade-off at search time
+DEFAULT_NPROBE = 8
+DEFAULT_RERANK = 100
+
+# Rows processed at a time when assigning vectors to centroids
+ASSIGN_CHUNK = 65536
+
+# At most this many training vectors per centroid are sampled for k-means
+TRAIN_POINTS_PER_CENTROID = 256
+
+def ann_index_path(db_path):
+    """Returns where the ANN index of the library at `db_path` is stored."""
+    if os.path.isdir(db_path):
+        return os.path.join(db_path, ANN_INDEX_FILE)
+    return db_path + ANN_INDEX_SUFFIX
+
+def _source_file(db_path):
+    """The library file whose modification invalidates its ANN index."""
+    if os.path.isdir(db_path):
+        return os.path.join(db_path, 'embeddings.npy')
+    return db_path
+
+def _assign(data, centroids, spherical):
+    """Returns the index of the nearest centroid for every row of `data`, in bounded chunks."""
+    labels = np.empty(len(data), dtype=np.int64)
+    centroid_norms = None if spherical else np.einsum('ij,ij->i', centroids, centroids)
+    for start in range(0, len(data), ASSIGN_CHUNK):
+        chunk = np.asarray(data[start:start + ASSIGN_CHUNK], dtype=np.float32)
+        products = chunk @ centroids.T
+        if spherical:
+            labels[start:start + len(chunk)] = products.argmax(axis=1)
+        else:
+            # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, and ||x||^2 does not change the argmin
+            labels[start:start + len(chunk)] = (centroid_norms - 2 * products).argmin(axis=1)
+    return labels
+
+def kmeans(data, n_clusters, n_iter=20, seed=0, spherical=True):
+    """
+    Lloyd's k-means on the rows of `data`, returning an n_clusters x d float32 centroid matrix.
+    With `spherical`, rows are compared by cosine similarity and centroids are kept at unit
+    length; otherwise squared Euclidean distance is used. Empty clusters are reseeded from random rows.
+    """
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    n_clusters = min(n_clusters, len(data))
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _assign(data, centroids, spherical)
+        counts = np.bincount(labels, minlength=n_clusters)
+        empty = counts == 0
+        order = np.argsort(labels, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        centroids[~empty] = np.add.reduceat(data[order], starts, axis=0) / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+        if spherical:
+            centroids = normalize_rows(centroids)
+    return centroids
+
+class IVFIndex:
+    """
+    Inverted-file index over a normalized embedding matrix.
+
+    A k-means coarse quantizer splits the library into `n_lists` cells; a query
+    only scores the entries of its `nprobe` closest cells, so the cost per query
+    grows with the cell size instead of the library size. Optionally the entries
+    are also product-quantized into one byte per sub-vector (of their residual to
+    the cell centroid), so candidates are scanned with table lookups and only a
+    short list is re-ranked exactly.
+    """
+
+    def __init__(self, centroids, list_offsets, list_ids, pq_codebooks=None, pq_codes=None, nprobe=DEFAULT_NPROBE):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.pq_codebooks = pq_codebooks
+        self.pq_codes = pq_codes
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, pq_subquantizers=None, nprobe=DEFAULT_NPROBE, n_iter=20, seed=0):
+        """
+        Trains the index on `embeddings` (rows are normalized to unit length first).
+        `n_lists` defaults to 4 * sqrt(N). With `pq_subquantizers` = m, every entry
+        is also encoded as m one-byte codes; the embedding size must be divisible by m.
+        """
+        n_items, dim = embeddings.shape
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(n_items))
+        n_lists = max(1, min(n_lists, n_items))
+        if pq_subquantizers and dim % pq_subquantizers:
+            raise ValueError(f"Embedding size {dim} is not divisible by {pq_subquantizers} PQ sub-quantizers.")
+
+        rng = np.random.default_rng(seed)
+        n_train = min(n_items, n_lists * TRAIN_POINTS_PER_CENTROID)
+        sample = np.sort(rng.choice(n_items, n_train, replace=False))
+        train = normalize_rows(embeddings[sample])
+        print(f"Training {n_lists} IVF lists on {n_train} of {n_items} embeddings...")
+        centroids = kmeans(train, n_lists, n_iter=n_iter, seed=seed)
+
+        labels = np.empty(n_items, dtype=np.int64)
+        for start in range(0, n_items, ASSIGN_CHUNK):
+            chunk = normalize_rows(embeddings[start:start + ASSIGN_CHUNK])
+            labels[start:start + len(chunk)] = _assign(chunk, centroids, spherical=True)
+        list_ids = np.argsort(labels, kind='stable')
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=len(centroids)), out=list_offsets[1:])
+
+        pq_codebooks = pq_codes = None
+        if pq_subquantizers:
+            sub_dim = dim // pq_subquantizers
+            n_codes = min(256, n_train)
+            print(f"Training {pq_subquantizers} PQ sub-quantizers with {n_codes} codes each...")
+            residuals = train - centroids[labels[sample]]
+            pq_codebooks = np.stack([
+                kmeans(residuals[:, m * sub_dim:(m + 1) * sub_dim], n_codes, n_iter=n_iter, seed=seed, spherical=False)
+                for m in range(pq_subquantizers)
+            ])
+            pq_codes = np.empty((n_items, pq_subquantizers), dtype=np.uint8)
+            for start in range(0, n_items, ASSIGN_CHUNK):
+                chunk = normalize_rows(embeddings[start:start + ASSIGN_CHUNK])
+                chunk -= centroids[labels[start:start + len(chunk)]]
+                for m in range(pq_subquantizers):
+                    pq_codes[start:start + len(chunk), m] = _assign(
+                        chunk[:, m * sub_dim:(m + 1) * sub_dim], pq_codebooks[m], spherical=False
+                    )
+            # Codes are stored in list order, so each inverted list is a contiguous block
+            pq_codes = pq_codes[list_ids]
+        return cls(centroids, list_offsets, list_ids, pq_codebooks, pq_codes, nprobe)
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    def candidates(self, query, nprobe=None):
+        """
+        Returns the positions (into list order) of all entries in the `nprobe` cells
+        closest to `query`, and the similarity of the query to the cell of each entry.
+        """
+        centroid_scores = self.centroids @ query
+        probes = top_k_indices(centroid_scores, nprobe or self.nprobe)
+        sizes = self.list_offsets[probes + 1] - self.list_offsets[probes]
+        positions = np.concatenate(
+            [np.arange(self.list_offsets[c], self.list_offsets[c + 1]) for c in probes] or [np.zeros(0, np.int64)]
+        )
+        return positions, np.repeat(centroid_scores[probes], sizes)
+
+    def search(self, query_embedding, top_k=1, nprobe=None, embeddings=None, rerank=DEFAULT_RERANK):
+        """
+        Returns (ids, scores) of the approximate `top_k` nearest library entries, best first.
+
+        Entries of the probed cells are scored exactly against `embeddings` if given.
+        With PQ codes, they are first ranked by their approximate score and only the
+        best `rerank` (at least `top_k`) are scored exactly; without `embeddings`,
+        the approximate PQ scores are returned.
+        """
+        query = normalize_rows(query_embedding)[0]
+        positions, cell_scores = self.candidates(query, nprobe)
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        if self.pq_codes is not None:
+            sub_dim = query.shape[0] // self.pq_codebooks.shape[0]
+            # Inner product of every sub-vector of the query with every code of its sub-quantizer;
+            # q.x = q.centroid + q.residual, and the residual is approximated by its codes
+            table = np.einsum('mkd,md->mk', self.pq_codebooks, query.reshape(-1, sub_dim))
+            approx = cell_scores + table[np.arange(table.shape[0]), self.pq_codes[positions]].sum(axis=1)
+            if embeddings is None:
+                best = top_k_indices(approx, top_k)
+                return self.list_ids[positions[best]], approx[best]
+            positions = positions[top_k_indices(approx, max(rerank, top_k))]
+        elif embeddings is None:
+            raise ValueError("An index without PQ codes needs the library embeddings to score candidates.")
+
+        ids = np.sort(self.list_ids[positions])
+        scores = np.asarray(embeddings[ids] @ query, dtype=np.float32)
+        best = top_k_indices(scores, top_k)
+        return ids[best], scores[best]
+
+    def save(self, path, source=None):
+        """Writes the index to `path`, stamped with the size and mtime of the library file `source`."""
+        stat = os.stat(source) if source else None
+        arrays = {}
+        if self.pq_codes is not None:
+            arrays = {'pq_codebooks': self.pq_codebooks, 'pq_codes': self.pq_codes}
+        with open(path, 'wb') as f:
+            np.savez(f, version=ANN_INDEX_VERSION, nprobe=self.nprobe,
+                     source_size=stat.st_size if stat else -1, source_mtime_ns=stat.st_mtime_ns if stat else -1,
+                     centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids, **arrays)
+
+    @classmethod
+    def load(cls, path, source=None):
+        """
+        Loads an index saved by `save`. If `source` is given, returns None when the
+        library file has changed since the index was built, so a stale index is never used.
+        """
+        with np.load(path) as saved:
+            if int(saved['version']) != ANN_INDEX_VERSION:
+                return None
+            if source is not None:
+                stat = os.stat(source)
+                if int(saved['source_size']) != stat.st_size or int(saved['source_mtime_ns']) != stat.st_mtime_ns:
+                    return None
+            pq = 'pq_codes' in saved.files
+            return cls(saved['centroids'], saved['list_offsets'], saved['list_ids'],
+                       saved['pq_codebooks'] if pq else None, saved['pq_codes'] if pq else None,
+                       int(saved['nprobe']))
+
+def load_ann_index(db_path):
+    """Returns the up-to-date ANN index stored with the library at `db_path`, or None."""
+    path = ann_index_path(db_path)
+    if not os.path.exists(path):
+        return None
+    return IVFIndex.load(path, source=_source_file(db_path))
+
+def build_ann_index(db_path, n_lists=None, pq_subquantizers=None, nprobe=DEFAULT_NPROBE, seed=0):
+    """Builds the ANN index of the library at `db_path` and saves it alongside the library."""
+    library = load_library(db_path)
+    index = IVFIndex.build(library.embeddings, n_lists=n_lists, pq_subquantizers=pq_subquantizers,
+                           nprobe=nprobe, seed=seed)
+    path = ann_index_path(db_path)
+    index.save(path, source=_source_file(db_path))
+    print(f"Saved ANN index with {len(index.centroids)} lists over {len(index)} spectra to {path}.")
+    return index
+
+def rerank_by_peaks(query_spectrum, candidate_ids, get_spectrum, similarity=None):
+    """
+    Exact re-rank stage: scores the query against the peaks of every candidate with
+    `similarity` (CosineGreedy by default, or e.g. ModifiedCosine) and returns
+    (id, score, matched_peaks) tuples, best first. `get_spectrum` maps a library id
+    to its matchms Spectrum, e.g. ColumnarLibrary.spectrum.
+    """
+    if similarity is None:
+        similarity = CosineGreedy()
+    scored = []
+    for idx in candidate_ids:
+        result = similarity.pair(query_spectrum, get_spectrum(idx))
+        scored.append((int(idx), float(result['score']), int(result['matches'])))
+    scored.sort(key=lambda item: item[1], reverse=True)
+    return scored
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an approximate nearest neighbour index for a spectral library.')
+    parser.add_argument('db_path', help="Path to an SQLite library ('spectra' table) or a columnar library directory.")
+    parser.add_argument('--n_lists', type=int, help='Number of IVF lists (default: 4 * sqrt(library size)).')
+    parser.add_argument('--pq', type=int, dest='pq_subquantizers', help='Number of product quantization sub-vectors (disabled by default).')
+    parser.add_argument('--nprobe', type=int, default=DEFAULT_NPROBE, help='Default number of lists scanned per query.')
+    args = parser.parse_args()
+    build_ann_index(args.db_path, args.n_lists, args.pq_subquantizers, args.nprobe)
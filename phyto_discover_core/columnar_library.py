@@ -0,0 +1,208 @@
+import os
+import sqlite3
+import pickle
+import argparse
+import numpy as np
+from matchms import Spectrum
+from core_search import SpectralLibrary, convert_array, normalize_rows, detect_source_table
+from peak_store import PeakStore
+from preprocessing import PREPROCESSING_METADATA_KEY, load_preprocessing_config, config_to_json, read_library_metadata
+from embedders import EMBEDDER_METADATA_KEY, EMBEDDER_WEIGHTS_FILE, load_embedder_weights
+
+# Bump whenever the on-disk layout changes
+COLUMNAR_FORMAT_VERSION = 1
+
+EMBEDDINGS_FILE = 'embeddings.npy'
+PRECURSOR_MZ_FILE = 'precursor_mz.npy'
+PEAK_OFFSETS_FILE = 'peak_offsets.npy'
+PEAK_MZ_FILE = 'peak_mz.npy'
+PEAK_INTENSITIES_FILE = 'peak_intensities.npy'
+METADATA_FILE = 'metadata.sqlite'
+
+# Rows fetched from SQLite at a time while importing
+IMPORT_BATCH_SIZE = 1000
+
+class ColumnarLibrary:
+    """
+    Read-only spectral library stored as memory-mapped columns.
+
+    A library is a directory holding a pre-normalized float32 embedding matrix,
+    the precursor m/z array and all peaks flattened into two arrays with an
+    offset index (spectrum i owns peaks offsets[i]:offsets[i + 1]), plus a small
+    SQLite file with per-spectrum metadata. Opening it maps the arrays instead of
+    unpickling one row at a time, and the OS page cache shares them between processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode='r')
+        self.precursor_mzs = np.load(os.path.join(path, PRECURSOR_MZ_FILE), mmap_mode='r')
+        self.peak_offsets = np.load(os.path.join(path, PEAK_OFFSETS_FILE), mmap_mode='r')
+        self.peak_mz = np.load(os.path.join(path, PEAK_MZ_FILE), mmap_mode='r')
+        self.peak_intensities = np.load(os.path.join(path, PEAK_INTENSITIES_FILE), mmap_mode='r')
+
+        conn = sqlite3.connect(os.path.join(path, METADATA_FILE))
+        rows = conn.execute("SELECT spectrum_id, compound_name FROM library_spectra ORDER BY idx").fetchall()
+        self.info = dict(conn.execute("SELECT key, value FROM library_info").fetchall())
+        conn.close()
+        self.spectrum_ids = np.array([row[0] for row in rows], dtype=object)
+        self.names = np.array([row[1] for row in rows], dtype=object)
+
+    def __len__(self):
+        return len(self.names)
+
+    def peaks(self, idx):
+        """Returns (mz, intensities) views onto the flat peak arrays for spectrum `idx`."""
+        start, stop = self.peak_offsets[idx], self.peak_offsets[idx + 1]
+        return self.peak_mz[start:stop], self.peak_intensities[start:stop]
+
+    def spectrum(self, idx):
+        """Materializes spectrum `idx` as a matchms Spectrum."""
+        mz, intensities = self.peaks(idx)
+        metadata = {'spectrum_id': self.spectrum_ids[idx], 'compound_name': self.names[idx]}
+        if not np.isnan(self.precursor_mzs[idx]):
+            metadata['precursor_mz'] = float(self.precursor_mzs[idx])
+        return Spectrum(mz=np.array(mz, dtype=np.float64), intensities=np.array(intensities, dtype=np.float64),
+                        metadata=metadata)
+
+    def to_peak_store(self):
+        """Reads every spectrum into a compact in-memory PeakStore."""
+        return PeakStore.from_flat(self.peak_mz, self.peak_intensities, self.peak_offsets, np.asarray(self.precursor_mzs),
+                                   {'compound_name': self.names, 'spectrum_id': self.spectrum_ids})
+
+    def to_spectral_library(self):
+        """Returns a SpectralLibrary that searches the memory-mapped embeddings without copying them."""
+        return SpectralLibrary.from_arrays(self.names, self.precursor_mzs, self.embeddings)
+
+def _iter_source_rows(conn, table):
+    """
+    Yields (spectrum_id, compound_name, precursor_mz, embedding, mz, intensities) per library row.
+    The 'spectra' table has no peaks, so its peak arrays are empty.
+    """
+    if table == 'reference_spectra':
+        cursor = conn.execute(
+            "SELECT spectrum_id, compound_name, precursor_mz, serialized_spectrum, embedding "
+            "FROM reference_spectra ORDER BY id"
+        )
+    else:
+        cursor = conn.execute("SELECT id, compound_name, precursor_mz, NULL, embedding FROM spectra ORDER BY id")
+
+    while True:
+        rows = cursor.fetchmany(IMPORT_BATCH_SIZE)
+        if not rows:
+            return
+        for spectrum_id, name, precursor_mz, serialized_spectrum, embedding in rows:
+            if table == 'reference_spectra':
+                spectrum = pickle.loads(serialized_spectrum)
+                embedding = pickle.loads(embedding)
+                mz, intensities = spectrum.peaks.mz, spectrum.peaks.intensities
+            else:
+                embedding = convert_array(embedding)
+                mz, intensities = np.zeros(0), np.zeros(0)
+            yield str(spectrum_id), name, precursor_mz, embedding, mz, intensities
+
+def _bin_to_npy(bin_path, npy_path, dtype):
+    """Converts a raw binary column into a .npy file, copying it in bounded chunks."""
+    raw = np.memmap(bin_path, dtype=dtype, mode='r') if os.path.getsize(bin_path) else np.zeros(0, dtype=dtype)
+    out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=(len(raw),))
+    chunk = 1 << 24
+    for start in range(0, len(raw), chunk):
+        out[start:start + chunk] = raw[start:start + chunk]
+    out.flush()
+    del raw, out
+    os.remove(bin_path)
+
+def import_sqlite_library(db_path, output_dir, table=None):
+    """
+    Converts a 'reference_spectra' or 'spectra' SQLite library into the columnar format.
+    Rows are streamed, so memory use does not depend on the library size.
+    """
+    print(f"Importing {db_path} into columnar library {output_dir}...")
+    os.makedirs(output_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    if table is None:
+        table = detect_source_table(conn)
+    n_spectra = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    metadata_path = os.path.join(output_dir, METADATA_FILE)
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+    meta = sqlite3.connect(metadata_path)
+    meta.execute('''
+        CREATE TABLE library_spectra (
+            idx INTEGER PRIMARY KEY,
+            spectrum_id TEXT,
+            compound_name TEXT,
+            precursor_mz REAL
+        )
+    ''')
+    meta.execute("CREATE INDEX idx_library_spectra_precursor_mz ON library_spectra (precursor_mz)")
+    meta.execute("CREATE TABLE library_info (key TEXT PRIMARY KEY, value TEXT)")
+
+    embeddings = None
+    precursor_mzs = np.full(n_spectra, np.nan)
+    peak_offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+    mz_bin = os.path.join(output_dir, PEAK_MZ_FILE + '.bin')
+    intensities_bin = os.path.join(output_dir, PEAK_INTENSITIES_FILE + '.bin')
+
+    with open(mz_bin, 'wb') as mz_out, open(intensities_bin, 'wb') as intensities_out:
+        idx = -1
+        for idx, (spectrum_id, name, precursor_mz, embedding, mz, intensities) in enumerate(_iter_source_rows(conn, table)):
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(
+                    os.path.join(output_dir, EMBEDDINGS_FILE), mode='w+', dtype=np.float32,
+                    shape=(n_spectra, len(embedding))
+                )
+            embeddings[idx] = normalize_rows(embedding)[0]
+            if precursor_mz is not None:
+                precursor_mzs[idx] = precursor_mz
+            np.asarray(mz, dtype=np.float64).tofile(mz_out)
+            np.asarray(intensities, dtype=np.float64).tofile(intensities_out)
+            peak_offsets[idx + 1] = peak_offsets[idx] + len(mz)
+            meta.execute("INSERT INTO library_spectra VALUES (?, ?, ?, ?)", (idx, spectrum_id, name, precursor_mz))
+    conn.close()
+
+    if embeddings is None:
+        embeddings = np.lib.format.open_memmap(os.path.join(output_dir, EMBEDDINGS_FILE), mode='w+',
+                                               dtype=np.float32, shape=(0, 0))
+    embedding_dim = embeddings.shape[1]
+    embeddings.flush()
+    del embeddings
+    np.save(os.path.join(output_dir, PRECURSOR_MZ_FILE), precursor_mzs[:idx + 1])
+    np.save(os.path.join(output_dir, PEAK_OFFSETS_FILE), peak_offsets[:idx + 2])
+    _bin_to_npy(mz_bin, os.path.join(output_dir, PEAK_MZ_FILE), np.float64)
+    _bin_to_npy(intensities_bin, os.path.join(output_dir, PEAK_INTENSITIES_FILE), np.float64)
+
+    meta.executemany("INSERT INTO library_info VALUES (?, ?)", [
+        ('format_version', str(COLUMNAR_FORMAT_VERSION)),
+        ('source', os.path.abspath(db_path)),
+        ('source_table', table),
+        ('embedding_dim', str(embedding_dim)),
+    ])
+    # The peaks are copied as stored, so they keep the preprocessing of the source library
+    preprocessing = load_preprocessing_config(db_path)
+    if preprocessing is not None:
+        meta.execute("INSERT INTO library_info VALUES (?, ?)", (PREPROCESSING_METADATA_KEY, config_to_json(preprocessing)))
+    # The embeddings are copied as well, so queries must keep using the source library's embedder
+    embedder = read_library_metadata(db_path, EMBEDDER_METADATA_KEY)
+    if embedder is not None:
+        meta.execute("INSERT INTO library_info VALUES (?, ?)", (EMBEDDER_METADATA_KEY, embedder))
+        weights = load_embedder_weights(db_path)
+        if weights:
+            np.savez(os.path.join(output_dir, EMBEDDER_WEIGHTS_FILE), **weights)
+    meta.commit()
+    meta.close()
+    print(f"Imported {idx + 1} spectra ({peak_offsets[idx + 1]} peaks) into {output_dir}.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert an SQLite spectral library into the columnar format.')
+    parser.add_argument('db_path', help="Path to the SQLite library ('reference_spectra' or 'spectra' table).")
+    parser.add_argument('output_dir', help='Directory for the columnar library.')
+    parser.add_argument('--table', choices=['reference_spectra', 'spectra'], help='Source table (detected by default).')
+    parser.add_argument('--ann_index', action='store_true', help='Also build an approximate nearest neighbour index for the library.')
+    parser.add_argument('--pq', type=int, help='Product-quantize the ANN index with this many sub-vectors.')
+    args = parser.parse_args()
+    import_sqlite_library(args.db_path, args.output_dir, args.table)
+    if args.ann_index:
+        from ann_index import build_ann_index
+        build_ann_index(args.output_dir, pq_subquantizers=args.pq)
@@ -1,9 +1,17 @@
 import sqlite3
 import numpy as np
 import io
+import os
+import pickle
 from matchms.importing import load_from_mzml
 from matchms import Spectrum
 from matchms.similarity import CosineGreedy
+from precursor_index import PrecursorIndex
+from mzml_stream import iter_query_batches
+from result_cache import file_content_hash, library_version, make_key
+from instrumentation import stage, count, timed_iter
+from preprocessing import preprocess_spectra, load_preprocessing_config
+from embedders import EMBEDDING_SIZE, DEFAULT_EMBEDDER, normalize_rows, load_embedder
 
 def adapt_array(arr):
     out = io.BytesIO()
@@ -21,74 +29,372 @@ sqlite3.register_adapter(np.ndarray, adapt_array)
 # Converts TEXT to np.array when selecting
 sqlite3.register_converter("array", convert_array)
 
+# Upper bound on the size of one query-chunk x library score matrix in search_spectra
+SCORE_CHUNK_BYTES = 256 * 1024 * 1024
+
 def generate_embedding(spectrum):
+    """Embeds one spectrum with DEFAULT_EMBEDDER, the binned embedding of libraries that do not record one."""
+    return embed_spectra([spectrum])[0]
+
+def embed_spectra(spectra):
+    """
+    Embeds many spectra at once into an N x EMBEDDING_SIZE float32 matrix with
+    DEFAULT_EMBEDDER: peaks binned into 1 Da bins, rows scaled to unit length.
+    `spectra` is a list of spectra or a PeakStore.
+    """
+    return DEFAULT_EMBEDDER.embed(spectra)
+
+def detect_source_table(conn):
+    """Returns which supported library table exists in an SQLite database."""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table in ('reference_spectra', 'spectra'):
+        if table in tables:
+            return table
+    raise ValueError("No 'reference_spectra' or 'spectra' table found in the database.")
+
+def top_k_indices(scores, top_k):
+    """
+    Returns the indices of the `top_k` highest scores, best first.
+    Uses argpartition so only the selected candidates are fully sorted.
     """
-    Placeholder function to generate a spectral embedding.
-    In a real application, this would be a trained neural network.
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < len(scores):
+        candidates = np.argpartition(scores, -top_k)[-top_k:]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+def top_k_rows(scores, top_k):
+    """
+    Row-wise version of top_k_indices for a 2D score matrix.
+    Returns an array of shape (n_rows, top_k) of column indices, best first.
     """
-    # Simple embedding: bin the spectrum and use bin intensities
-    bins = np.arange(0, 1001, 1)
-    binned_intensities, _ = np.histogram(spectrum.peaks.mz, bins=bins, weights=spectrum.peaks.intensities)
-    # Normalize the vector to have a length of 1 (unit vector)
-    norm = np.linalg.norm(binned_intensities)
-    if norm == 0:
-        return np.zeros(len(bins) - 1, dtype=np.float32) # Return zero vector if spectrum is empty
-    embedding = binned_intensities / norm
-    return embedding.astype(np.float32)
+    top_k = min(top_k, scores.shape[1])
+    if top_k < scores.shape[1]:
+        candidates = np.argpartition(scores, -top_k, axis=1)[:, -top_k:]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
 
-def search_spectrum(query_spectrum, db_path='phytodiscover_core.db'):
+class SpectralLibrary:
+    """
+    Memory-resident search engine over a spectral library.
+
+    All library embeddings are loaded once into a contiguous, pre-normalized
+    float32 matrix with parallel name and precursor arrays, so scoring a query
+    is a single matrix-vector product instead of a Python loop over rows.
+
+    If an approximate nearest neighbour index is attached as `ann_index`, searches
+    without a precursor window only score the entries of the probed index cells.
+    `preprocessing` is the peak preprocessing config the library was built with
+    (None for raw peaks) and `embedder` the Embedder that produced its embeddings;
+    query spectra get the same treatment before they are scored.
+    """
+
+    def __init__(self, names, precursor_mzs, embeddings):
+        self.names = np.asarray(names, dtype=object)
+        self.precursor_mzs = np.asarray(
+            [np.nan if mz is None else mz for mz in precursor_mzs], dtype=np.float64
+        )
+        self.embeddings = normalize_rows(embeddings)
+        self.precursor_index = PrecursorIndex(self.precursor_mzs)
+        self.ann_index = None
+        self.preprocessing = None
+        self.embedder = DEFAULT_EMBEDDER
+
+    @classmethod
+    def from_arrays(cls, names, precursor_mzs, embeddings):
+        """
+        Wraps arrays that are already normalized without copying them,
+        e.g. an embedding matrix that lives in shared memory.
+        """
+        library = cls.__new__(cls)
+        library.names = names
+        library.precursor_mzs = precursor_mzs
+        library.embeddings = embeddings
+        library.precursor_index = PrecursorIndex(precursor_mzs)
+        library.ann_index = None
+        library.preprocessing = None
+        library.embedder = DEFAULT_EMBEDDER
+        return library
+
+    @classmethod
+    def from_sqlite(cls, db_path, table=None):
+        """
+        Loads every embedding of `table` from the SQLite library at `db_path`:
+        'spectra' (array embeddings) or 'reference_spectra' (pickled embeddings),
+        detected by default.
+        """
+        with stage('sqlite_fetch'):
+            conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+            if table is None:
+                table = detect_source_table(conn)
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT compound_name, precursor_mz, embedding FROM {table} ORDER BY id")
+            rows = cursor.fetchall()
+            conn.close()
+
+        if not rows:
+            return cls([], [], np.zeros((0, EMBEDDING_SIZE), dtype=np.float32))
+
+        names, precursor_mzs, embeddings = zip(*rows)
+        if table == 'reference_spectra':
+            embeddings = [pickle.loads(embedding) for embedding in embeddings]
+        return cls(names, precursor_mzs, np.vstack(embeddings))
+
+    def __len__(self):
+        return len(self.names)
+
+    def score(self, query_embedding):
+        """Returns the cosine similarity of `query_embedding` against every library entry."""
+        query = normalize_rows(query_embedding)[0]
+        return self.embeddings @ query
+
+    def search(self, query_embedding, top_k=1, precursor_mz=None, tolerance=None, unit='ppm', nprobe=None):
+        """
+        Returns the `top_k` best matching library entries for a single query embedding.
+        If `tolerance` is given, only entries whose precursor m/z lies within the
+        window around `precursor_mz` are scored. `nprobe` overrides the number of
+        cells scanned when an ANN index is attached.
+        """
+        ids, scores = self.search_ids(query_embedding, top_k, precursor_mz, tolerance, unit, nprobe)
+        return [self.match(idx, score) for idx, score in zip(ids, scores)]
+
+    def search_ids(self, query_embedding, top_k=1, precursor_mz=None, tolerance=None, unit='ppm', nprobe=None):
+        """Same as `search`, but returns the (ids, scores) arrays of the best entries instead of match dictionaries."""
+        if len(self) == 0 or not np.any(query_embedding):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if tolerance is None and self.ann_index is not None:
+            return self.ann_index.search(query_embedding, top_k, nprobe=nprobe, embeddings=self.embeddings)
+        if tolerance is None:
+            scores = self.score(query_embedding)
+            best = top_k_indices(scores, top_k)
+            return best, scores[best]
+
+        candidates = self.precursor_index.query(precursor_mz, tolerance, unit)
+        query = normalize_rows(query_embedding)[0]
+        scores = self.embeddings[candidates] @ query
+        best = top_k_indices(scores, top_k)
+        return candidates[best], scores[best]
+
+    def search_batch(self, query_embeddings, top_k=1, chunk_size=None,
+                     precursor_mzs=None, tolerance=None, unit='ppm', nprobe=None):
+        """
+        Returns the `top_k` best matches for every row of `query_embeddings`.
+        Queries are scored against the library with one matrix-matrix product
+        per chunk of `chunk_size` queries, which bounds the score matrix memory.
+        If `tolerance` is given, each query is only scored against the library
+        entries inside its precursor window (see `precursor_mzs`). With an ANN
+        index attached, every query is searched through the index instead.
+        """
+        return [
+            [self.match(idx, score) for idx, score in zip(ids, scores)]
+            for ids, scores in self.search_batch_ids(query_embeddings, top_k, chunk_size, precursor_mzs,
+                                                     tolerance, unit, nprobe)
+        ]
+
+    def search_batch_ids(self, query_embeddings, top_k=1, chunk_size=None,
+                         precursor_mzs=None, tolerance=None, unit='ppm', nprobe=None):
+        """Same as `search_batch`, but returns one (ids, scores) pair of arrays per query."""
+        queries = normalize_rows(query_embeddings)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+        results = [empty] * len(queries)
+        if len(self) == 0 or len(queries) == 0:
+            return results
+        has_signal = np.any(queries, axis=1)
+
+        if tolerance is not None:
+            precursor_mzs = np.array([np.nan if mz is None else mz for mz in precursor_mzs], dtype=np.float64)
+            starts, stops = self.precursor_index.bounds(precursor_mzs, tolerance, unit)
+            for i in np.flatnonzero(has_signal & ~np.isnan(precursor_mzs) & (stops > starts)):
+                candidates = self.precursor_index.order[starts[i]:stops[i]]
+                scores = self.embeddings[candidates] @ queries[i]
+                best = top_k_indices(scores, top_k)
+                results[i] = (candidates[best], scores[best])
+            return results
+
+        if self.ann_index is not None:
+            for i in np.flatnonzero(has_signal):
+                results[i] = self.search_ids(queries[i], top_k=top_k, nprobe=nprobe)
+            return results
+
+        if chunk_size is None:
+            chunk_size = max(1, SCORE_CHUNK_BYTES // (4 * len(self)))
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            scores = chunk @ self.embeddings.T
+            best = top_k_rows(scores, top_k)
+            for row, indices in enumerate(best):
+                if has_signal[start + row]:
+                    results[start + row] = (indices, scores[row, indices])
+        return results
+
+    def prepare_queries(self, query_spectra):
+        """Applies the library's peak preprocessing to `query_spectra`, if it has any."""
+        if self.preprocessing is None:
+            return query_spectra
+        with stage('preprocessing'):
+            return preprocess_spectra(query_spectra, self.preprocessing)
+
+    def embed_queries(self, query_spectra):
+        """Embeds already prepared `query_spectra` with the library's embedder."""
+        with stage('embedding'):
+            return self.embedder.embed(query_spectra)
+
+    def match(self, idx, score):
+        """Formats library entry `idx` as a match dictionary."""
+        mz = self.precursor_mzs[idx]
+        return {
+            "compound_name": self.names[idx],
+            "precursor_mz": None if np.isnan(mz) else float(mz),
+            "score": float(score)
+        }
+
+# Libraries already loaded by this process, keyed by database path
+_library_cache = {}
+
+def load_library(db_path='phytodiscover_core.db'):
+    """
+    Returns the in-memory SpectralLibrary for `db_path`, loading it only once per process.
+    `db_path` is either an SQLite library or a columnar library directory.
+    The library is reloaded if the database file has changed since it was cached.
+    An up-to-date ANN index saved alongside the library is attached automatically,
+    as are the preprocessing config and the embedder stored in the library metadata.
+    """
+    key = os.path.abspath(db_path)
+    mtime = os.path.getmtime(key) if os.path.exists(key) else None
+    cached = _library_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        with stage('library_load'):
+            if os.path.isdir(key):
+                # Imported here because columnar_library itself builds on this module
+                from columnar_library import ColumnarLibrary
+                library = ColumnarLibrary(key).to_spectral_library()
+            else:
+                library = SpectralLibrary.from_sqlite(db_path)
+            # Imported here because ann_index itself builds on this module
+            from ann_index import load_ann_index
+            library.ann_index = load_ann_index(key)
+            library.preprocessing = load_preprocessing_config(key)
+            library.embedder = load_embedder(key)
+            if len(library) and library.embeddings.shape[1] != library.embedder.dim:
+                raise ValueError(f"Library {db_path} holds {library.embeddings.shape[1]}-dimensional embeddings, but "
+                                 f"its '{library.embedder.name}' embedder makes {library.embedder.dim}-dimensional "
+                                 f"ones; rebuild it so the embedder is recorded.")
+        cached = (mtime, library)
+        _library_cache[key] = cached
+    return cached[1]
+
+def search_spectrum(query_spectrum, db_path='phytodiscover_core.db', top_k=1, library=None,
+                    precursor_tolerance=None, tolerance_unit='ppm'):
     """
     Searches for a single query spectrum against the library.
+    Returns up to `top_k` matches, best first. If `precursor_tolerance` is set,
+    only library entries within that precursor m/z window are scored.
     """
-    query_embedding = generate_embedding(query_spectrum)
-    
-    conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT compound_name, precursor_mz, embedding FROM spectra")
-    library_spectra = cursor.fetchall()
-    conn.close()
-    
-    if not library_spectra:
-        return []
-
-    best_match = None
-    highest_score = -1.0
-
-    for name, mz, lib_embedding in library_spectra:
-        # Calculate cosine similarity
-        # np.dot is faster for 1D arrays
-        score = np.dot(query_embedding, lib_embedding) / (np.linalg.norm(query_embedding) * np.linalg.norm(lib_embedding))
-
-        if score > highest_score:
-            highest_score = score
-            best_match = {
-                "compound_name": name,
-                "precursor_mz": mz,
-                "score": float(score)
-            }
-            
-    return [best_match] if best_match else []
+    if library is None:
+        library = load_library(db_path)
+    query_spectrum = library.prepare_queries([query_spectrum])[0]
+    query_embedding = library.embed_queries([query_spectrum])[0]
+    with stage('library_search'):
+        return library.search(query_embedding, top_k=top_k, precursor_mz=query_spectrum.get('precursor_mz'),
+                              tolerance=precursor_tolerance, unit=tolerance_unit)
+
+def search_spectra(queries, db_path='phytodiscover_core.db', top_k=1, chunk_size=None, library=None,
+                   precursor_tolerance=None, tolerance_unit='ppm'):
+    """
+    Searches many query spectra against the library at once.
+    Returns one list of up to `top_k` matches per query, in query order.
+    """
+    if library is None:
+        library = load_library(db_path)
+    precursor_mzs = [q.get('precursor_mz') for q in queries]
+    count('query_spectra', len(queries))
+    queries = library.prepare_queries(queries)
+    query_embeddings = library.embed_queries(queries)
+    with stage('library_search'):
+        return library.search_batch(query_embeddings, top_k=top_k, chunk_size=chunk_size,
+                                    precursor_mzs=precursor_mzs, tolerance=precursor_tolerance,
+                                    unit=tolerance_unit)
 
-def run_search(compound_name, mzml_file_path, db_path='phytodiscover_core.db'):
+def screen_run(mzml_file_path, library, threshold=0.85, batch_size=1000, precursor_tolerance=None,
+               tolerance_unit='ppm'):
+    """
+    Screens every MS2 spectrum of a run against `library`.
+    Spectra are streamed into compact PeakStore batches and searched; for each batch this yields
+    (number of spectra processed, hits) where hits are the report rows of the
+    queries whose best match scores at least `threshold`.
+    """
+    for batch in timed_iter(iter_query_batches(mzml_file_path, batch_size), 'mzml_parse'):
+        results = search_spectra(batch, library=library, top_k=1, precursor_tolerance=precursor_tolerance,
+                                 tolerance_unit=tolerance_unit)
+        hits = []
+        for query, matches in zip(batch, results):
+            if matches and matches[0]["score"] >= threshold:
+                match_mz = matches[0]["precursor_mz"]
+                hits.append({
+                    'query_id': query.get('id'),
+                    'query_mz': f"{query.get('precursor_mz'):.4f}",
+                    'match_compound_name': matches[0]["compound_name"],
+                    'match_mz': f"{match_mz:.4f}" if match_mz is not None else '',
+                    'similarity_score': f"{matches[0]['score']:.4f}"
+                })
+        count('hits', len(hits))
+        yield len(batch), hits
+
+def select_query_spectrum(mzml_file_path):
+    """Returns the spectrum of the run that is searched for a compound, or None if the run has no spectra."""
+    # In a real app, you'd find the spectrum that best matches the compound's expected mass.
+    # For this demo, we'll just use the most intense spectrum as the query.
+    # Spectra are streamed so only the current best candidate is kept in memory.
+    with stage('mzml_parse'):
+        return max(load_from_mzml(mzml_file_path), key=lambda s: s.get('precursor_mz') or 0, default=None)
+
+def run_search(compound_name, mzml_file_path, db_path='phytodiscover_core.db', top_k=1, library=None, cache=None):
     """
     Main function to run the search for a compound in an mzML file.
+    Pass an already loaded `library` to skip the database lookup entirely.
+    If a ResultCache is given as `cache`, results are keyed by the content hash
+    of the mzML file and the version of the library at `db_path` (also when
+    `library` is given), so repeated searches skip parsing and scoring.
     """
+    cache_key = None
+    if cache is not None:
+        # A missing or unreadable file is reported like a parse failure, with or without a cache
+        try:
+            mzml_hash = file_content_hash(mzml_file_path)
+        except Exception as e:
+            return {"error": f"Failed to load mzML file: {e}"}
+        cache_key = make_key(kind='run_search', mzml_hash=mzml_hash,
+                             library_version=library_version(db_path), method='embedding', top_k=top_k,
+                             tolerance=None, threshold=None)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            count('cached_searches')
+            return {
+                "query": {"compound_name": compound_name, "precursor_mz": cached["precursor_mz"]},
+                "matches": cached["matches"]
+            }
+
     try:
-        spectra = list(load_from_mzml(mzml_file_path))
+        query_spectrum = select_query_spectrum(mzml_file_path)
     except Exception as e:
         return {"error": f"Failed to load mzML file: {e}"}
 
-    if not spectra:
+    if query_spectrum is None:
         return {"error": "No spectra found in the provided mzML file."}
-        
-    # In a real app, you'd find the spectrum that best matches the compound's expected mass.
-    # For this demo, we'll just use the most intense spectrum as the query.
-    query_spectrum = sorted(spectra, key=lambda s: s.get('precursor_mz', 0), reverse=True)[0]
+
     query_spectrum.set("compound_name", compound_name)
 
-    results = search_spectrum(query_spectrum, db_path)
-    
+    results = search_spectrum(query_spectrum, db_path, top_k=top_k, library=library)
+
+    if cache_key is not None:
+        # The compound name does not affect the matches, so it is not part of the key
+        cache.put(cache_key, {"precursor_mz": query_spectrum.get("precursor_mz"), "matches": results})
+
     return {
         "query": {
             "compound_name": compound_name,
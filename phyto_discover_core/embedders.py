@@ -0,0 +1,262 @@
+import io
+import os
+import json
+import sqlite3
+import hashlib
+import numpy as np
+from abc import ABC, abstractmethod
+from functools import cached_property
+from peak_store import flatten_peaks
+from preprocessing import read_library_metadata
+
+# Number of 1 Da bins of the default binned embedding
+EMBEDDING_SIZE = 1000
+
+# Key of the embedder description in the library_metadata / library_info tables
+EMBEDDER_METADATA_KEY = 'embedder'
+
+# Weights of an SQLite library's embedder are stored in this table, one array per row
+EMBEDDER_WEIGHTS_TABLE = 'embedder_weights'
+
+# Weights of a columnar library's embedder, next to its embeddings
+EMBEDDER_WEIGHTS_FILE = 'embedder_weights.npz'
+
+# Spectra binned and encoded per matrix product by MLPEmbedder
+MLP_BATCH_SIZE = 1024
+
+def normalize_rows(matrix):
+    """
+    Returns a C-contiguous float32 copy of `matrix` with every row scaled to unit length.
+    All-zero rows are left as zeros so they score 0 against any query.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+def bin_peaks(mz, intensities, offsets, max_mz=1024):
+    """
+    Bins flat peak arrays (spectrum i owning mz[offsets[i]:offsets[i + 1]]) into an
+    N x max_mz float32 matrix with one bincount call, then scales every non-empty
+    row to a maximum of 1.
+    """
+    n_spectra = len(offsets) - 1
+    if len(mz) == 0:
+        return np.zeros((n_spectra, max_mz), dtype=np.float32)
+
+    rows = np.repeat(np.arange(n_spectra), np.diff(offsets))
+    keep = (mz >= 0) & (mz < max_mz)
+    flat = rows[keep] * max_mz + mz[keep].astype(np.int64)
+    binned = np.bincount(flat, weights=intensities[keep], minlength=n_spectra * max_mz).reshape(n_spectra, max_mz)
+
+    has_signal = binned.sum(axis=1) > 0
+    binned[has_signal] /= binned[has_signal].max(axis=1, keepdims=True)
+    return binned.astype(np.float32)
+
+# Embedder classes by name, filled by register_embedder
+EMBEDDERS = {}
+
+def register_embedder(cls):
+    """Class decorator that makes an Embedder available to make_embedder under its `name`."""
+    EMBEDDERS[cls.name] = cls
+    return cls
+
+class Embedder(ABC):
+    """
+    Turns peaks into fixed-size embedding vectors.
+
+    Subclasses set `name` and implement `params`, `dim` and embed_peaks. An
+    embedder is fully described by its name, its JSON-serializable `params` and
+    its `weights` ({name: array}), which is what save_embedder records in a library
+    so that queries are embedded exactly like the library spectra.
+    """
+
+    name = None
+    weights = {}
+
+    @classmethod
+    def from_config(cls, params, weights):
+        return cls(**params)
+
+    @property
+    @abstractmethod
+    def params(self):
+        """JSON-serializable settings that, with the weights, rebuild the embedder through from_config."""
+
+    @property
+    @abstractmethod
+    def dim(self):
+        """Length of the embedding vectors."""
+
+    @abstractmethod
+    def embed_peaks(self, mz, intensities, offsets):
+        """Embeds flat peak arrays (spectrum i owning mz[offsets[i]:offsets[i + 1]]) into an N x dim float32 matrix."""
+
+    def embed(self, spectra):
+        """Embeds a list of spectra or a PeakStore."""
+        return self.embed_peaks(*flatten_peaks(spectra))
+
+    @cached_property
+    def weights_sha256(self):
+        digest = hashlib.sha256()
+        for key in sorted(self.weights):
+            array = np.ascontiguousarray(self.weights[key])
+            digest.update(f'{key}:{array.dtype.str}:{array.shape}'.encode())
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def describe(self):
+        return {'name': self.name, 'params': self.params, 'weights_sha256': self.weights_sha256}
+
+@register_embedder
+class BinnedEmbedder(Embedder):
+    """
+    Sums peak intensities into `n_bins` 1 Da bins and scales every row to unit length.
+    It has no weights. Libraries that do not record an embedder were built with it.
+    """
+
+    name = 'binned'
+
+    def __init__(self, n_bins=EMBEDDING_SIZE):
+        self.n_bins = n_bins
+
+    @property
+    def params(self):
+        return {'n_bins': self.n_bins}
+
+    @property
+    def dim(self):
+        return self.n_bins
+
+    def embed_peaks(self, mz, intensities, offsets):
+        n_spectra = len(offsets) - 1
+        if n_spectra == 0:
+            return np.zeros((0, self.n_bins), dtype=np.float32)
+        rows = np.repeat(np.arange(n_spectra), np.diff(offsets))
+
+        # Same binning as np.histogram over [0, 1, ..., n_bins]: the last bin is closed
+        keep = (mz >= 0) & (mz <= self.n_bins)
+        bins = np.minimum(np.floor(mz[keep]).astype(np.int64), self.n_bins - 1)
+        binned = np.bincount(rows[keep] * self.n_bins + bins, weights=intensities[keep],
+                             minlength=n_spectra * self.n_bins)
+        return normalize_rows(binned.reshape(n_spectra, self.n_bins))
+
+@register_embedder
+class MLPEmbedder(Embedder):
+    """
+    Multilayer perceptron over max-scaled 1 Da bins, with a ReLU between layers.
+
+    `weights` holds the 'fc1.weight', 'fc1.bias', 'fc2.weight', ... arrays of the
+    layers in torch state_dict layout (weights are out x in), so a trained torch
+    model is used as is. Inference is plain NumPy: every batch of MLP_BATCH_SIZE
+    spectra is binned and pushed through the layers with one matrix product each.
+    """
+
+    name = 'mlp'
+
+    def __init__(self, weights, batch_size=MLP_BATCH_SIZE):
+        self.weights = {key: np.ascontiguousarray(value, dtype=np.float32) for key, value in weights.items()}
+        self.layers = []
+        while f'fc{len(self.layers) + 1}.weight' in self.weights:
+            prefix = f'fc{len(self.layers) + 1}'
+            # Transposed once here so every batch is a plain x @ weight product
+            self.layers.append((np.ascontiguousarray(self.weights[f'{prefix}.weight'].T),
+                                self.weights[f'{prefix}.bias']))
+        if not self.layers or len(self.layers) * 2 != len(self.weights):
+            raise ValueError(f"Expected MLP weights fc1.weight, fc1.bias, ..., got {sorted(self.weights)}.")
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_config(cls, params, weights):
+        embedder = cls(weights)
+        if params != embedder.params:
+            raise ValueError(f"MLP weights have layers {embedder.params}, expected {params}.")
+        return embedder
+
+    @property
+    def params(self):
+        return {'input_size': self.layers[0][0].shape[0], 'layer_sizes': [weight.shape[1] for weight, _ in self.layers]}
+
+    @property
+    def dim(self):
+        return self.layers[-1][0].shape[1]
+
+    def embed_peaks(self, mz, intensities, offsets):
+        n_spectra = len(offsets) - 1
+        embeddings = np.zeros((n_spectra, self.dim), dtype=np.float32)
+        input_size = self.layers[0][0].shape[0]
+        for start in range(0, n_spectra, self.batch_size):
+            stop = min(start + self.batch_size, n_spectra)
+            first, last = offsets[start], offsets[stop]
+            x = bin_peaks(mz[first:last], intensities[first:last], offsets[start:stop + 1] - first, input_size)
+            for i, (weight, bias) in enumerate(self.layers):
+                x = x @ weight + bias
+                if i < len(self.layers) - 1:
+                    np.maximum(x, 0, out=x)
+            embeddings[start:stop] = x
+        return embeddings
+
+# Embedding of libraries that do not record an embedder
+DEFAULT_EMBEDDER = BinnedEmbedder()
+
+def make_embedder(name, params=None, weights=None):
+    """Returns the registered embedder `name` built from its `params` and `weights`."""
+    if name not in EMBEDDERS:
+        raise ValueError(f"Unknown embedder '{name}', expected one of {sorted(EMBEDDERS)}.")
+    return EMBEDDERS[name].from_config(params or {}, weights or {})
+
+def embedder_to_json(embedder):
+    """Serializes an embedder's description (not its weights) for the library metadata."""
+    return json.dumps(embedder.describe(), sort_keys=True)
+
+def embedder_from_json(text, weights):
+    """Rebuilds an embedder from embedder_to_json output and its weights, checking that they belong together."""
+    description = json.loads(text)
+    embedder = make_embedder(description['name'], description['params'], weights)
+    if embedder.weights_sha256 != description['weights_sha256']:
+        raise ValueError(f"Stored weights of the '{embedder.name}' embedder do not match the library metadata.")
+    return embedder
+
+def save_embedder(conn, embedder):
+    """Records `embedder` in an open SQLite library: its description in library_metadata, its weights in their own table."""
+    conn.execute("CREATE TABLE IF NOT EXISTS library_metadata (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {EMBEDDER_WEIGHTS_TABLE} (name TEXT PRIMARY KEY, value BLOB)")
+    conn.execute(f"DELETE FROM {EMBEDDER_WEIGHTS_TABLE}")
+    rows = []
+    for key, array in embedder.weights.items():
+        out = io.BytesIO()
+        np.save(out, array)
+        rows.append((key, out.getvalue()))
+    conn.executemany(f"INSERT INTO {EMBEDDER_WEIGHTS_TABLE} (name, value) VALUES (?, ?)", rows)
+    conn.execute("INSERT OR REPLACE INTO library_metadata (key, value) VALUES (?, ?)",
+                 (EMBEDDER_METADATA_KEY, embedder_to_json(embedder)))
+
+def load_embedder_weights(db_path):
+    """Returns the stored embedder weights of an SQLite or columnar library ({} if it has none)."""
+    if os.path.isdir(db_path):
+        path = os.path.join(db_path, EMBEDDER_WEIGHTS_FILE)
+        if not os.path.exists(path):
+            return {}
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+    conn = sqlite3.connect(db_path)
+    try:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if EMBEDDER_WEIGHTS_TABLE not in tables:
+            return {}
+        return {key: np.load(io.BytesIO(value))
+                for key, value in conn.execute(f"SELECT name, value FROM {EMBEDDER_WEIGHTS_TABLE}")}
+    finally:
+        conn.close()
+
+def load_embedder(db_path):
+    """
+    Returns the embedder a library was built with. `db_path` is an SQLite library or a
+    columnar library directory; libraries that do not record one use DEFAULT_EMBEDDER.
+    """
+    text = read_library_metadata(db_path, EMBEDDER_METADATA_KEY)
+    if text is None:
+        return DEFAULT_EMBEDDER
+    return embedder_from_json(text, load_embedder_weights(db_path))
@@ -0,0 +1,132 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from core_search import load_library, select_query_spectrum
+from columnar_library import EMBEDDINGS_FILE
+from preprocessing import config_to_json
+from embedders import embedder_to_json
+from result_cache import file_content_hash, library_version, make_key
+from instrumentation import stage, count
+
+# Upper bound on the number of libraries searched at the same time
+DEFAULT_MAX_WORKERS = os.cpu_count() or 4
+
+# File extensions recognised as SQLite libraries by find_libraries
+LIBRARY_SUFFIXES = ('.db', '.sqlite')
+
+def find_libraries(directory):
+    """
+    Returns {name: path} for every library in `directory`, named after the file:
+    SQLite files and columnar library directories. A missing directory has none.
+    """
+    if not os.path.isdir(directory):
+        return {}
+    libraries = {}
+    for entry in sorted(os.listdir(directory)):
+        path = os.path.join(directory, entry)
+        name, extension = os.path.splitext(entry)
+        if os.path.isdir(path) and os.path.exists(os.path.join(path, EMBEDDINGS_FILE)):
+            libraries[entry] = path
+        elif os.path.isfile(path) and extension in LIBRARY_SUFFIXES:
+            libraries[name] = path
+    return libraries
+
+def federated_search(query_spectra, libraries, top_k=1, precursor_tolerance=None, tolerance_unit='ppm',
+                     max_workers=None):
+    """
+    Searches every query against several SpectralLibrary objects, given as {name: library}.
+
+    The queries are preprocessed and embedded once per distinct preprocessing
+    config and embedder of the libraries (so once in total when they share both), then the
+    libraries are searched concurrently on threads; NumPy releases the GIL while
+    scoring. Returns (results, errors): one list of up to `top_k` matches per query,
+    best first across all libraries, each carrying the name of its `library`, and
+    {name: message} for libraries whose search failed.
+    """
+    results = [[] for _ in range(len(query_spectra))]
+    errors = {}
+    if not libraries or len(query_spectra) == 0:
+        return results, errors
+
+    precursor_mzs = [q.get('precursor_mz') for q in query_spectra]
+    count('query_spectra', len(query_spectra))
+    def embedding_key(library):
+        return config_to_json(library.preprocessing), embedder_to_json(library.embedder)
+
+    embeddings = {}
+    for library in libraries.values():
+        key = embedding_key(library)
+        if key not in embeddings:
+            embeddings[key] = library.embed_queries(library.prepare_queries(query_spectra))
+
+    def search_library(library):
+        with stage('library_search'):
+            return library.search_batch(embeddings[embedding_key(library)], top_k=top_k,
+                                        precursor_mzs=precursor_mzs, tolerance=precursor_tolerance,
+                                        unit=tolerance_unit)
+
+    with ThreadPoolExecutor(max_workers=min(len(libraries), max_workers or DEFAULT_MAX_WORKERS)) as pool:
+        futures = {name: pool.submit(search_library, library) for name, library in libraries.items()}
+        # Collected in the order of `libraries`, so equal scores keep that order after the stable sort
+        for name, future in futures.items():
+            try:
+                per_query = future.result()
+            except Exception as e:
+                errors[name] = str(e)
+                continue
+            for merged, matches in zip(results, per_query):
+                merged.extend(dict(match, library=name) for match in matches)
+
+    return [sorted(merged, key=lambda match: -match["score"])[:top_k] for merged in results], errors
+
+def run_federated_search(compound_name, mzml_file_path, db_paths, top_k=1, cache=None, max_workers=None):
+    """
+    Federated version of core_search.run_search: the query spectrum is parsed and
+    embedded once and searched against every library of `db_paths` ({name: path}).
+    Libraries that cannot be loaded or searched are reported under "errors"
+    instead of failing the whole search. With a ResultCache, complete results are
+    keyed by the mzML content hash and the version of every library.
+    """
+    cache_key = None
+    if cache is not None:
+        # A missing or unreadable file is reported like a parse failure, with or without a cache
+        try:
+            mzml_hash = file_content_hash(mzml_file_path)
+        except Exception as e:
+            return {"error": f"Failed to load mzML file: {e}"}
+        cache_key = make_key(kind='federated_search', mzml_hash=mzml_hash,
+                             library_versions={name: library_version(path) for name, path in db_paths.items()},
+                             top_k=top_k)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            count('cached_searches')
+            return {
+                "query": {"compound_name": compound_name, "precursor_mz": cached["precursor_mz"]},
+                "matches": cached["matches"],
+                "errors": {}
+            }
+
+    try:
+        query_spectrum = select_query_spectrum(mzml_file_path)
+    except Exception as e:
+        return {"error": f"Failed to load mzML file: {e}"}
+    if query_spectrum is None:
+        return {"error": "No spectra found in the provided mzML file."}
+
+    libraries, errors = {}, {}
+    for name, path in db_paths.items():
+        try:
+            libraries[name] = load_library(path)
+        except Exception as e:
+            errors[name] = f"Could not load library: {e}"
+
+    results, search_errors = federated_search([query_spectrum], libraries, top_k=top_k, max_workers=max_workers)
+    errors.update(search_errors)
+
+    if cache_key is not None and not errors:
+        cache.put(cache_key, {"precursor_mz": query_spectrum.get("precursor_mz"), "matches": results[0]})
+
+    return {
+        "query": {"compound_name": compound_name, "precursor_mz": query_spectrum.get("precursor_mz")},
+        "matches": results[0],
+        "errors": errors
+    }
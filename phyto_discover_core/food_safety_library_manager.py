@@ -1,9 +1,17 @@
 import sqlite3
+import time
+import hashlib
+import argparse
 import torch
 import torch.nn as nn
-from matchms.importing import load_from_mgf
+from matchms import Spectrum
 import numpy as np
 import pickle
+from precursor_index import create_precursor_index
+from embedders import MLPEmbedder, BinnedEmbedder, EMBEDDER_METADATA_KEY, save_embedder, embedder_to_json
+from spectrum_parsers import iter_records, MGF
+from preprocessing import (DEFAULT_PREPROCESSING, PREPROCESSING_METADATA_KEY, preprocess_peaks, make_config,
+                           config_to_json, config_from_json)
 
 # --- 1. Define the Neural Network for Embeddings ---
 class SpectrumEncoder(nn.Module):
@@ -21,80 +29,266 @@ class SpectrumEncoder(nn.Module):
         x = self.fc3(x)
         return x
 
-# --- 2. Function to Preprocess and Generate Embeddings ---
-def get_embedding(spectrum, model, max_mz=1024):
-    if spectrum is None or spectrum.peaks.mz is None or len(spectrum.peaks.mz) == 0:
-        return None
+# --- 2. Functions to Preprocess and Generate Embeddings ---
 
-    binned_spectrum = np.zeros(max_mz)
-    for mz, intensity in zip(spectrum.peaks.mz, spectrum.peaks.intensities):
-        if 0 <= mz < max_mz:
-            binned_spectrum[int(mz)] += intensity
+# Number of spectra preprocessed, embedded and written per batch
+EMBEDDING_BATCH_SIZE = 1024
 
-    if np.sum(binned_spectrum) > 0:
-        binned_spectrum = binned_spectrum / np.max(binned_spectrum)
-
-    spectrum_tensor = torch.FloatTensor(binned_spectrum).unsqueeze(0)
-    with torch.no_grad():
-        embedding = model(spectrum_tensor)
-    return embedding.squeeze().numpy()
-
-# --- 3. Main Function to Build the Library ---
-def build_food_safety_library(mgf_file, db_file):
-    print(f'Building food safety library from {mgf_file} into {db_file}...')
+def get_embeddings(spectra, embedder):
+    """Embeds a list of non-empty spectra with an Embedder (see create_encoder)."""
+    return embedder.embed(spectra)
 
+def create_encoder(weights_file=None):
+    """
+    Returns the MLPEmbedder that embeds the library. Its weights are loaded from
+    `weights_file` (an .npz of SpectrumEncoder state_dict arrays, e.g. a trained
+    model), or are the seeded initial weights of SpectrumEncoder. torch is only
+    used to create those; inference and searches run on the NumPy embedder.
+    """
+    if weights_file is not None:
+        with np.load(weights_file) as data:
+            return MLPEmbedder({key: data[key] for key in data.files})
     torch.manual_seed(42)
     model = SpectrumEncoder()
-    model.eval()
-
-    spectrums = list(load_from_mgf(mgf_file))
-    print(f'Loaded {len(spectrums)} spectra from MGF file.')
+    return MLPEmbedder({key: value.numpy() for key, value in model.state_dict().items()})
 
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
+# --- 3. Library Schema and Record Helpers ---
 
-    cursor.execute('''
+def ensure_library_schema(conn):
+    """Creates the reference_spectra and library_metadata tables and upgrades older libraries in place."""
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS reference_spectra (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             spectrum_id TEXT,
             compound_name TEXT,
             precursor_mz REAL,
             serialized_spectrum BLOB,
-            embedding BLOB
+            embedding BLOB,
+            content_hash TEXT
         )
     ''')
-    print("Database table 'reference_spectra' created or already exists.")
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(reference_spectra)")}
+    if 'content_hash' not in columns:
+        conn.execute("ALTER TABLE reference_spectra ADD COLUMN content_hash TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reference_spectra_spectrum_id ON reference_spectra (spectrum_id)")
+    conn.execute("CREATE TABLE IF NOT EXISTS library_metadata (key TEXT PRIMARY KEY, value TEXT)")
 
-    for i, spectrum in enumerate(spectrums):
-        if spectrum is None:
-            continue
+def set_library_metadata(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO library_metadata (key, value) VALUES (?, ?)", (key, str(value)))
+
+def get_library_metadata(conn, key, default=None):
+    row = conn.execute("SELECT value FROM library_metadata WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_preprocessing_metadata(conn, preprocessing):
+    if preprocessing is None:
+        conn.execute("DELETE FROM library_metadata WHERE key = ?", (PREPROCESSING_METADATA_KEY,))
+    else:
+        set_library_metadata(conn, PREPROCESSING_METADATA_KEY, config_to_json(preprocessing))
 
-        spectrum_id = spectrum.get('spectrumid', f'spectrum_{i}')
-        compound_name = spectrum.get('name', 'Unknown') # .mgf files often use 'name' instead of 'compound_name'
-        precursor_mz = spectrum.get('pepmass')[0] if spectrum.get('pepmass') else 0.0
+def get_spectrum_id(spectrum, i):
+    # spectrum_parsers renames the MGF SPECTRUMID key to 'spectrum_id', as matchms does; older files may keep 'spectrumid'
+    return spectrum.get('spectrum_id') or spectrum.get('spectrumid') or f'spectrum_{i}'
 
-        embedding = get_embedding(spectrum, model)
-        if embedding is None:
+def peaks_content_hash(metadata, mz, intensities):
+    """Hashes everything stored for a spectrum: its name, precursor m/z and peaks."""
+    digest = hashlib.sha256()
+    digest.update(str(get_compound_name(metadata)).encode())
+    digest.update(np.float64(get_precursor_mz(metadata)).tobytes())
+    digest.update(np.ascontiguousarray(mz, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(intensities, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+def get_compound_name(spectrum):
+    # .mgf files often use 'name' instead of 'compound_name'
+    return spectrum.get('compound_name') or spectrum.get('name') or 'Unknown'
+
+def get_precursor_mz(spectrum):
+    return spectrum.get('precursor_mz') or (spectrum.get('pepmass')[0] if spectrum.get('pepmass') else 0.0)
+
+def load_library_entries(mgf_file, workers=None):
+    """
+    Returns (spectrum_id, metadata, mz, intensities) for every usable spectrum of
+    the MGF file, parsed in chunks on `workers` processes (see spectrum_parsers).
+    """
+    entries = []
+    n_spectra = 0
+    for i, (mz, intensities, metadata) in enumerate(iter_records(mgf_file, MGF, workers)):
+        n_spectra += 1
+        spectrum_id = get_spectrum_id(metadata, i)
+        if len(mz) == 0:
             print(f'Skipping spectrum {spectrum_id} due to missing data.')
             continue
+        entries.append((spectrum_id, metadata, mz, intensities))
+    print(f'Loaded {n_spectra} spectra from MGF file.')
+    return entries
+
+def iter_embedded_rows(entries, embedder, batch_size, preprocessing=DEFAULT_PREPROCESSING):
+    """
+    Preprocesses and embeds `entries` (from load_library_entries) in batches and yields lists of
+    (spectrum_id, compound_name, precursor_mz, serialized_spectrum, embedding, content_hash) rows.
+    Each batch is preprocessed and binned as flat peak arrays; only the stored
+    spectra are built as matchms objects. The stored spectrum holds the preprocessed
+    peaks, while the content hash is taken over the source peaks so incremental
+    updates can compare it with the MGF file.
+    """
+    start_time = time.perf_counter()
+    for start in range(0, len(entries), batch_size):
+        batch = entries[start:start + batch_size]
+        offsets = np.zeros(len(batch) + 1, dtype=np.int64)
+        np.cumsum([len(mz) for _, _, mz, _ in batch], out=offsets[1:])
+        mz = np.concatenate([mz for _, _, mz, _ in batch])
+        intensities = np.concatenate([intensities for _, _, _, intensities in batch])
+        if preprocessing is not None:
+            mz, intensities, offsets = preprocess_peaks(
+                mz, intensities, offsets, [metadata.get('precursor_mz') for _, metadata, _, _ in batch], preprocessing)
+        embeddings = embedder.embed_peaks(mz, intensities, offsets)
+
+        rows = []
+        for i, (spectrum_id, metadata, source_mz, source_intensities) in enumerate(batch):
+            peaks = slice(offsets[i], offsets[i + 1])
+            spectrum = Spectrum(mz=mz[peaks].copy(), intensities=intensities[peaks].copy(), metadata=metadata)
+            rows.append((spectrum_id, get_compound_name(metadata), get_precursor_mz(metadata),
+                         pickle.dumps(spectrum), pickle.dumps(embeddings[i]),
+                         peaks_content_hash(metadata, source_mz, source_intensities)))
+        yield rows
+
+        done = start + len(batch)
+        elapsed = time.perf_counter() - start_time
+        print(f'Embedded {done}/{len(entries)} spectra ({done / elapsed:.0f} spectra/s)...')
+
+# --- 4. Main Functions to Build or Update the Library ---
+def build_food_safety_library(mgf_file, db_file, batch_size=EMBEDDING_BATCH_SIZE, preprocessing=DEFAULT_PREPROCESSING,
+                              workers=None, embedder=None):
+    """
+    Builds the library from `mgf_file`, replacing any spectra already in `db_file`. Peaks are filtered with the `preprocessing`
+    config (None keeps the raw peaks) and embedded with `embedder` (create_encoder()
+    by default). Both are stored in the library metadata, the embedder with its
+    weights, so searches treat and embed their query spectra the same way.
+    """
+    print(f'Building food safety library from {mgf_file} into {db_file}...')
 
-        serialized_spectrum = pickle.dumps(spectrum)
-        serialized_embedding = pickle.dumps(embedding)
+    embedder = embedder or create_encoder()
+    entries = load_library_entries(mgf_file, workers)
 
-        cursor.execute('''
-            INSERT INTO reference_spectra (spectrum_id, compound_name, precursor_mz, serialized_spectrum, embedding)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (spectrum_id, compound_name, precursor_mz, serialized_spectrum, serialized_embedding))
+    conn = sqlite3.connect(db_file)
+    ensure_library_schema(conn)
+    # A full build replaces the library, so rows of an earlier build are dropped in the same
+    # transaction; use update_food_safety_library to keep them and only sync the changes
+    replaced = conn.execute("DELETE FROM reference_spectra").rowcount
+    if replaced:
+        print(f'Replacing the {replaced} spectra of the existing library.')
+
+    # All rows are inserted in a single transaction, committed at the end
+    for rows in iter_embedded_rows(entries, embedder, batch_size, preprocessing):
+        conn.executemany('''
+            INSERT INTO reference_spectra (spectrum_id, compound_name, precursor_mz, serialized_spectrum, embedding, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+    save_embedder(conn, embedder)
+    set_preprocessing_metadata(conn, preprocessing)
+    conn.commit()
+    conn.close()
+    create_precursor_index(db_file, 'reference_spectra')
+    print(f'Successfully built food safety library with {len(entries)} entries.')
+
+def update_food_safety_library(mgf_file, db_file, batch_size=EMBEDDING_BATCH_SIZE, preprocessing=DEFAULT_PREPROCESSING,
+                               workers=None, embedder=None):
+    """
+    Incrementally syncs the library with `mgf_file`, keyed by SPECTRUMID.
+
+    Only spectra that are new or whose content hash changed are embedded and
+    written, spectra no longer in the file are deleted, and duplicate rows left
+    by earlier full builds are removed. If the stored embedder (including its
+    weights) or preprocessing config differs from the current one, every spectrum
+    is recomputed.
+    """
+    print(f'Updating food safety library {db_file} from {mgf_file}...')
+
+    entries = load_library_entries(mgf_file, workers)
+    conn = sqlite3.connect(db_file)
+    ensure_library_schema(conn)
+
+    embedder = embedder or create_encoder()
+    # Libraries built before embedders were recorded have no description and are recomputed
+    encoder_changed = get_library_metadata(conn, EMBEDDER_METADATA_KEY) != embedder_to_json(embedder)
+    if encoder_changed:
+        print(f"Embedder changed (now '{embedder.name}' {embedder.params}), recomputing all embeddings.")
+    # Libraries built before preprocessing existed hold raw peaks, like preprocessing=None
+    stored_preprocessing = config_from_json(get_library_metadata(conn, PREPROCESSING_METADATA_KEY))
+    if stored_preprocessing != preprocessing:
+        print('Preprocessing config changed, recomputing all spectra.')
+        encoder_changed = True
+
+    existing = {}
+    duplicates = []
+    for row_id, spectrum_id, content_hash in conn.execute(
+            "SELECT id, spectrum_id, content_hash FROM reference_spectra ORDER BY id"):
+        if spectrum_id in existing:
+            duplicates.append((row_id,))
+        else:
+            existing[spectrum_id] = content_hash
+
+    incoming = {}
+    for entry in entries:
+        if entry[0] in incoming:
+            print(f'Skipping duplicate spectrum {entry[0]}.')
+            continue
+        incoming[entry[0]] = entry
+
+    added, changed = [], []
+    for spectrum_id, entry in incoming.items():
+        if spectrum_id not in existing:
+            added.append(entry)
+        elif encoder_changed or existing[spectrum_id] != peaks_content_hash(*entry[1:]):
+            changed.append(entry)
+    removed = [(spectrum_id,) for spectrum_id in existing if spectrum_id not in incoming]
 
-        if (i + 1) % 20 == 0:
-            print(f'Processed {i + 1}/{len(spectrums)} spectra...')
+    # All changes are applied in a single transaction, committed at the end
+    conn.executemany("DELETE FROM reference_spectra WHERE id = ?", duplicates)
+    conn.executemany("DELETE FROM reference_spectra WHERE spectrum_id = ?", removed)
+    for rows in iter_embedded_rows(added, embedder, batch_size, preprocessing) if added else []:
+        conn.executemany('''
+            INSERT INTO reference_spectra (spectrum_id, compound_name, precursor_mz, serialized_spectrum, embedding, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+    for rows in iter_embedded_rows(changed, embedder, batch_size, preprocessing) if changed else []:
+        conn.executemany('''
+            UPDATE reference_spectra
+            SET compound_name = ?, precursor_mz = ?, serialized_spectrum = ?, embedding = ?, content_hash = ?
+            WHERE spectrum_id = ?
+        ''', [row[1:] + row[:1] for row in rows])
 
+    save_embedder(conn, embedder)
+    set_preprocessing_metadata(conn, preprocessing)
     conn.commit()
     conn.close()
-    print(f'Successfully built food safety library with {len(spectrums)} entries.')
+    create_precursor_index(db_file, 'reference_spectra')
 
-# --- 4. Execute the Build Process ---
+    unchanged = len(incoming) - len(added) - len(changed)
+    print(f'Library updated: {len(added)} added, {len(changed)} updated, {len(removed)} deleted, '
+          f'{len(duplicates)} duplicates removed, {unchanged} unchanged.')
+
+# --- 5. Execute the Build Process ---
 if __name__ == '__main__':
-    MGF_FILE_PATH = 'data/pesticides.mgf'
-    DB_FILE_PATH = 'data/food_safety.db'
-    build_food_safety_library(MGF_FILE_PATH, DB_FILE_PATH)
+    parser = argparse.ArgumentParser(description='Build or update the food safety spectral library.')
+    parser.add_argument('--mgf_file', default='data/pesticides.mgf', help='Path to the source MGF file.')
+    parser.add_argument('--db_file', default='data/food_safety.db', help='Path to the SQLite library.')
+    parser.add_argument('--incremental', action='store_true', help='Only embed and write spectra that were added, changed or removed.')
+    parser.add_argument('--no_preprocessing', action='store_true', help='Store the raw peaks instead of filtering them.')
+    parser.add_argument('--top_n', type=int, default=DEFAULT_PREPROCESSING['top_n'], help='Peaks kept per 50 Da window.')
+    parser.add_argument('--noise_floor', type=float, default=DEFAULT_PREPROCESSING['noise_floor'], help='Minimum peak intensity relative to the base peak.')
+    parser.add_argument('--workers', type=int, default=None, help='Processes parsing the MGF file (default: one per CPU core).')
+    parser.add_argument('--embedder', choices=['mlp', 'binned'], default='mlp', help='Embedding stored for every spectrum.')
+    parser.add_argument('--weights', help='.npz file of SpectrumEncoder state_dict arrays for the mlp embedder (default: seeded initial weights).')
+    args = parser.parse_args()
+
+    preprocessing = None if args.no_preprocessing else make_config(top_n=args.top_n, noise_floor=args.noise_floor)
+    embedder = BinnedEmbedder() if args.embedder == 'binned' else create_encoder(args.weights)
+    if args.incremental:
+        update_food_safety_library(args.mgf_file, args.db_file, preprocessing=preprocessing, workers=args.workers,
+                                   embedder=embedder)
+    else:
+        build_food_safety_library(args.mgf_file, args.db_file, preprocessing=preprocessing, workers=args.workers,
+                                  embedder=embedder)
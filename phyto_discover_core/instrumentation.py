@@ -0,0 +1,149 @@
+import io
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# Prefix of every metric exported in Prometheus text format
+METRIC_PREFIX = 'phytodiscover'
+
+class Metrics:
+    """
+    Process-wide per-stage timers and counters.
+
+    A stage records how often it ran, its total and its longest duration.
+    Stages may nest (e.g. 'sqlite_fetch' inside 'library_load'), so their
+    totals are inclusive. Updates take a lock and are safe from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._hooks = []
+
+    def record(self, name, seconds):
+        with self._lock:
+            calls, total, longest = self._stages.get(name, (0, 0.0, 0.0))
+            self._stages[name] = (calls + 1, total + seconds, max(longest, seconds))
+            hooks = list(self._hooks)
+        for hook in hooks:
+            hook(name, seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def add_hook(self, hook):
+        """Registers `hook(stage_name, seconds)`, called after every stage, e.g. to forward timings to a tracer."""
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        """Returns {'stages': {name: {calls, total_s, max_s}}, 'counters': {name: value}}."""
+        with self._lock:
+            return {
+                'stages': {name: {'calls': calls, 'total_s': total, 'max_s': longest}
+                           for name, (calls, total, longest) in self._stages.items()},
+                'counters': dict(self._counters),
+            }
+
+# The metrics shared by all modules of this process
+metrics = Metrics()
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block as pipeline stage `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record(name, time.perf_counter() - start)
+
+def count(name, n=1):
+    """Adds `n` to counter `name`, e.g. the number of spectra processed."""
+    metrics.count(name, n)
+
+def timed_iter(iterable, name):
+    """Yields from `iterable`, timing the production of every item as stage `name` (e.g. lazy mzML parsing)."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        # Only items that were produced count as calls, not the final exhausted next()
+        metrics.record(name, time.perf_counter() - start)
+        yield item
+
+def format_breakdown(snapshot=None):
+    """Formats the stage timings and counters as a table, slowest stage first."""
+    if snapshot is None:
+        snapshot = metrics.snapshot()
+    stages = sorted(snapshot['stages'].items(), key=lambda item: item[1]['total_s'], reverse=True)
+    lines = [f"{'Stage':<24}{'Calls':>10}{'Total (s)':>12}{'Mean (ms)':>12}{'Max (ms)':>12}"]
+    for name, s in stages:
+        lines.append(f"{name:<24}{s['calls']:>10}{s['total_s']:>12.3f}"
+                     f"{s['total_s'] / s['calls'] * 1000:>12.2f}{s['max_s'] * 1000:>12.2f}")
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append(f"{name:<24}{value:>10}")
+    return '\n'.join(lines)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_text(snapshot=None, gauges=None):
+    """
+    Renders the metrics in the Prometheus text exposition format.
+    `gauges` optionally adds {name: (help, value)} entries, e.g. cache statistics.
+    """
+    if snapshot is None:
+        snapshot = metrics.snapshot()
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+        lines.extend(f"{METRIC_PREFIX}_{name}{labels} {value}" for labels, value in samples)
+
+    stages = sorted(snapshot['stages'].items())
+    family('stage_seconds_total', 'counter', 'Total time spent in each pipeline stage.',
+           [(f'{{stage="{_escape(n)}"}}', s['total_s']) for n, s in stages])
+    family('stage_calls_total', 'counter', 'Number of times each pipeline stage ran.',
+           [(f'{{stage="{_escape(n)}"}}', s['calls']) for n, s in stages])
+    family('stage_seconds_max', 'gauge', 'Longest single run of each pipeline stage.',
+           [(f'{{stage="{_escape(n)}"}}', s['max_s']) for n, s in stages])
+    family('items_total', 'counter', 'Items processed by the pipeline, e.g. spectra and hits.',
+           [(f'{{name="{_escape(n)}"}}', v) for n, v in sorted(snapshot['counters'].items())])
+    for name, (help_text, value) in sorted((gauges or {}).items()):
+        family(name, 'gauge', help_text, [('', value)])
+    return '\n'.join(lines) + '\n'
+
+def start_profiler():
+    """Starts and returns a cProfile profiler; pass it to print_profile when done."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def print_profile(profiler, limit=25, sort='cumulative', output=None):
+    """
+    Stops `profiler` and prints the `limit` most expensive functions. With `output`,
+    the raw stats are also saved there for tools such as snakeviz.
+    """
+    profiler.disable()
+    if output:
+        profiler.dump_stats(output)
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats(sort).print_stats(limit)
+    print(text.getvalue())
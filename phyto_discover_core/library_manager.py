@@ -1,7 +1,29 @@
 import sqlite3
 import os
+import csv
+import numpy as np
 from pyteomics import mass
 
+# Mass of a proton, used for the charge of protonated and deprotonated ions
+PROTON_MASS = 1.007276
+
+# Common ESI adducts as (number of molecules M, mass shift in Da, charge).
+# The m/z of an ion is (M * molecules + shift) / |charge|.
+ADDUCTS = {
+    '[M+H]+': (1, PROTON_MASS, 1),
+    '[M+Na]+': (1, 22.989218, 1),
+    '[M+K]+': (1, 38.963158, 1),
+    '[M+NH4]+': (1, 18.033823, 1),
+    '[M+H-H2O]+': (1, PROTON_MASS - 18.010565, 1),
+    '[M+2H]2+': (1, 2 * PROTON_MASS, 2),
+    '[2M+H]+': (2, PROTON_MASS, 1),
+    '[M-H]-': (1, -PROTON_MASS, -1),
+    '[M+Cl]-': (1, 34.969402, -1),
+    '[M+FA-H]-': (1, 44.998201, -1),
+    '[M-H-H2O]-': (1, -PROTON_MASS - 18.010565, -1),
+    '[2M-H]-': (2, -PROTON_MASS, -1),
+}
+
 def build_database(db_path):
     """Creates the SQLite database and the compounds table."""
     if os.path.exists(db_path):
@@ -16,6 +38,7 @@ def build_database(db_path):
             mass REAL NOT NULL
         )
     ''')
+    cursor.execute("CREATE INDEX idx_compounds_mass ON compounds (mass)")
     conn.commit()
     conn.close()
     print(f"Database with 'compounds' table created at {db_path}")
@@ -39,12 +62,175 @@ def add_compound_to_db(db_path, name, formula):
         print(f"Error adding {name} to database: {e}")
         return False
 
+def calculate_masses(formulas):
+    """
+    Returns the monoisotopic masses of many formulas at once.
+    Each formula is parsed into element counts once, then all masses are a single
+    product of the count matrix with the element masses. Formulas that cannot be
+    parsed or contain an unknown element get a mass of NaN.
+    """
+    compositions = []
+    for formula in formulas:
+        try:
+            composition = mass.Composition(formula=formula)
+        except Exception:
+            composition = None
+        if not composition or any(element not in mass.nist_mass for element in composition):
+            composition = None
+        compositions.append(composition)
+
+    elements = sorted({element for composition in compositions if composition for element in composition})
+    column = {element: i for i, element in enumerate(elements)}
+    counts = np.zeros((len(compositions), len(elements)))
+    for row, composition in enumerate(compositions):
+        if composition is None:
+            continue
+        for element, count in composition.items():
+            counts[row, column[element]] = count
+    # nist_mass[element][0][0] is the mass of the most abundant isotope
+    element_masses = np.array([mass.nist_mass[element][0][0] for element in elements])
+    masses = counts @ element_masses
+    masses[[composition is None for composition in compositions]] = np.nan
+    return masses
+
+def add_compounds_to_db(db_path, compounds):
+    """
+    Adds many (name, formula) compounds in a single transaction.
+    Invalid formulas are reported and skipped, and names already in the
+    database are left unchanged. Returns the number of compounds added.
+    """
+    compounds = list(compounds)
+    masses = calculate_masses([formula for _, formula in compounds])
+    rows = []
+    for (name, formula), compound_mass in zip(compounds, masses):
+        if np.isnan(compound_mass):
+            print(f"Error adding {name} to database: invalid formula '{formula}'.")
+            continue
+        rows.append((name, formula, float(compound_mass)))
+    if not rows:
+        return 0
+
+    conn = sqlite3.connect(db_path)
+    ensure_mass_index(conn)
+    before = conn.total_changes
+    conn.executemany("INSERT OR IGNORE INTO compounds (name, formula, mass) VALUES (?, ?, ?)", rows)
+    added = conn.total_changes - before
+    conn.commit()
+    conn.close()
+    print(f"Added {added} of {len(rows)} compounds to the database.")
+    return added
+
+def load_compounds_csv(csv_path):
+    """Reads (name, formula) pairs from a CSV file with 'name' and 'formula' columns."""
+    with open(csv_path, newline='') as f:
+        return [(row['name'].strip(), row['formula'].strip()) for row in csv.DictReader(f)]
+
+def ensure_mass_index(conn):
+    """Adds the index on compounds.mass to databases created before it existed."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_compounds_mass ON compounds (mass)")
+
+class MassIndex:
+    """
+    In-memory index of the ion m/z of every compound and adduct, sorted by m/z.
+
+    Each compound is expanded into one ion per adduct, so looking up the
+    precursors of a whole run is two searchsorted calls over the sorted ion
+    m/z array instead of one SQL range query per precursor.
+    """
+
+    def __init__(self, names, formulas, masses, adducts=None):
+        if adducts is None:
+            adducts = list(ADDUCTS)
+        self.names = np.asarray(names, dtype=object)
+        self.formulas = np.asarray(formulas, dtype=object)
+        self.masses = np.asarray(masses, dtype=np.float64)
+        self.adducts = np.asarray(adducts, dtype=object)
+
+        unknown = [a for a in adducts if a not in ADDUCTS]
+        if unknown:
+            raise ValueError(f"Unknown adducts {unknown}, expected any of {list(ADDUCTS)}.")
+        molecules, shifts, charges = np.array([ADDUCTS[a] for a in adducts], dtype=np.float64).reshape(-1, 3).T
+
+        # One row per compound, one column per adduct, flattened in m/z order
+        ion_mz = (self.masses[:, None] * molecules + shifts) / np.abs(charges)
+        order = np.argsort(ion_mz, axis=None, kind='stable')
+        self.ion_mz = ion_mz.ravel()[order]
+        self.ion_compound, self.ion_adduct = np.divmod(order, max(len(adducts), 1))
+
+    @classmethod
+    def from_db(cls, db_path, adducts=None):
+        """Loads every compound of the 'compounds' table at `db_path`."""
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute("SELECT name, formula, mass FROM compounds ORDER BY id").fetchall()
+        conn.close()
+        names, formulas, masses = zip(*rows) if rows else ((), (), ())
+        return cls(names, formulas, masses, adducts)
+
+    def __len__(self):
+        return len(self.ion_mz)
+
+    def search_by_mass(self, mz_array, ppm=10):
+        """
+        Finds every ion within `ppm` of each m/z in `mz_array`, all queries at once.
+        Returns a dict of parallel arrays with one entry per (query, ion) match:
+        'query' (position in `mz_array`), 'name', 'formula', 'adduct', 'ion_mz' and 'ppm_error'.
+        """
+        mz_array = np.asarray(mz_array, dtype=np.float64)
+        tolerance = mz_array * ppm * 1e-6
+        starts = np.searchsorted(self.ion_mz, mz_array - tolerance, side='left')
+        stops = np.searchsorted(self.ion_mz, mz_array + tolerance, side='right')
+        counts = np.where(np.isnan(mz_array), 0, stops - starts)
+
+        # Expand every [start, stop) window into the ion positions it covers
+        query = np.repeat(np.arange(len(mz_array)), counts)
+        window_starts = np.cumsum(counts) - counts
+        positions = np.arange(counts.sum()) - np.repeat(window_starts - starts, counts)
+
+        compound = self.ion_compound[positions]
+        ion_mz = self.ion_mz[positions]
+        return {
+            'query': query,
+            'name': self.names[compound],
+            'formula': self.formulas[compound],
+            'adduct': self.adducts[self.ion_adduct[positions]],
+            'ion_mz': ion_mz,
+            'ppm_error': (mz_array[query] - ion_mz) / ion_mz * 1e6,
+        }
+
+def annotate_precursors(mzml_file, mass_index, ppm=10, ms_level=2):
+    """
+    Annotates the precursor m/z of every MS2 spectrum in an mzML run with the
+    matching compounds and adducts. Precursors are read from the spectrum index,
+    so the peaks are never decoded. Returns one report row per match.
+    """
+    # Imported here because only run annotation needs the mzML spectrum index
+    from spectrum_index import SpectrumIndex
+    index = SpectrumIndex.open(mzml_file)
+    positions = np.flatnonzero((index.ms_levels == ms_level) & ~np.isnan(index.precursor_mzs))
+    precursor_mzs = index.precursor_mzs[positions]
+    matches = mass_index.search_by_mass(precursor_mzs, ppm)
+
+    rows = []
+    for i, query in enumerate(matches['query']):
+        rows.append({
+            'query_id': str(index.scan_ids[positions[query]]),
+            'query_mz': f"{precursor_mzs[query]:.4f}",
+            'compound_name': matches['name'][i],
+            'formula': matches['formula'][i],
+            'adduct': matches['adduct'][i],
+            'ion_mz': f"{matches['ion_mz'][i]:.4f}",
+            'ppm_error': f"{matches['ppm_error'][i]:.2f}"
+        })
+    return rows
+
 if __name__ == '__main__':
     # Example usage: create and populate the database
     DB_FILE = '../data/phyto_discover_core.db'
     os.makedirs('../data', exist_ok=True)
     build_database(DB_FILE)
-    add_compound_to_db(DB_FILE, 'Aspirin', 'C9H8O4')
-    add_compound_to_db(DB_FILE, 'Metformin', 'C4H11N5')
-    add_compound_to_db(DB_FILE, 'Caffeine', 'C8H10N4O2')
+    add_compounds_to_db(DB_FILE, [
+        ('Aspirin', 'C9H8O4'),
+        ('Metformin', 'C4H11N5'),
+        ('Caffeine', 'C8H10N4O2'),
+    ])
     print("\nLibrary manager script executed successfully.")
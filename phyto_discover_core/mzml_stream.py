@@ -0,0 +1,49 @@
+import itertools
+import numpy as np
+import pymzml.run
+from matchms import Spectrum
+from peak_store import PeakStore
+
+def iter_query_spectra(mzml_file, ms_level=2):
+    """
+    Lazily yields the MS2 spectra of an mzML file as matchms Spectrum objects.
+    Only one scan is held in memory at a time, so memory use does not depend on file size.
+    Scans without peaks or without a usable precursor m/z are skipped.
+    """
+    for mz, intensities, metadata in iter_query_peaks(mzml_file, ms_level):
+        # Peaks are sorted by m/z because matchms rejects unsorted peak lists
+        order = np.argsort(mz, kind='stable')
+        yield Spectrum(mz=mz[order], intensities=intensities[order], metadata=metadata)
+
+def iter_query_batches(mzml_file, batch_size, ms_level=2):
+    """
+    Same spectra as iter_query_spectra, yielded as one compact PeakStore per
+    `batch_size` spectra instead of one matchms Spectrum per scan.
+    """
+    for batch in iter_batches(iter_query_peaks(mzml_file, ms_level), batch_size):
+        yield PeakStore.from_peak_lists(batch)
+
+def iter_query_peaks(mzml_file, ms_level=2):
+    """Lazily yields (mz, intensities, metadata) of every usable scan, with the peaks as read from the file."""
+    run = pymzml.run.Reader(mzml_file)
+    try:
+        for spec in run:
+            if spec.ms_level != ms_level or len(spec.mz) == 0 or not spec.selected_precursors:
+                continue
+            try:
+                precursor_mz = float(spec.selected_precursors[0].get('mz'))
+            except (IndexError, TypeError):
+                continue
+            yield (np.asarray(spec.mz, dtype=np.float64), np.asarray(spec.i, dtype=np.float64),
+                   {'precursor_mz': precursor_mz, 'id': str(spec.ID)})
+    finally:
+        run.close()
+
+def iter_batches(iterable, batch_size):
+    """Groups any iterable into lists of at most `batch_size` items without materializing it."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
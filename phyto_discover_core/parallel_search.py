@@ -0,0 +1,211 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from core_search import SpectralLibrary, load_library
+from peak_store import PeakStore, METADATA_KEYS
+from precursor_index import PrecursorIndex
+from sparse_scoring import SparseScores, score_sparse, score_dense
+
+def default_workers():
+    """Returns the number of worker processes used when none is given: one per CPU core."""
+    return os.cpu_count() or 1
+
+def shard_bounds(n_items, n_shards):
+    """
+    Splits range(n_items) into at most `n_shards` contiguous (start, stop) ranges.
+    Shards are always returned in order, so merged results keep the input order.
+    """
+    n_shards = max(1, min(n_shards, n_items))
+    edges = np.linspace(0, n_items, n_shards + 1).astype(np.int64)
+    return [(int(edges[i]), int(edges[i + 1])) for i in range(n_shards) if edges[i + 1] > edges[i]]
+
+def share_array(array):
+    """
+    Copies `array` into a new shared memory block.
+    Returns the block and the (name, shape, dtype) spec that attach_array maps in a worker.
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def attach_array(spec):
+    """Maps an array shared by share_array; the block must stay referenced as long as the array is used."""
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def release_shared(blocks):
+    """Closes and frees the shared memory blocks created by share_array."""
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+# --- Embedding library search ---
+
+# Per-worker state, set once by the pool initializer
+_worker_library = None
+_worker_shm = None
+
+def _init_library_worker(source, names, precursor_mzs):
+    global _worker_library, _worker_shm
+    kind, location = source
+    if kind == 'memmap':
+        embeddings = np.load(location, mmap_mode='r')
+    else:
+        _worker_shm, embeddings = attach_array(location)
+    _worker_library = SpectralLibrary.from_arrays(names, precursor_mzs, embeddings)
+
+def _search_shard(query_embeddings, precursor_mzs, top_k, chunk_size, tolerance, unit):
+    return _worker_library.search_batch(query_embeddings, top_k=top_k, chunk_size=chunk_size,
+                                        precursor_mzs=precursor_mzs, tolerance=tolerance, unit=unit)
+
+class ParallelLibrarySearch:
+    """
+    Process pool that searches query shards against one SpectralLibrary.
+
+    The library embedding matrix is copied once into shared memory and every
+    worker maps it directly instead of receiving a pickled copy. Embeddings of
+    a columnar library are already memory-mapped, so workers map the same file.
+    Results are merged in query order, so the output does not depend on worker scheduling.
+    Scores can differ from a single-process search in the last float32 digits
+    (around 1e-7), because the shards change the shapes of the matrix products.
+    """
+
+    def __init__(self, library, workers=None):
+        self.library = library
+        self.workers = workers or default_workers()
+        embeddings = library.embeddings
+        self._shm = None
+        if isinstance(embeddings, np.memmap):
+            source = ('memmap', embeddings.filename)
+        else:
+            self._shm, spec = share_array(np.asarray(embeddings, dtype=np.float32))
+            source = ('shm', spec)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_library_worker,
+            initargs=(source, library.names, library.precursor_mzs)
+        )
+
+    def search_batch(self, query_embeddings, top_k=1, chunk_size=None, precursor_mzs=None, tolerance=None,
+                     unit='ppm'):
+        """Same contract as SpectralLibrary.search_batch, with the queries sharded across the pool."""
+        if precursor_mzs is None:
+            precursor_mzs = [None] * len(query_embeddings)
+        futures = [
+            self._pool.submit(_search_shard, query_embeddings[start:stop], list(precursor_mzs[start:stop]),
+                              top_k, chunk_size, tolerance, unit)
+            for start, stop in shard_bounds(len(query_embeddings), self.workers)
+        ]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def close(self):
+        self._pool.shutdown()
+        if self._shm is not None:
+            release_shared([self._shm])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def parallel_search_spectra(queries, db_path='phytodiscover_core.db', workers=None, top_k=1, chunk_size=None,
+                            library=None, precursor_tolerance=None, tolerance_unit='ppm'):
+    """
+    Parallel version of core_search.search_spectra.
+    Returns one list of up to `top_k` matches per query, in query order.
+    """
+    if library is None:
+        library = load_library(db_path)
+    queries = library.prepare_queries(queries)
+    with ParallelLibrarySearch(library, workers) as searcher:
+        return searcher.search_batch(library.embed_queries(queries), top_k=top_k, chunk_size=chunk_size,
+                                     precursor_mzs=[q.get('precursor_mz') for q in queries],
+                                     tolerance=precursor_tolerance, unit=tolerance_unit)
+
+# --- ModifiedCosine scoring of query spectra against reference spectra ---
+
+# Per-worker state, set once by the pool initializer
+_worker_references = None
+_worker_reference_index = None
+_worker_reference_shms = []
+
+def _init_scoring_worker(specs, mz_resolution):
+    global _worker_references, _worker_reference_index, _worker_reference_shms
+    _worker_reference_shms, arrays = zip(*(attach_array(spec) for spec in specs))
+    mz, intensities, offsets, precursor_mzs = arrays
+    # Scoring only reads peaks and precursor m/z, so the metadata columns are left empty
+    metadata = {key: np.full(len(precursor_mzs), None, dtype=object) for key in METADATA_KEYS}
+    _worker_references = PeakStore(mz, intensities, offsets, precursor_mzs, metadata, mz_resolution)
+    _worker_reference_index = PrecursorIndex(precursor_mzs)
+
+def _score_sparse_shard(query_spectra, tolerance, unit):
+    return score_sparse(query_spectra, _worker_references, tolerance, unit, reference_index=_worker_reference_index)
+
+def _score_dense_shard(query_spectra):
+    return score_dense(query_spectra, _worker_references)
+
+class ParallelScorer:
+    """
+    Process pool that scores query spectra against a fixed set of reference spectra.
+
+    The flat peak and precursor buffers of the references are copied once into
+    shared memory and every worker maps them as a PeakStore instead of receiving
+    a pickled copy. Any other list of spectra is converted to a PeakStore first.
+    """
+
+    def __init__(self, reference_spectra, workers=None):
+        if not isinstance(reference_spectra, PeakStore):
+            reference_spectra = PeakStore.from_spectra(reference_spectra)
+        self.n_references = len(reference_spectra)
+        self.workers = workers or default_workers()
+        self._shms, specs = zip(*(share_array(array) for array in (
+            reference_spectra.mz, reference_spectra.intensities, reference_spectra.offsets,
+            reference_spectra.precursor_mzs
+        )))
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_scoring_worker,
+            initargs=(specs, reference_spectra.mz_resolution)
+        )
+
+    def score_sparse(self, query_spectra, tolerance, unit='Da'):
+        """Parallel version of sparse_scoring.score_sparse; row indices refer to `query_spectra`."""
+        bounds = shard_bounds(len(query_spectra), self.workers)
+        futures = [self._pool.submit(_score_sparse_shard, query_spectra[start:stop], tolerance, unit)
+                   for start, stop in bounds]
+        shards = [future.result() for future in futures]
+        if not shards:
+            return SparseScores([], [], [], [], len(query_spectra), self.n_references)
+        return SparseScores(
+            np.concatenate([shard.rows + start for shard, (start, _) in zip(shards, bounds)]),
+            np.concatenate([shard.cols for shard in shards]),
+            np.concatenate([shard.scores for shard in shards]),
+            np.concatenate([shard.matches for shard in shards]),
+            len(query_spectra), self.n_references
+        )
+
+    def score_dense(self, query_spectra):
+        """Parallel version of sparse_scoring.score_dense."""
+        futures = [self._pool.submit(_score_dense_shard, query_spectra[start:stop])
+                   for start, stop in shard_bounds(len(query_spectra), self.workers)]
+        shards = [future.result() for future in futures]
+        if not shards:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        return np.concatenate([s[0] for s in shards]), np.concatenate([s[1] for s in shards])
+
+    def close(self):
+        self._pool.shutdown()
+        release_shared(self._shms)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
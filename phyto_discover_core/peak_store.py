@@ -0,0 +1,246 @@
+import operator
+import numpy as np
+from matchms import Spectrum
+
+# m/z values are stored as integer multiples of this step in Da, so the rounding
+# error is at most half a step (0.005 mDa), far below any fragment tolerance
+MZ_RESOLUTION = 1e-5
+
+# Metadata kept per spectrum besides the precursor m/z; everything else is dropped
+METADATA_KEYS = ('compound_name', 'spectrum_id', 'id')
+
+# Spectra converted at a time by PeakStore.from_peak_lists
+BUILD_CHUNK_SIZE = 10000
+
+class PeakView:
+    """Peaks of one SpectrumView, with the attributes of matchms Fragments used by the similarity functions."""
+
+    __slots__ = ('mz', 'intensities')
+
+    def __init__(self, mz, intensities):
+        self.mz = mz
+        self.intensities = intensities
+
+    def __len__(self):
+        return len(self.mz)
+
+    @property
+    def to_numpy(self):
+        return np.vstack((self.mz, self.intensities.astype(np.float64))).T
+
+class SpectrumView:
+    """
+    Lightweight stand-in for a matchms Spectrum, backed by one entry of a PeakStore.
+    Peaks are decoded on access, so a view costs two references however many peaks it has.
+    """
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def peaks(self):
+        return PeakView(*self.store.peaks(self.index))
+
+    def get(self, key, default=None):
+        return self.store.get_metadata(self.index, key, default)
+
+    @property
+    def metadata(self):
+        return self.store.metadata_dict(self.index)
+
+    def to_spectrum(self):
+        """Materializes the view as a full matchms Spectrum."""
+        mz, intensities = self.store.peaks(self.index)
+        return Spectrum(mz=mz, intensities=intensities.astype(np.float64), metadata=self.metadata)
+
+class PeakStore:
+    """
+    Compact, read-only peaks and metadata of many spectra.
+
+    Spectrum i owns entries offsets[i]:offsets[i + 1] of two flat buffers:
+    float32 intensities and uint32 m/z codes. The first code of a spectrum is its
+    lowest m/z in units of `mz_resolution` and the following codes are the gaps to
+    the previous peak, so a spectrum decodes with one cumsum. With
+    `mz_resolution=None` the m/z buffer holds the sorted float64 values instead.
+    Only the precursor m/z and METADATA_KEYS are kept. Indexing returns a
+    SpectrumView, slicing returns a smaller PeakStore.
+    """
+
+    def __init__(self, mz, intensities, offsets, precursor_mzs, metadata, mz_resolution):
+        self.mz = mz
+        self.intensities = intensities
+        self.offsets = offsets
+        self.precursor_mzs = precursor_mzs
+        self.metadata = metadata
+        self.mz_resolution = mz_resolution
+
+    @classmethod
+    def from_flat(cls, mz, intensities, offsets, precursor_mzs, metadata=None, mz_resolution=MZ_RESOLUTION):
+        """
+        Encodes flat peak arrays (spectrum i owning mz[offsets[i]:offsets[i + 1]]).
+        `metadata` maps METADATA_KEYS to one value per spectrum. Peaks are sorted by
+        m/z within each spectrum.
+        """
+        mz = np.asarray(mz, dtype=np.float64)
+        intensities = np.asarray(intensities, dtype=np.float32)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        n_spectra = len(offsets) - 1
+        counts = np.diff(offsets)
+        rows = np.repeat(np.arange(n_spectra), counts)
+        order = np.lexsort((mz, rows))
+        mz, intensities = mz[order], intensities[order]
+
+        if mz_resolution is not None:
+            if len(mz) and (mz.min() < 0 or mz.max() > np.iinfo(np.uint32).max * mz_resolution):
+                raise ValueError(f"Peak m/z outside the range of the {mz_resolution} Da quantization.")
+            codes = np.rint(mz / mz_resolution).astype(np.int64)
+            deltas = np.empty_like(codes)
+            deltas[1:] = codes[1:] - codes[:-1]
+            starts = offsets[:-1][counts > 0]
+            deltas[starts] = codes[starts]
+            mz = deltas.astype(np.uint32)
+
+        if not isinstance(precursor_mzs, np.ndarray):
+            precursor_mzs = [np.nan if p is None else p for p in precursor_mzs]
+        precursor_mzs = np.asarray(precursor_mzs, dtype=np.float64)
+        columns = {key: np.asarray((metadata or {}).get(key, [None] * n_spectra), dtype=object)
+                   for key in METADATA_KEYS}
+        return cls(mz, intensities, offsets, precursor_mzs, columns, mz_resolution)
+
+    @classmethod
+    def from_peak_lists(cls, entries, mz_resolution=MZ_RESOLUTION):
+        """
+        Builds a store from an iterable of (mz, intensities, metadata) per spectrum.
+        The iterable is consumed in chunks, so only BUILD_CHUNK_SIZE spectra are held
+        in their original form at a time.
+        """
+        chunks = []
+        iterator = iter(entries)
+        while True:
+            chunk = [entry for _, entry in zip(range(BUILD_CHUNK_SIZE), iterator)]
+            if not chunk:
+                break
+            offsets = np.zeros(len(chunk) + 1, dtype=np.int64)
+            np.cumsum([len(mz) for mz, _, _ in chunk], out=offsets[1:])
+            chunks.append(cls.from_flat(
+                np.concatenate([np.asarray(mz, dtype=np.float64) for mz, _, _ in chunk]),
+                np.concatenate([np.asarray(intensities, dtype=np.float32) for _, intensities, _ in chunk]),
+                offsets, [metadata.get('precursor_mz') for _, _, metadata in chunk],
+                {key: [metadata.get(key) for _, _, metadata in chunk] for key in METADATA_KEYS}, mz_resolution
+            ))
+        if not chunks:
+            return cls.from_flat(np.zeros(0), np.zeros(0), np.zeros(1, dtype=np.int64), [], None, mz_resolution)
+        return cls.concatenate(chunks)
+
+    @classmethod
+    def from_spectra(cls, spectra, mz_resolution=MZ_RESOLUTION):
+        """Builds a store from an iterable of matchms Spectrum objects (or SpectrumViews)."""
+        return cls.from_peak_lists(((s.peaks.mz, s.peaks.intensities, s.metadata) for s in spectra), mz_resolution)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Joins stores that share one m/z encoding into a single store, in order."""
+        resolutions = {store.mz_resolution for store in stores}
+        if len(resolutions) != 1:
+            raise ValueError("Cannot concatenate peak stores with different m/z encodings.")
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for store in stores:
+            offsets.append(store.offsets[1:] + offsets[-1][-1])
+        # The first code of every spectrum is absolute, so the code buffers can be joined as they are
+        return cls(
+            np.concatenate([store.mz for store in stores]),
+            np.concatenate([store.intensities for store in stores]),
+            np.concatenate(offsets),
+            np.concatenate([store.precursor_mzs for store in stores]),
+            {key: np.concatenate([store.metadata[key] for store in stores]) for key in METADATA_KEYS},
+            resolutions.pop()
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.take(np.arange(len(self))[key])
+        index = operator.index(key)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Spectrum index {key} out of range for {len(self)} spectra.")
+        return SpectrumView(self, index)
+
+    def __iter__(self):
+        return (SpectrumView(self, i) for i in range(len(self)))
+
+    @property
+    def nbytes(self):
+        """Size of the peak and precursor buffers; metadata strings are not included."""
+        return self.mz.nbytes + self.intensities.nbytes + self.offsets.nbytes + self.precursor_mzs.nbytes
+
+    def _decode(self, codes):
+        if self.mz_resolution is None:
+            return codes
+        return np.cumsum(codes, dtype=np.int64) * self.mz_resolution
+
+    def peaks(self, idx):
+        """Returns the (float64 m/z, float32 intensities) of spectrum `idx`."""
+        start, stop = self.offsets[idx], self.offsets[idx + 1]
+        return self._decode(self.mz[start:stop]), self.intensities[start:stop]
+
+    def flat_peaks(self):
+        """Returns (mz, intensities, offsets) of all spectra, with the m/z decoded to float64."""
+        if self.mz_resolution is None:
+            return self.mz, self.intensities, self.offsets
+        codes = np.cumsum(self.mz, dtype=np.int64)
+        # Restart the running sum at every spectrum, whose first code is absolute
+        counts = np.diff(self.offsets)
+        before = np.concatenate([[0], codes])[self.offsets[:-1]]
+        codes -= np.repeat(before, counts)
+        return codes * self.mz_resolution, self.intensities, self.offsets
+
+    def get_metadata(self, idx, key, default=None):
+        if key == 'precursor_mz':
+            mz = self.precursor_mzs[idx]
+            return default if np.isnan(mz) else float(mz)
+        column = self.metadata.get(key)
+        value = None if column is None else column[idx]
+        return default if value is None else value
+
+    def metadata_dict(self, idx):
+        metadata = {key: self.metadata[key][idx] for key in METADATA_KEYS if self.metadata[key][idx] is not None}
+        if not np.isnan(self.precursor_mzs[idx]):
+            metadata['precursor_mz'] = float(self.precursor_mzs[idx])
+        return metadata
+
+    def take(self, indices):
+        """Returns a new store holding spectra `indices`, in that order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        counts = self.offsets[indices + 1] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        return PeakStore(self.mz[positions], self.intensities[positions], offsets, self.precursor_mzs[indices],
+                         {key: column[indices] for key, column in self.metadata.items()}, self.mz_resolution)
+
+    def with_peaks(self, mz, intensities, offsets):
+        """Returns a store with the same spectra and metadata but new flat peaks, e.g. after preprocessing."""
+        return PeakStore.from_flat(mz, intensities, offsets, self.precursor_mzs, self.metadata, self.mz_resolution)
+
+def flatten_peaks(spectra):
+    """
+    Returns (mz, intensities, offsets) of all peaks of `spectra`, flattened.
+    A PeakStore hands out its buffers directly; other spectra are concatenated.
+    """
+    if isinstance(spectra, PeakStore):
+        return spectra.flat_peaks()
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    if len(spectra) == 0:
+        return np.zeros(0), np.zeros(0), offsets
+    peaks = [s.peaks for s in spectra]
+    np.cumsum([len(p.mz) for p in peaks], out=offsets[1:])
+    return (np.concatenate([np.asarray(p.mz, dtype=np.float64) for p in peaks]),
+            np.concatenate([np.asarray(p.intensities, dtype=np.float64) for p in peaks]), offsets)
@@ -0,0 +1,63 @@
+import sqlite3
+import numpy as np
+
+# Tables that store a precursor_mz column: core_search uses 'spectra',
+# food_safety_library_manager uses 'reference_spectra'
+PRECURSOR_TABLES = ('spectra', 'reference_spectra')
+
+def tolerance_window(precursor_mz, tolerance, unit='ppm'):
+    """
+    Returns the (low, high) precursor m/z bounds around `precursor_mz`.
+    `unit` is either 'ppm' (relative) or 'Da' (absolute).
+    Works on scalars and arrays alike.
+    """
+    precursor_mz = np.asarray(precursor_mz, dtype=np.float64)
+    if unit == 'ppm':
+        delta = precursor_mz * tolerance * 1e-6
+    elif unit == 'Da':
+        delta = np.full_like(precursor_mz, tolerance)
+    else:
+        raise ValueError(f"Unknown tolerance unit '{unit}', expected 'ppm' or 'Da'.")
+    return precursor_mz - delta, precursor_mz + delta
+
+class PrecursorIndex:
+    """
+    Sorted array of library precursor m/z values for fast mass-window lookups.
+    Entries without a precursor m/z (NaN) are never returned as candidates.
+    """
+
+    def __init__(self, precursor_mzs):
+        precursor_mzs = np.asarray(precursor_mzs, dtype=np.float64)
+        valid = np.flatnonzero(~np.isnan(precursor_mzs))
+        order = valid[np.argsort(precursor_mzs[valid], kind='stable')]
+        self.order = order
+        self.sorted_mzs = precursor_mzs[order]
+
+    def __len__(self):
+        return len(self.order)
+
+    def bounds(self, precursor_mzs, tolerance, unit='ppm'):
+        """
+        Returns (starts, stops) into the sorted array for every query m/z.
+        Candidates of query i are `self.order[starts[i]:stops[i]]`.
+        """
+        low, high = tolerance_window(precursor_mzs, tolerance, unit)
+        starts = np.searchsorted(self.sorted_mzs, low, side='left')
+        stops = np.searchsorted(self.sorted_mzs, high, side='right')
+        return starts, stops
+
+    def query(self, precursor_mz, tolerance, unit='ppm'):
+        """Returns the library indices whose precursor m/z lies within the tolerance window."""
+        if precursor_mz is None or np.isnan(precursor_mz):
+            return np.empty(0, dtype=np.int64)
+        start, stop = self.bounds(precursor_mz, tolerance, unit)
+        return self.order[int(start):int(stop)]
+
+def create_precursor_index(db_path, table='spectra'):
+    """Creates an SQLite index on the precursor_mz column of `table` if it does not exist yet."""
+    if table not in PRECURSOR_TABLES:
+        raise ValueError(f"Table '{table}' has no precursor_mz column.")
+    conn = sqlite3.connect(db_path)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_precursor_mz ON {table} (precursor_mz)")
+    conn.commit()
+    conn.close()
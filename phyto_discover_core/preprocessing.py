@@ -0,0 +1,131 @@
+import os
+import json
+import sqlite3
+import numpy as np
+from matchms import Fragments
+from peak_store import PeakStore, flatten_peaks
+
+# Filters applied to library and query peaks before embedding and scoring.
+# top_n peaks are kept per window of `window` Da, like the GNPS "filter peaks window" step.
+DEFAULT_PREPROCESSING = {
+    'min_mz': 10.0,               # drop peaks below this m/z
+    'max_mz': None,               # drop peaks above this m/z (None keeps everything)
+    'precursor_tolerance': 1.5,   # drop peaks within this many Da of the precursor (None keeps them)
+    'noise_floor': 0.01,          # drop peaks below this fraction of the base peak
+    'top_n': 6,                   # keep at most this many peaks per m/z window (None keeps all)
+    'window': 50.0,               # width of the top_n windows in Da
+    'normalize': True,            # scale intensities so the base peak is 1
+}
+
+# Key of the preprocessing config in the library_metadata / library_info tables
+PREPROCESSING_METADATA_KEY = 'preprocessing'
+
+def make_config(**overrides):
+    """Returns DEFAULT_PREPROCESSING with `overrides` applied, rejecting unknown settings."""
+    unknown = set(overrides) - set(DEFAULT_PREPROCESSING)
+    if unknown:
+        raise ValueError(f"Unknown preprocessing settings {sorted(unknown)}, expected {sorted(DEFAULT_PREPROCESSING)}.")
+    return dict(DEFAULT_PREPROCESSING, **overrides)
+
+def config_to_json(config):
+    """Serializes a config for the library metadata and cache keys; None means no preprocessing."""
+    return None if config is None else json.dumps(config, sort_keys=True)
+
+def config_from_json(text):
+    return None if text is None else make_config(**json.loads(text))
+
+def read_library_metadata(db_path, key):
+    """
+    Returns the value stored under `key` in a library's metadata, or None if it has none.
+    `db_path` is an SQLite library (library_metadata table) or a columnar library directory.
+    """
+    if not os.path.exists(db_path):
+        return None
+    if os.path.isdir(db_path):
+        # Imported here because columnar_library itself builds on core_search, which uses this module
+        from columnar_library import METADATA_FILE
+        conn, table = sqlite3.connect(os.path.join(db_path, METADATA_FILE)), 'library_info'
+    else:
+        conn, table = sqlite3.connect(db_path), 'library_metadata'
+    try:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if table not in tables:
+            return None
+        row = conn.execute(f"SELECT value FROM {table} WHERE key = ?", (key,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def load_preprocessing_config(db_path):
+    """Returns the preprocessing config a library was built with, or None if its peaks are raw."""
+    return config_from_json(read_library_metadata(db_path, PREPROCESSING_METADATA_KEY))
+
+def preprocess_peaks(mz, intensities, offsets, precursor_mzs, config=DEFAULT_PREPROCESSING):
+    """
+    Filters the peaks of many spectra at once.
+
+    Peaks are given flattened, spectrum i owning mz[offsets[i]:offsets[i + 1]] in
+    ascending m/z order. All filters run as array operations over the flat arrays,
+    so there is no Python loop over spectra or peaks. Returns the filtered
+    (mz, intensities, offsets), still in ascending m/z order within each spectrum.
+    Applying the same config twice gives the same peaks as applying it once.
+    """
+    mz = np.asarray(mz, dtype=np.float64)
+    intensities = np.asarray(intensities, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    precursor_mzs = np.asarray([np.nan if p is None else p for p in precursor_mzs], dtype=np.float64)
+    n_spectra = len(offsets) - 1
+    rows = np.repeat(np.arange(n_spectra), np.diff(offsets))
+
+    keep = (intensities > 0) & (mz >= config['min_mz'])
+    if config['max_mz'] is not None:
+        keep &= mz <= config['max_mz']
+    if config['precursor_tolerance'] is not None:
+        # Spectra without a precursor m/z compare as NaN and keep all their peaks
+        keep &= ~(np.abs(mz - precursor_mzs[rows]) <= config['precursor_tolerance'])
+
+    base_peak = np.zeros(n_spectra)
+    np.maximum.at(base_peak, rows[keep], intensities[keep])
+    if config['noise_floor']:
+        keep &= intensities >= config['noise_floor'] * base_peak[rows]
+
+    if config['top_n'] is not None:
+        kept = np.flatnonzero(keep)
+        windows = np.floor(mz[kept] / config['window']).astype(np.int64)
+        # Group the kept peaks by (spectrum, window), most intense first, and rank them within their group
+        order = np.lexsort((-intensities[kept], windows, rows[kept]))
+        group_rows, group_windows = rows[kept][order], windows[order]
+        new_group = np.ones(len(order), dtype=bool)
+        new_group[1:] = (group_rows[1:] != group_rows[:-1]) | (group_windows[1:] != group_windows[:-1])
+        positions = np.arange(len(order))
+        rank = positions - np.maximum.accumulate(np.where(new_group, positions, 0))
+        keep[kept[order[rank >= config['top_n']]]] = False
+
+    out_intensities = intensities[keep]
+    if config['normalize']:
+        out_intensities = out_intensities / base_peak[rows[keep]]
+    out_offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[keep], minlength=n_spectra), out=out_offsets[1:])
+    return mz[keep], out_intensities, out_offsets
+
+def preprocess_spectra(spectra, config=DEFAULT_PREPROCESSING):
+    """
+    Returns copies of `spectra` whose peaks went through preprocess_peaks; metadata is kept.
+    A PeakStore gives a new PeakStore, a list of matchms spectra a list of spectra.
+    With `config=None` the spectra are returned unchanged.
+    """
+    if config is None:
+        return spectra
+    if isinstance(spectra, PeakStore):
+        return spectra.with_peaks(*preprocess_peaks(*spectra.flat_peaks(), spectra.precursor_mzs, config))
+    if not spectra:
+        return []
+    mz, intensities, offsets = preprocess_peaks(*flatten_peaks(spectra), [s.get('precursor_mz') for s in spectra],
+                                                config)
+    processed = []
+    for i, spectrum in enumerate(spectra):
+        start, stop = offsets[i], offsets[i + 1]
+        copy = spectrum.clone()
+        copy.peaks = Fragments(mz=mz[start:stop], intensities=intensities[start:stop])
+        processed.append(copy)
+    return processed
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+# Used when no cache directory is given; override with PHYTODISCOVER_CACHE_DIR
+DEFAULT_CACHE_DIR = os.environ.get(
+    'PHYTODISCOVER_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'phytodiscover')
+)
+
+# Upper bound on the total size of the cached results
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+CACHE_FILE = 'results.sqlite'
+
+# Content hashes already computed by this process, keyed by path and validated by size and mtime
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+def file_content_hash(path):
+    """
+    Returns the SHA-256 of the contents of `path`.
+    The hash is computed once per process and file version; it is only
+    recomputed when the size or modification time of the file changes.
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    with _hash_lock:
+        cached = _hash_cache.get(key)
+    if cached is not None and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(key, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    content_hash = digest.hexdigest()
+    with _hash_lock:
+        _hash_cache[key] = ((stat.st_size, stat.st_mtime_ns), content_hash)
+    return content_hash
+
+def library_version(db_path):
+    """
+    Returns a version string for the library at `db_path` (SQLite file or columnar directory).
+    It changes whenever any library file is rewritten, so cached results of an old library are never reused.
+    """
+    key = os.path.abspath(db_path)
+    paths = [os.path.join(key, name) for name in sorted(os.listdir(key))] if os.path.isdir(key) else [key]
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+def make_key(**parts):
+    """Builds a cache key from keyword parts, e.g. file hash, library version and search parameters."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+class ResultCache:
+    """
+    Size-bounded, least-recently-used cache of search results on disk.
+
+    Values are stored as JSON in a small SQLite file inside `cache_dir`, so they
+    survive restarts and can be shared by the CLI and the backend. When the total
+    size exceeds `max_bytes`, the entries used least recently are evicted.
+    Hit and miss counts of this instance are available from `stats()`.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_path = os.path.join(cache_dir, CACHE_FILE)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_last_access ON results (last_access)")
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None on a miss."""
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        conn.close()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """Stores a JSON-serializable `value` under `key`, evicting old entries if the cache is full."""
+        payload = json.dumps(value)
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        conn = self._connect()
+        conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, payload, size, time.time()))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        evicted = 0
+        if total > self.max_bytes:
+            # Walk the entries from least to most recently used until enough space is freed
+            stale = []
+            for old_key, old_size in conn.execute("SELECT key, size FROM results ORDER BY last_access"):
+                if total <= self.max_bytes:
+                    break
+                stale.append((old_key,))
+                total -= old_size
+            conn.executemany("DELETE FROM results WHERE key = ?", stale)
+            evicted = len(stale)
+        conn.commit()
+        conn.close()
+        if evicted:
+            with self._lock:
+                self.evictions += evicted
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM results")
+        conn.commit()
+        conn.close()
+
+    def stats(self):
+        """Returns hit/miss counters of this instance and the current size of the cache."""
+        conn = self._connect()
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        conn.close()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": size,
+                "max_bytes": self.max_bytes
+            }
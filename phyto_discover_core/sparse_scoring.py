@@ -0,0 +1,88 @@
+import numpy as np
+from matchms.similarity import ModifiedCosine
+from precursor_index import PrecursorIndex
+
+class SparseScores:
+    """
+    Similarity scores for the query/reference pairs that were actually evaluated,
+    stored as parallel COO-style arrays instead of a dense query x reference matrix.
+    """
+
+    def __init__(self, rows, cols, scores, matches, n_queries, n_references):
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.matches = np.asarray(matches, dtype=np.int64)
+        self.shape = (n_queries, n_references)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def best_per_query(self):
+        """
+        Returns (best_reference_idx, best_score) arrays with one entry per query.
+        Queries without any scored pair get index -1 and a NaN score.
+        Ties are broken towards the lowest reference index, like np.argmax.
+        """
+        best_idx = np.full(self.shape[0], -1, dtype=np.int64)
+        best_score = np.full(self.shape[0], np.nan)
+        if len(self) == 0:
+            return best_idx, best_score
+
+        order = np.lexsort((self.cols, -self.scores, self.rows))
+        sorted_rows = self.rows[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_rows[1:] != sorted_rows[:-1]
+        selected = order[first]
+        best_idx[self.rows[selected]] = self.cols[selected]
+        best_score[self.rows[selected]] = self.scores[selected]
+        return best_idx, best_score
+
+def iter_candidate_pairs(query_spectra, reference_spectra, tolerance, unit='Da', reference_index=None):
+    """
+    Yields (query_idx, reference_idx) for every pair whose precursor m/z values
+    lie within the tolerance window. The window is centred on the query.
+    """
+    if reference_index is None:
+        reference_index = PrecursorIndex([_precursor_mz(s) for s in reference_spectra])
+    query_mzs = np.array([_precursor_mz(s) for s in query_spectra], dtype=np.float64)
+    starts, stops = reference_index.bounds(query_mzs, tolerance, unit)
+    for i in np.flatnonzero(~np.isnan(query_mzs) & (stops > starts)):
+        for j in reference_index.order[starts[i]:stops[i]]:
+            yield int(i), int(j)
+
+def iter_sparse_scores(query_spectra, reference_spectra, tolerance, unit='Da', similarity=None,
+                       reference_index=None):
+    """
+    Yields (query_idx, reference_idx, score, matches) for every candidate pair
+    inside the precursor window, so results can be streamed without a dense matrix.
+    """
+    if similarity is None:
+        similarity = ModifiedCosine()
+    for i, j in iter_candidate_pairs(query_spectra, reference_spectra, tolerance, unit, reference_index):
+        result = similarity.pair(query_spectra[i], reference_spectra[j])
+        yield i, j, float(result['score']), int(result['matches'])
+
+def score_sparse(query_spectra, reference_spectra, tolerance, unit='Da', similarity=None,
+                 reference_index=None):
+    """Scores only the precursor-windowed pairs and collects them into a SparseScores."""
+    rows, cols, scores, matches = [], [], [], []
+    for i, j, score, n_matches in iter_sparse_scores(query_spectra, reference_spectra, tolerance, unit,
+                                                     similarity, reference_index):
+        rows.append(i)
+        cols.append(j)
+        scores.append(score)
+        matches.append(n_matches)
+    return SparseScores(rows, cols, scores, matches, len(query_spectra), len(reference_spectra))
+
+def score_dense(query_spectra, reference_spectra, similarity=None):
+    """Scores every query against every reference and returns (best_reference_idx, best_score) per query."""
+    if similarity is None:
+        similarity = ModifiedCosine()
+    scores = similarity.matrix(query_spectra, reference_spectra)['score']
+    best_idx = np.argmax(scores, axis=1)
+    return best_idx, scores[np.arange(len(query_spectra)), best_idx]
+
+def _precursor_mz(spectrum):
+    mz = spectrum.get('precursor_mz')
+    return np.nan if mz is None else float(mz)
@@ -0,0 +1,174 @@
+import os
+import re
+import mmap
+import zlib
+import base64
+import xml.etree.ElementTree as ET
+import numpy as np
+from matchms import Spectrum
+from precursor_index import PrecursorIndex
+
+# Suffix of the index file cached beside each mzML file
+INDEX_SUFFIX = '.pdidx.npz'
+
+# Bump whenever the layout of the cached index changes
+INDEX_VERSION = 1
+
+SPECTRUM_START = re.compile(rb'<spectrum\s')
+SPECTRUM_ID = re.compile(rb'\sid="([^"]*)"')
+CV_PARAM = re.compile(rb'<cvParam\b[^>]*?accession="(MS:1000511|MS:1000744)"[^>]*?value="([^"]*)"')
+SCAN_NUMBER = re.compile(r'scan=(\d+)')
+
+# PSI-MS accessions used when decoding binary data arrays
+MZ_ARRAY = 'MS:1000514'
+INTENSITY_ARRAY = 'MS:1000515'
+FLOAT_32 = 'MS:1000521'
+FLOAT_64 = 'MS:1000523'
+ZLIB_COMPRESSION = 'MS:1000574'
+NO_COMPRESSION = 'MS:1000576'
+
+def scan_id_from_native_id(native_id):
+    """Returns the scan number of a native ID such as 'scan=5', matching pymzml's spec.ID."""
+    match = SCAN_NUMBER.search(native_id)
+    return match.group(1) if match else native_id
+
+class SpectrumIndex:
+    """
+    On-disk index of an mzML file: scan ID -> byte offset, precursor m/z and MS level.
+
+    The index is built with a single byte-level pass over the file and cached
+    beside it, so later lookups by scan ID or precursor window are binary
+    searches followed by one seek instead of a full reparse.
+    """
+
+    def __init__(self, mzml_file, native_ids, offsets, lengths, ms_levels, precursor_mzs):
+        self.mzml_file = mzml_file
+        self.native_ids = np.asarray(native_ids, dtype=str)
+        self.scan_ids = np.array([scan_id_from_native_id(i) for i in self.native_ids], dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.ms_levels = np.asarray(ms_levels, dtype=np.int8)
+        self.precursor_mzs = np.asarray(precursor_mzs, dtype=np.float64)
+        self._native_order = np.argsort(self.native_ids, kind='stable')
+        self._scan_order = np.argsort(self.scan_ids, kind='stable')
+        self._sorted_native_ids = self.native_ids[self._native_order]
+        self._sorted_scan_ids = self.scan_ids[self._scan_order]
+        self._precursor_index = None
+
+    @classmethod
+    def build(cls, mzml_file):
+        """Scans `mzml_file` once and records the position and header of every spectrum."""
+        native_ids, offsets, lengths, ms_levels, precursor_mzs = [], [], [], [], []
+        with open(mzml_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(mzml_file, [], [], [], [], [])
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for match in SPECTRUM_START.finditer(mm):
+                    start = match.start()
+                    end = mm.find(b'</spectrum>', start)
+                    if end == -1:
+                        break
+                    end += len(b'</spectrum>')
+                    header_end = mm.find(b'<binaryDataArrayList', start, end)
+                    header = mm[start:header_end if header_end != -1 else end]
+
+                    id_match = SPECTRUM_ID.search(header, 0, header.find(b'>'))
+                    ms_level, precursor_mz = 0, np.nan
+                    for accession, value in CV_PARAM.findall(header):
+                        if accession == b'MS:1000511':
+                            ms_level = int(value)
+                        elif np.isnan(precursor_mz):
+                            precursor_mz = float(value)
+
+                    native_ids.append(id_match.group(1).decode() if id_match else str(len(offsets)))
+                    offsets.append(start)
+                    lengths.append(end - start)
+                    ms_levels.append(ms_level)
+                    precursor_mzs.append(precursor_mz)
+        return cls(mzml_file, native_ids, offsets, lengths, ms_levels, precursor_mzs)
+
+    @classmethod
+    def open(cls, mzml_file):
+        """
+        Returns the index for `mzml_file`, loading the cached copy beside it if it is
+        still up to date and building (and caching) a new one otherwise.
+        """
+        index_path = mzml_file + INDEX_SUFFIX
+        stat = os.stat(mzml_file)
+        if os.path.exists(index_path):
+            with np.load(index_path) as cached:
+                if (int(cached['version']) == INDEX_VERSION and int(cached['source_size']) == stat.st_size
+                        and int(cached['source_mtime_ns']) == stat.st_mtime_ns):
+                    return cls(mzml_file, cached['native_ids'], cached['offsets'], cached['lengths'],
+                               cached['ms_levels'], cached['precursor_mzs'])
+
+        index = cls.build(mzml_file)
+        try:
+            index.save(index_path, stat)
+        except OSError as e:
+            print(f"Warning: Could not cache spectrum index at {index_path}: {e}")
+        return index
+
+    def save(self, index_path, stat=None):
+        """Writes the index to `index_path` together with the size and mtime of its source file."""
+        if stat is None:
+            stat = os.stat(self.mzml_file)
+        with open(index_path, 'wb') as f:
+            np.savez(f, version=INDEX_VERSION, source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns,
+                     native_ids=self.native_ids, offsets=self.offsets, lengths=self.lengths,
+                     ms_levels=self.ms_levels, precursor_mzs=self.precursor_mzs)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def find(self, spectrum_id):
+        """
+        Returns the position of `spectrum_id` in the file, or None.
+        Accepts either the native ID ('scan=5') or the pymzml scan number ('5').
+        """
+        spectrum_id = str(spectrum_id)
+        for sorted_ids, order in ((self._sorted_native_ids, self._native_order),
+                                  (self._sorted_scan_ids, self._scan_order)):
+            i = np.searchsorted(sorted_ids, spectrum_id)
+            if i < len(sorted_ids) and sorted_ids[i] == spectrum_id:
+                return int(order[i])
+        return None
+
+    def in_precursor_window(self, precursor_mz, tolerance, unit='Da', ms_level=2):
+        """Returns the positions of all spectra of `ms_level` whose precursor m/z is within the window."""
+        if self._precursor_index is None:
+            self._precursor_index = PrecursorIndex(self.precursor_mzs)
+        positions = np.sort(self._precursor_index.query(precursor_mz, tolerance, unit))
+        return positions[self.ms_levels[positions] == ms_level]
+
+    def read(self, position):
+        """Seeks to the spectrum at `position` and decodes it into a matchms Spectrum."""
+        with open(self.mzml_file, 'rb') as f:
+            f.seek(self.offsets[position])
+            element = ET.fromstring(f.read(self.lengths[position]))
+
+        arrays = {}
+        for array in element.iter('binaryDataArray'):
+            accessions = {param.get('accession') for param in array.iter('cvParam')}
+            dtype = np.float32 if FLOAT_32 in accessions else np.float64
+            raw = base64.b64decode(array.findtext('binary') or '')
+            if ZLIB_COMPRESSION in accessions:
+                raw = zlib.decompress(raw)
+            elif NO_COMPRESSION not in accessions:
+                raise ValueError(f"Unsupported compression in spectrum '{self.native_ids[position]}'.")
+            for kind in (MZ_ARRAY, INTENSITY_ARRAY):
+                if kind in accessions:
+                    arrays[kind] = np.frombuffer(raw, dtype=dtype).astype(np.float64)
+
+        mz = arrays.get(MZ_ARRAY, np.zeros(0))
+        intensities = arrays.get(INTENSITY_ARRAY, np.zeros(0))
+        order = np.argsort(mz, kind='stable')
+        metadata = {'id': str(self.scan_ids[position]), 'ms_level': int(self.ms_levels[position])}
+        if not np.isnan(self.precursor_mzs[position]):
+            metadata['precursor_mz'] = float(self.precursor_mzs[position])
+        return Spectrum(mz=mz[order], intensities=intensities[order], metadata=metadata)
+
+    def get_spectrum(self, spectrum_id):
+        """Returns the spectrum with `spectrum_id` as a matchms Spectrum, or None."""
+        position = self.find(spectrum_id)
+        return None if position is None else self.read(position)
@@ -0,0 +1,186 @@
+import os
+import mmap
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# Files are split into chunks of roughly this many bytes, each parsed by one worker
+PARSE_CHUNK_BYTES = 16 * 1024 * 1024
+
+MGF = 'mgf'
+MASSBANK = 'massbank'
+
+# Metadata keys renamed to the names used by matchms and the library builders
+MGF_KEYS = {'name': 'compound_name', 'spectrumid': 'spectrum_id'}
+MASSBANK_KEYS = {'ch$name': 'compound_name', 'accession': 'spectrum_id'}
+
+def detect_format(path):
+    """Returns MGF or MASSBANK from the first non-empty line of `path`."""
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(b'#'):
+                continue
+            return MGF if line == b'BEGIN IONS' else MASSBANK
+    return MGF
+
+def chunk_bounds(path, file_format, chunk_bytes=PARSE_CHUNK_BYTES):
+    """
+    Splits `path` into (start, stop) byte ranges of about `chunk_bytes` that never
+    cut through a spectrum: every range starts at an MGF 'BEGIN IONS' line or right
+    after a MassBank '//' line.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    marker = b'\nBEGIN IONS' if file_format == MGF else b'\n//'
+    bounds, start = [], 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while start < size:
+            position = mm.find(marker, start + chunk_bytes) if start + chunk_bytes < size else -1
+            if position == -1:
+                bounds.append((start, size))
+                break
+            stop = position + 1
+            if file_format == MASSBANK:
+                # The record end belongs to the current chunk; the next one starts after it
+                line_end = mm.find(b'\n', stop)
+                stop = size if line_end == -1 else line_end + 1
+            bounds.append((start, stop))
+            start = stop
+    return bounds
+
+def _bulk_peaks(peak_lines):
+    """
+    Converts the peak lines of a whole chunk to (mz, intensities) with one float conversion.
+    Extra columns (e.g. MassBank relative intensities or MGF fragment charges) are ignored.
+    """
+    if not peak_lines:
+        return np.zeros(0), np.zeros(0)
+    n_columns = len(peak_lines[0].split())
+    tokens = b' '.join(peak_lines).split()
+    try:
+        if len(tokens) != n_columns * len(peak_lines):
+            raise ValueError
+        values = np.array(tokens, dtype=np.float64).reshape(len(peak_lines), n_columns)
+    except ValueError:
+        # Mixed column counts or non-numeric columns: fall back to the first two fields of each line
+        values = np.array([line.split()[:2] for line in peak_lines], dtype=np.float64)
+    return values[:, 0], values[:, 1]
+
+def _finish_chunk(peak_lines, counts, metadata):
+    """Builds the (mz, intensities, offsets, metadata) chunk, with the peaks of each spectrum sorted by m/z."""
+    mz, intensities = _bulk_peaks(peak_lines)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    order = np.lexsort((mz, np.repeat(np.arange(len(counts)), counts)))
+    return mz[order], intensities[order], offsets, metadata
+
+def _parse_float(value):
+    try:
+        return float(value.split()[0])
+    except (ValueError, IndexError):
+        return None
+
+def parse_mgf(data):
+    """Parses the BEGIN IONS blocks in the bytes `data` into one (mz, intensities, offsets, metadata) chunk."""
+    peak_lines, counts, metadata = [], [], []
+    current = None
+    for line in data.split(b'\n'):
+        line = line.strip()
+        if not line:
+            continue
+        if current is None:
+            if line == b'BEGIN IONS':
+                current, n_peaks = {}, 0
+            continue
+        if line == b'END IONS':
+            counts.append(n_peaks)
+            metadata.append(current)
+            current = None
+        elif line[:1].isdigit():
+            peak_lines.append(line)
+            n_peaks += 1
+        elif b'=' in line:
+            key, value = line.decode(errors='replace').split('=', 1)
+            key = key.strip().lower()
+            value = value.strip()
+            if key == 'pepmass':
+                current['precursor_mz'] = _parse_float(value)
+            else:
+                current[MGF_KEYS.get(key, key)] = value
+    return _finish_chunk(peak_lines, counts, metadata)
+
+def parse_massbank(data):
+    """Parses the MassBank records in the bytes `data` into one (mz, intensities, offsets, metadata) chunk."""
+    peak_lines, counts, metadata = [], [], []
+    current, in_peaks, n_peaks = None, False, 0
+    for raw_line in data.split(b'\n'):
+        line = raw_line.strip()
+        if line == b'//':
+            if current is not None:
+                counts.append(n_peaks)
+                metadata.append(current)
+            current, in_peaks, n_peaks = None, False, 0
+            continue
+        if not line:
+            continue
+        if current is None:
+            current = {}
+        if in_peaks and raw_line[:1].isspace():
+            peak_lines.append(line)
+            n_peaks += 1
+            continue
+        in_peaks = False
+        if b': ' not in line:
+            continue
+        key, value = line.decode(errors='replace').split(': ', 1)
+        key = key.strip().lower()
+        value = value.strip()
+        if key == 'pk$peak':
+            in_peaks = True
+        elif key == 'ms$focused_ion' and value.upper().startswith('PRECURSOR_M/Z'):
+            current['precursor_mz'] = _parse_float(value[len('PRECURSOR_M/Z'):])
+        elif key == 'ac$mass_spectrometry' and value.upper().startswith('ION_MODE'):
+            current['ionmode'] = value[len('ION_MODE'):].strip().lower()
+        else:
+            # Repeated tags such as CH$NAME keep their first value
+            current.setdefault(MASSBANK_KEYS.get(key, key), value)
+    if current is not None and n_peaks:
+        # A final record without its closing '//'
+        counts.append(n_peaks)
+        metadata.append(current)
+    return _finish_chunk(peak_lines, counts, metadata)
+
+PARSERS = {MGF: parse_mgf, MASSBANK: parse_massbank}
+
+def parse_chunk(path, start, stop, file_format):
+    """Reads bytes start:stop of `path` and parses them; runs in the worker processes."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return PARSERS[file_format](f.read(stop - start))
+
+def iter_chunks(path, file_format=None, workers=None, chunk_bytes=PARSE_CHUNK_BYTES):
+    """
+    Yields (mz, intensities, offsets, metadata) chunks of an MGF or MassBank file, in file order.
+
+    The file is split at spectrum boundaries and the chunks are parsed on a pool
+    of `workers` processes (one per CPU core by default). A file that fits in a
+    single chunk is parsed in this process.
+    """
+    file_format = file_format or detect_format(path)
+    bounds = chunk_bounds(path, file_format, chunk_bytes)
+    if len(bounds) <= 1 or workers == 1:
+        for start, stop in bounds:
+            yield parse_chunk(path, start, stop, file_format)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(bounds))) as pool:
+        yield from pool.map(parse_chunk, *zip(*[(path, start, stop, file_format) for start, stop in bounds]))
+
+def iter_records(path, file_format=None, workers=None, chunk_bytes=PARSE_CHUNK_BYTES):
+    """
+    Yields (mz, intensities, metadata) per spectrum, the peak list format of
+    PeakStore.from_peak_lists. The peak arrays are views onto their chunk's buffers.
+    """
+    for mz, intensities, offsets, metadata in iter_chunks(path, file_format, workers, chunk_bytes):
+        for i, spectrum_metadata in enumerate(metadata):
+            yield mz[offsets[i]:offsets[i + 1]], intensities[offsets[i]:offsets[i + 1]], spectrum_metadata
@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import pickle
+import numpy as np
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from core_search import SpectralLibrary, embed_spectra
+from ann_index import load_ann_index, rerank_by_peaks
+from embedders import DEFAULT_EMBEDDER, load_embedder
+from preprocessing import preprocess_spectra, load_preprocessing_config
+from peak_store import PeakStore
+
+# Library candidates per query kept by the embedding prefilter and rescored on their peaks
+DEFAULT_CANDIDATES = 50
+
+# Similarity functions available for the rescoring stage
+SIMILARITIES = {
+    'cosine': CosineGreedy,
+    'modified_cosine': ModifiedCosine,
+}
+
+def get_similarity(name='cosine', fragment_tolerance=0.1):
+    """Returns the matchms similarity called `name` with the given fragment m/z tolerance."""
+    if name not in SIMILARITIES:
+        raise ValueError(f"Unknown similarity '{name}', expected one of {sorted(SIMILARITIES)}.")
+    return SIMILARITIES[name](tolerance=fragment_tolerance)
+
+def load_reference_spectra(db_path):
+    """
+    Returns every spectrum of a library that stores peaks as a PeakStore, in library order:
+    a columnar library directory or an SQLite library with a 'reference_spectra' table.
+    """
+    if os.path.isdir(db_path):
+        # Imported here because the columnar format is only needed for directory libraries
+        from columnar_library import ColumnarLibrary
+        return ColumnarLibrary(db_path).to_peak_store()
+
+    conn = sqlite3.connect(db_path)
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'reference_spectra' not in tables:
+        conn.close()
+        raise ValueError(f"Library {db_path} has no 'reference_spectra' table with stored peaks.")
+    # Rows are unpickled as they are fetched, so only one chunk of full Spectrum objects exists at a time
+    cursor = conn.execute("SELECT serialized_spectrum FROM reference_spectra ORDER BY id")
+    store = PeakStore.from_spectra(pickle.loads(row[0]) for row in cursor)
+    conn.close()
+    return store
+
+def load_prefilter_index(db_path, n_references):
+    """
+    Returns the ANN index stored with the library at `db_path` if it indexes the
+    `n_references` binned embeddings TwoStageSearch prefilters on, else None.
+    That is the case when the library itself was built with the default binned embedder.
+    """
+    if load_embedder(db_path).describe() != DEFAULT_EMBEDDER.describe():
+        return None
+    ann_index = load_ann_index(db_path)
+    if ann_index is None or len(ann_index) != n_references or ann_index.centroids.shape[1] != DEFAULT_EMBEDDER.dim:
+        return None
+    return ann_index
+
+class TwoStageSearch:
+    """
+    Embedding prefilter followed by exact rescoring on the peaks.
+
+    The cheap binned embedding picks the `n_candidates` best library spectra for
+    every query, then only those candidates are scored with CosineGreedy or
+    ModifiedCosine. The final ranking therefore has the quality of the matchms
+    score while the number of peak comparisons per query stays constant.
+
+    `preprocessing` is the peak preprocessing config the reference spectra already
+    went through; query spectra are preprocessed the same way before both stages.
+    With an `ann_index` (an IVFIndex over the binned embeddings of the references),
+    searches without a precursor window take their candidates from the index
+    instead of scoring every reference embedding.
+    """
+
+    def __init__(self, reference_spectra, similarity='cosine', fragment_tolerance=0.1, preprocessing=None,
+                 ann_index=None):
+        self.reference_spectra = reference_spectra
+        self.similarity = get_similarity(similarity, fragment_tolerance)
+        self.preprocessing = preprocessing
+        self.library = SpectralLibrary(
+            [s.get('compound_name') for s in reference_spectra],
+            [s.get('precursor_mz') for s in reference_spectra],
+            embed_spectra(reference_spectra)
+        )
+        self.library.ann_index = ann_index
+
+    @classmethod
+    def from_library(cls, db_path, similarity='cosine', fragment_tolerance=0.1):
+        """
+        Builds the search over every stored spectrum of the library at `db_path`.
+        The prefilter embeddings are recomputed from the peaks with embed_spectra, so
+        they match the query embeddings whichever encoder the library was built with.
+        The library's ANN index is used for the prefilter when it fits (see load_prefilter_index).
+        """
+        reference_spectra = load_reference_spectra(db_path)
+        return cls(reference_spectra, similarity, fragment_tolerance,
+                   preprocessing=load_preprocessing_config(db_path),
+                   ann_index=load_prefilter_index(db_path, len(reference_spectra)))
+
+    def __len__(self):
+        return len(self.reference_spectra)
+
+    def _rescored_candidates(self, query_spectra, n_candidates, precursor_tolerance, tolerance_unit):
+        """Yields (ids, scores, matched_peaks, embedding_scores) per query, ordered by the rescored score."""
+        query_spectra = preprocess_spectra(query_spectra, self.preprocessing)
+        prefiltered = self.library.search_batch_ids(
+            embed_spectra(query_spectra), top_k=n_candidates,
+            precursor_mzs=[q.get('precursor_mz') for q in query_spectra],
+            tolerance=precursor_tolerance, unit=tolerance_unit
+        )
+        for query, (ids, embedding_scores) in zip(query_spectra, prefiltered):
+            # Ties on the rescored score keep the embedding order
+            ranked = rerank_by_peaks(query, ids, self.reference_spectra.__getitem__, self.similarity)
+            embedding_score_of = dict(zip(ids.tolist(), embedding_scores))
+            yield (np.array([idx for idx, _, _ in ranked], dtype=np.int64),
+                   np.array([score for _, score, _ in ranked], dtype=np.float64),
+                   np.array([n_matches for _, _, n_matches in ranked], dtype=np.int64),
+                   np.array([embedding_score_of[idx] for idx, _, _ in ranked], dtype=np.float32))
+
+    def search_batch(self, query_spectra, top_k=1, n_candidates=DEFAULT_CANDIDATES, precursor_tolerance=None,
+                     tolerance_unit='ppm'):
+        """
+        Returns one list of up to `top_k` matches per query, best rescored match first.
+        Every match holds the rescored `score`, the `embedding_score` of the prefilter
+        and the number of `matched_peaks`.
+        """
+        n_candidates = max(n_candidates, top_k)
+        results = []
+        for ids, scores, matches, embedding_scores in self._rescored_candidates(
+                query_spectra, n_candidates, precursor_tolerance, tolerance_unit):
+            results.append([
+                dict(self.library.match(idx, score), embedding_score=float(embedding_score),
+                     matched_peaks=int(n_matches))
+                for idx, score, n_matches, embedding_score in zip(ids[:top_k], scores[:top_k], matches[:top_k],
+                                                                  embedding_scores[:top_k])
+            ])
+        return results
+
+    def search(self, query_spectrum, top_k=1, n_candidates=DEFAULT_CANDIDATES, precursor_tolerance=None,
+               tolerance_unit='ppm'):
+        return self.search_batch([query_spectrum], top_k, n_candidates, precursor_tolerance, tolerance_unit)[0]
+
+    def best_per_query(self, query_spectra, n_candidates=DEFAULT_CANDIDATES, precursor_tolerance=None,
+                       tolerance_unit='ppm'):
+        """
+        Returns (best_indices, best_scores) like SparseScores.best_per_query:
+        queries without any candidate get index -1 and score NaN.
+        """
+        best_indices = np.full(len(query_spectra), -1, dtype=np.int64)
+        best_scores = np.full(len(query_spectra), np.nan)
+        for i, (ids, scores, _, _) in enumerate(self._rescored_candidates(
+                query_spectra, n_candidates, precursor_tolerance, tolerance_unit)):
+            if len(ids):
+                best_indices[i] = ids[0]
+                best_scores[i] = scores[0]
+        return best_indices, best_scores
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Add the core logic path to the system path, as the CLI scripts and the backend do
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(project_root, 'phyto_discover_core'))
@@ -0,0 +1,84 @@
+import os
+import numpy as np
+from ann_index import IVFIndex, rerank_by_peaks
+from core_search import normalize_rows, top_k_rows
+from peak_store import PeakStore
+from two_stage_search import TwoStageSearch, get_similarity
+
+def clustered_embeddings(n, dim, n_clusters, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    return normalize_rows(centers[rng.integers(n_clusters, size=n)] + 0.3 * rng.normal(size=(n, dim)))
+
+def recall_at(index, embeddings, queries, top_k):
+    exact = top_k_rows(queries @ embeddings.T, top_k)
+    found = 0
+    for query, expected in zip(queries, exact):
+        ids, _ = index.search(query, top_k=top_k, embeddings=embeddings)
+        found += len(set(ids) & set(expected))
+    return found / exact.size
+
+def test_ivf_recall_against_brute_force():
+    embeddings = clustered_embeddings(3000, 32, 30, seed=0)
+    queries = normalize_rows(clustered_embeddings(50, 32, 30, seed=0) + 0.05)
+    index = IVFIndex.build(embeddings, n_lists=40, nprobe=8)
+
+    assert recall_at(index, embeddings, queries, 10) >= 0.9
+    index.nprobe = len(index.centroids)
+    assert recall_at(index, embeddings, queries, 10) == 1.0
+
+def test_ivf_pq_recall_against_brute_force():
+    embeddings = clustered_embeddings(3000, 32, 30, seed=1)
+    queries = normalize_rows(clustered_embeddings(50, 32, 30, seed=1) + 0.05)
+    index = IVFIndex.build(embeddings, n_lists=40, pq_subquantizers=8, nprobe=8)
+
+    assert recall_at(index, embeddings, queries, 10) >= 0.85
+
+def test_saved_index_is_stale_once_the_library_changes(tmp_path):
+    source, path = tmp_path / 'library.db', str(tmp_path / 'library.db.ann.npz')
+    source.write_bytes(b'library')
+    IVFIndex.build(clustered_embeddings(200, 16, 4, seed=2), n_lists=4).save(path, source=str(source))
+    assert IVFIndex.load(path, source=str(source)) is not None
+
+    source.write_bytes(b'rebuilt library')
+    assert IVFIndex.load(path, source=str(source)) is None
+
+    source.write_bytes(b'same size lib')
+    os.utime(source, ns=(0, 0))
+    assert IVFIndex.load(path, source=str(source)) is None
+
+def test_two_stage_search_reranks_ann_candidates_on_peaks():
+    rng = np.random.default_rng(3)
+    counts = rng.integers(5, 21, size=80)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    references = PeakStore.from_flat(rng.uniform(50, 300, size=offsets[-1]), rng.uniform(1, 100, size=offsets[-1]),
+                                     offsets, rng.uniform(200, 260, size=80),
+                                     {'compound_name': [f'Compound {i}' for i in range(80)]})
+    queries = references[:10]
+
+    exhaustive = TwoStageSearch(references)
+    index = IVFIndex.build(exhaustive.library.embeddings, n_lists=8)
+    index.nprobe = len(index.centroids)
+    with_index = TwoStageSearch(references, ann_index=index)
+
+    # Probing every cell finds the same candidates as the exhaustive prefilter
+    for approximate, exact in zip(with_index.search_batch(queries, top_k=3, n_candidates=20),
+                                  exhaustive.search_batch(queries, top_k=3, n_candidates=20)):
+        assert [m['compound_name'] for m in approximate] == [m['compound_name'] for m in exact]
+        assert np.allclose([m['score'] for m in approximate], [m['score'] for m in exact])
+    for i, matches in enumerate(with_index.search_batch(queries, top_k=1, n_candidates=20)):
+        assert matches[0]['compound_name'] == f'Compound {i}'
+
+def test_rerank_by_peaks_orders_by_exact_score():
+    rng = np.random.default_rng(4)
+    offsets = np.arange(0, 61, 10)
+    references = PeakStore.from_flat(rng.uniform(50, 300, size=60), rng.uniform(1, 100, size=60), offsets,
+                                     rng.uniform(200, 260, size=6))
+    similarity = get_similarity('cosine')
+
+    ranked = rerank_by_peaks(references[2], [5, 2, 0], references.__getitem__, similarity)
+
+    assert [idx for idx, _, _ in ranked][0] == 2
+    scores = [score for _, score, _ in ranked]
+    assert scores == sorted(scores, reverse=True)
+    assert scores[0] == float(similarity.pair(references[2], references[2])['score'])
@@ -0,0 +1,88 @@
+import sqlite3
+from core_search import load_library
+from embedders import BinnedEmbedder
+from food_safety_library_manager import build_food_safety_library, update_food_safety_library
+
+def write_mgf(path, spectra):
+    """Writes {spectrum_id: (name, precursor_mz, [(mz, intensity), ...])} as an MGF file."""
+    blocks = []
+    for spectrum_id, (name, precursor_mz, peaks) in spectra.items():
+        lines = ['BEGIN IONS', f'PEPMASS={precursor_mz}', f'NAME={name}', f'SPECTRUMID={spectrum_id}']
+        lines += [f'{mz} {intensity}' for mz, intensity in peaks]
+        lines.append('END IONS')
+        blocks.append('\n'.join(lines))
+    path.write_text('\n\n'.join(blocks) + '\n')
+
+def make_spectra(n):
+    return {
+        f'SPEC{i}': (f'Compound {i}', 300.0 + i, [(50.0 + i, 100.0), (120.5 + i, 40.0), (210.25 + i, 75.0)])
+        for i in range(n)
+    }
+
+def stored_rows(db_file):
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute("SELECT spectrum_id, compound_name, content_hash FROM reference_spectra ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+def test_rebuild_replaces_rows(tmp_path):
+    mgf_file, db_file = tmp_path / 'library.mgf', str(tmp_path / 'library.db')
+    write_mgf(mgf_file, make_spectra(5))
+
+    build_food_safety_library(str(mgf_file), db_file, workers=1)
+    first = stored_rows(db_file)
+    build_food_safety_library(str(mgf_file), db_file, workers=1)
+
+    assert len(first) == 5
+    assert stored_rows(db_file) == first
+
+def test_incremental_update_syncs_added_changed_and_removed(tmp_path):
+    mgf_file, db_file = tmp_path / 'library.mgf', str(tmp_path / 'library.db')
+    spectra = make_spectra(4)
+    write_mgf(mgf_file, spectra)
+    build_food_safety_library(str(mgf_file), db_file, workers=1)
+    hashes = {spectrum_id: content_hash for spectrum_id, _, content_hash in stored_rows(db_file)}
+
+    del spectra['SPEC0']
+    spectra['SPEC1'] = ('Renamed compound', 301.0, spectra['SPEC1'][2])
+    spectra['SPEC9'] = ('Compound 9', 309.0, [(75.0, 10.0), (150.0, 90.0)])
+    write_mgf(mgf_file, spectra)
+    update_food_safety_library(str(mgf_file), db_file, workers=1)
+
+    rows = {spectrum_id: (name, content_hash) for spectrum_id, name, content_hash in stored_rows(db_file)}
+    assert sorted(rows) == ['SPEC1', 'SPEC2', 'SPEC3', 'SPEC9']
+    assert rows['SPEC1'][0] == 'Renamed compound'
+    assert rows['SPEC1'][1] != hashes['SPEC1']
+    assert rows['SPEC2'][1] == hashes['SPEC2']
+    assert rows['SPEC3'][1] == hashes['SPEC3']
+
+def test_incremental_update_removes_duplicates(tmp_path):
+    mgf_file, db_file = tmp_path / 'library.mgf', str(tmp_path / 'library.db')
+    write_mgf(mgf_file, make_spectra(3))
+    build_food_safety_library(str(mgf_file), db_file, workers=1)
+    conn = sqlite3.connect(db_file)
+    conn.execute("INSERT INTO reference_spectra (spectrum_id, compound_name, serialized_spectrum, embedding, "
+                 "content_hash) SELECT spectrum_id, compound_name, serialized_spectrum, embedding, content_hash "
+                 "FROM reference_spectra")
+    conn.commit()
+    conn.close()
+
+    update_food_safety_library(str(mgf_file), db_file, workers=1)
+
+    assert sorted(row[0] for row in stored_rows(db_file)) == ['SPEC0', 'SPEC1', 'SPEC2']
+
+def test_rebuild_with_another_embedder_stays_loadable(tmp_path):
+    mgf_file, db_file = tmp_path / 'library.mgf', str(tmp_path / 'library.db')
+    write_mgf(mgf_file, make_spectra(4))
+    build_food_safety_library(str(mgf_file), db_file, workers=1)
+    assert load_library(db_file).embeddings.shape == (4, 128)
+
+    build_food_safety_library(str(mgf_file), db_file, workers=1, embedder=BinnedEmbedder())
+    library = load_library(db_file)
+    assert library.embedder.name == 'binned'
+    assert library.embeddings.shape == (4, 1000)
+
+    update_food_safety_library(str(mgf_file), db_file, workers=1)
+    library = load_library(db_file)
+    assert library.embedder.name == 'mlp'
+    assert library.embeddings.shape == (4, 128)
@@ -0,0 +1,22 @@
+from instrumentation import Metrics, timed_iter, metrics
+
+def test_timed_iter_records_one_call_per_item():
+    metrics.reset()
+
+    assert list(timed_iter(iter(['batch']), 'mzml_parse')) == ['batch']
+    assert list(timed_iter(iter([]), 'empty_stream')) == []
+
+    stages = metrics.snapshot()['stages']
+    assert stages['mzml_parse']['calls'] == 1
+    assert 'empty_stream' not in stages
+    metrics.reset()
+
+def test_metrics_keep_calls_total_and_max():
+    local = Metrics()
+    local.record('scoring', 0.5)
+    local.record('scoring', 1.5)
+    local.count('hits', 3)
+
+    snapshot = local.snapshot()
+    assert snapshot['stages']['scoring'] == {'calls': 2, 'total_s': 2.0, 'max_s': 1.5}
+    assert snapshot['counters'] == {'hits': 3}
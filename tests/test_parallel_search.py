@@ -0,0 +1,45 @@
+import numpy as np
+from core_search import SpectralLibrary, embed_spectra, search_spectra
+from parallel_search import ParallelScorer, parallel_search_spectra
+from peak_store import PeakStore
+from sparse_scoring import score_sparse, score_dense
+
+def make_store(n, seed):
+    """Random spectra of 5 to 20 peaks with precursors between 200 and 260."""
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(5, 21, size=n)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return PeakStore.from_flat(
+        rng.uniform(50, 300, size=offsets[-1]), rng.uniform(1, 100, size=offsets[-1]), offsets,
+        rng.uniform(200, 260, size=n), {'compound_name': [f'Compound {i}' for i in range(n)]}
+    )
+
+def test_parallel_scoring_matches_serial():
+    references, queries = make_store(40, seed=0), make_store(25, seed=1)
+
+    with ParallelScorer(references, workers=3) as scorer:
+        dense = scorer.score_dense(queries)
+        sparse = scorer.score_sparse(queries, 5.0, 'Da')
+
+    serial_dense = score_dense(queries, references)
+    serial_sparse = score_sparse(queries, references, 5.0, 'Da')
+    assert np.array_equal(dense[0], serial_dense[0])
+    assert np.allclose(dense[1], serial_dense[1])
+    assert len(sparse) == len(serial_sparse) > 0
+    for parallel, serial in zip(sparse.best_per_query(), serial_sparse.best_per_query()):
+        assert np.allclose(parallel, serial, equal_nan=True)
+
+def test_parallel_library_search_matches_serial():
+    references, queries = make_store(60, seed=2), make_store(30, seed=3)
+    library = SpectralLibrary([f'Compound {i}' for i in range(60)], references.precursor_mzs,
+                              embed_spectra(references))
+
+    parallel = parallel_search_spectra(queries, library=library, workers=3, top_k=3)
+    serial = search_spectra(queries, library=library, top_k=3)
+
+    assert len(parallel) == len(serial) == 30
+    for parallel_matches, serial_matches in zip(parallel, serial):
+        assert [m['compound_name'] for m in parallel_matches] == [m['compound_name'] for m in serial_matches]
+        # Sharding changes the matrix product shapes, so float32 scores may differ in the last digits
+        assert np.allclose([m['score'] for m in parallel_matches], [m['score'] for m in serial_matches],
+                           atol=1e-6)
@@ -0,0 +1,157 @@
+import os
+import csv
+import json
+import time
+import uuid
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from core_search import load_library, screen_run
+
+# Job states; queued and running jobs are resumed when the backend restarts
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+FINISHED_STATES = (COMPLETED, FAILED)
+
+# Columns of the screening report, same as cli/run_full_analysis.py
+REPORT_FIELDS = ['query_id', 'query_mz', 'match_compound_name', 'match_mz', 'similarity_score']
+
+class JobManager:
+    """
+    Runs whole-run screening jobs on a bounded local worker pool.
+
+    Job state and progress are persisted in SQLite, so the status of every job
+    survives a backend restart and unfinished jobs are started again.
+    """
+
+    def __init__(self, db_path, reports_dir, max_workers=2, batch_size=500):
+        self.db_path = db_path
+        self.reports_dir = reports_dir
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        os.makedirs(reports_dir, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                module TEXT NOT NULL,
+                mzml_file TEXT NOT NULL,
+                threshold REAL NOT NULL,
+                db_path TEXT NOT NULL,
+                mzml_path TEXT NOT NULL,
+                spectra_processed INTEGER NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0,
+                report_path TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        conn = self._connect()
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        conn.commit()
+        conn.close()
+
+    def submit(self, module, mzml_file, threshold, db_path, mzml_path):
+        """Records a new job and queues it on the worker pool. Returns the job ID."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        conn.execute('''
+            INSERT INTO jobs (id, status, module, mzml_file, threshold, db_path, mzml_path, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (job_id, QUEUED, module, mzml_file, threshold, db_path, mzml_path, now, now))
+        conn.commit()
+        conn.close()
+        self.executor.submit(self._run, job_id)
+        return job_id
+
+    def resume_unfinished(self):
+        """Requeues the jobs that were queued or running when the backend stopped."""
+        conn = self._connect()
+        rows = conn.execute("SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at",
+                            (QUEUED, RUNNING)).fetchall()
+        conn.close()
+        for row in rows:
+            self._update(row["id"], status=QUEUED, spectra_processed=0, hits=0, error=None)
+            self.executor.submit(self._run, row["id"])
+        return len(rows)
+
+    def get(self, job_id):
+        conn = self._connect()
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        conn.close()
+        return self._to_dict(row) if row else None
+
+    def list_jobs(self, limit=50):
+        conn = self._connect()
+        rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        conn.close()
+        return [self._to_dict(row) for row in rows]
+
+    def report_path(self, job_id):
+        """Returns the path of the CSV report of a completed job, or None."""
+        conn = self._connect()
+        row = conn.execute("SELECT status, report_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        conn.close()
+        if row is None or row["status"] != COMPLETED:
+            return None
+        return row["report_path"]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        # Server-side paths are not part of the public job description
+        for key in ("db_path", "mzml_path", "report_path"):
+            job.pop(key)
+        return job
+
+    def _run(self, job_id):
+        conn = self._connect()
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        conn.close()
+        if job is None or job["status"] in FINISHED_STATES:
+            return
+
+        report_path = os.path.join(self.reports_dir, f"{job_id}.csv")
+        self._update(job_id, status=RUNNING, report_path=report_path)
+        processed = 0
+        n_hits = 0
+        try:
+            library = load_library(job["db_path"])
+            with open(report_path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+                writer.writeheader()
+                for n_spectra, hits in screen_run(job["mzml_path"], library, job["threshold"], self.batch_size):
+                    writer.writerows(hits)
+                    f.flush()
+                    processed += n_spectra
+                    n_hits += len(hits)
+                    self._update(job_id, spectra_processed=processed, hits=n_hits)
+            self._update(job_id, status=COMPLETED)
+        except Exception as e:
+            print(f"Screening job {job_id} failed: {e}")
+            self._update(job_id, status=FAILED, error=str(e))
+
+def format_event(job):
+    """Formats a job snapshot as a server-sent event."""
+    return f"data: {json.dumps(job)}\n\n"
@@ -1,22 +1,66 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import time
 import sys
 import os
-import subprocess
 
 # Add the project root to the Python path to allow imports from phyto_discover_core
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 core_path = os.path.join(project_root, 'phyto_discover_core')
 sys.path.insert(0, core_path)
 
-try:
-    # This import is for context, the script is called as a subprocess
-    from core_search import search_spectra
-except ImportError as e:
-    print(f"Warning: Could not import 'core_search' for context. This is okay if the script exists at {core_path}. Error: {e}")
+from core_search import load_library, run_search
+from federated_search import find_libraries, run_federated_search
+from result_cache import ResultCache
+from instrumentation import metrics, count, prometheus_text
+from jobs import JobManager, FINISHED_STATES, format_event
 
-app = FastAPI()
+# Analysis modules offered by the UI
+MODULES = ["Clinical Diagnostics", "Food Safety", "Forensic Toxicology"]
+
+# Extra libraries offered to federated search: SQLite files or columnar directories, named after the file
+user_libraries_dir = os.environ.get('PHYTODISCOVER_USER_LIBRARIES', os.path.join(project_root, 'data', 'user_libraries'))
+
+# Searches run on this pool so they never block the event loop. NumPy releases
+# the GIL during scoring, so several searches can run concurrently.
+search_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+
+# Whole-run screening jobs, persisted in SQLite with their reports under reports/jobs
+job_manager = JobManager(
+    db_path=os.environ.get('PHYTODISCOVER_JOBS_DB', os.path.join(project_root, 'data', 'jobs.db')),
+    reports_dir=os.environ.get('PHYTODISCOVER_REPORTS_DIR', os.path.join(project_root, 'reports', 'jobs')),
+    max_workers=int(os.environ.get('PHYTODISCOVER_JOB_WORKERS', 2))
+)
+
+# Search results keyed by sample file content, library version and search parameters
+result_cache = ResultCache(
+    cache_dir=os.environ.get('PHYTODISCOVER_CACHE_DIR', os.path.join(project_root, 'data', 'cache')),
+    max_bytes=int(os.environ.get('PHYTODISCOVER_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load every module and user library once, so requests only score against resident embeddings
+    for name, db_path in get_available_libraries().items():
+        try:
+            library = load_library(db_path)
+            print(f"Loaded {len(library)} library spectra for '{name}'.")
+        except Exception as e:
+            print(f"Warning: Could not load library '{name}': {e}")
+    resumed = job_manager.resume_unfinished()
+    if resumed:
+        print(f"Resumed {resumed} unfinished screening jobs.")
+    yield
+    job_manager.shutdown()
+    search_executor.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -27,11 +71,33 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Timed by route template, so /api/jobs/{job_id} is one stage rather than one per job
+    route = request.scope.get("route")
+    metrics.record(f"http {request.method} {route.path if route else 'unmatched'}", time.perf_counter() - start)
+    count("http_requests")
+    return response
+
 # --- Pydantic Models ---
 class SearchRequest(BaseModel):
     module: str
     compound_name: str
     mzml_file: str
+    top_k: int = 10
+
+class FederatedSearchRequest(BaseModel):
+    compound_name: str
+    mzml_file: str
+    libraries: Optional[List[str]] = None  # Names from /api/libraries; all of them by default
+    top_k: int = 10
+
+class ScreeningJobRequest(BaseModel):
+    module: str
+    mzml_file: str
+    threshold: float = 0.85
 
 # --- Helper Functions ---
 def get_db_path(module: str):
@@ -46,9 +112,38 @@ def get_db_path(module: str):
         return None
     return os.path.join(project_root, 'data', db_filename)
 
+def get_available_libraries():
+    """Returns {name: path} of every library on disk: the module libraries, then the user libraries."""
+    libraries = {}
+    for module in MODULES:
+        db_path = get_db_path(module)
+        if os.path.exists(db_path):
+            libraries[module] = db_path
+    for name, db_path in find_libraries(user_libraries_dir).items():
+        libraries.setdefault(name, db_path)
+    return libraries
+
 def get_mzml_path(filename: str):
     return os.path.join(project_root, 'data', filename)
 
+def resolve_paths(module: str, mzml_file: str):
+    """Returns (db_path, mzml_path) for a request, or raises a 404 if either file is missing."""
+    db_path = get_db_path(module)
+    mzml_path = get_mzml_path(mzml_file)
+
+    if not db_path or not os.path.exists(db_path):
+        print(f"Database not found for module: {module} at path: {db_path}")
+        raise HTTPException(status_code=404, detail=f"Database for module '{module}' not found.")
+    if not os.path.exists(mzml_path):
+        print(f"mzML file not found at path: {mzml_path}")
+        raise HTTPException(status_code=404, detail=f"Sample data file '{mzml_file}' not found.")
+    return db_path, mzml_path
+
+def search_module(db_path: str, mzml_path: str, compound_name: str, top_k: int):
+    """Runs one search against the resident library of a module (executed on search_executor)."""
+    library = load_library(db_path)  # Cached after startup; reloaded only if the file changed
+    return run_search(compound_name, mzml_path, db_path=db_path, top_k=top_k, library=library, cache=result_cache)
+
 # --- API Endpoints ---
 @app.get("/")
 def read_root():
@@ -57,49 +152,86 @@ def read_root():
 @app.post("/api/search")
 async def search(request: SearchRequest):
     print(f"Received search request: {request}")
-    db_path = get_db_path(request.module)
-    mzml_path = get_mzml_path(request.mzml_file)
-
-    if not db_path or not os.path.exists(db_path):
-        print(f"Database not found for module: {request.module} at path: {db_path}")
-        raise HTTPException(status_code=404, detail=f"Database for module '{request.module}' not found.")
-    if not os.path.exists(mzml_path):
-        print(f"mzML file not found at path: {mzml_path}")
-        raise HTTPException(status_code=404, detail=f"Sample data file '{request.mzml_file}' not found.")
+    db_path, mzml_path = resolve_paths(request.module, request.mzml_file)
 
     try:
-        # Use the system's python interpreter to run the core search script
-        command = [
-            sys.executable,
-            os.path.join(core_path, 'core_search.py'),
-            '--db_path', db_path,
-            '--mzml_file', mzml_path,
-            '--compound_name', request.compound_name
-        ]
-        print(f"Executing command: {' '.join(command)}")
-
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=True,
-            timeout=60 # Add a timeout for safety
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            search_executor, search_module, db_path, mzml_path, request.compound_name, request.top_k
         )
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
 
-        print("Search script stdout:", result.stdout)
-        print("Search script stderr:", result.stderr)
+    if "error" in result:
+        raise HTTPException(status_code=422, detail=result["error"])
 
-        # The script is expected to return a JSON string or similar structured text
-        return {"results": result.stdout.strip()}
+    return {
+        "query": result["query"],
+        "results": [
+            {
+                "id": rank,
+                "name": match["compound_name"],
+                "mz": match["precursor_mz"],
+                "score": match["score"]
+            }
+            for rank, match in enumerate(result["matches"], start=1)
+        ]
+    }
+
+@app.get("/api/libraries")
+async def list_libraries():
+    return {
+        "libraries": [
+            {"name": name, "kind": "module" if name in MODULES else "user"}
+            for name in get_available_libraries()
+        ]
+    }
+
+@app.post("/api/search/federated")
+async def federated_search(request: FederatedSearchRequest):
+    print(f"Received federated search request: {request}")
+    available = get_available_libraries()
+    names = request.libraries if request.libraries is not None else list(available)
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown libraries: {', '.join(unknown)}.")
+    if not names:
+        raise HTTPException(status_code=404, detail="No libraries available to search.")
+    mzml_path = get_mzml_path(request.mzml_file)
+    if not os.path.exists(mzml_path):
+        raise HTTPException(status_code=404, detail=f"Sample data file '{request.mzml_file}' not found.")
 
-    except subprocess.CalledProcessError as e:
-        print(f"Error executing search script: {e}")
-        print(f"Stderr: {e.stderr}")
-        raise HTTPException(status_code=500, detail=f"Error during spectral search: {e.stderr}")
+    try:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            search_executor, lambda: run_federated_search(
+                request.compound_name, mzml_path, {name: available[name] for name in names},
+                top_k=request.top_k, cache=result_cache
+            )
+        )
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
 
+    if "error" in result:
+        raise HTTPException(status_code=422, detail=result["error"])
+
+    return {
+        "query": result["query"],
+        "results": [
+            {
+                "id": rank,
+                "name": match["compound_name"],
+                "mz": match["precursor_mz"],
+                "score": match["score"],
+                "library": match["library"]
+            }
+            for rank, match in enumerate(result["matches"], start=1)
+        ],
+        "errors": result["errors"]
+    }
+
 @app.get("/api/data-files")
 async def get_data_files():
     data_path = os.path.join(project_root, 'data')
@@ -108,3 +240,60 @@ async def get_data_files():
         return {"files": files}
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Data directory not found.")
+
+@app.get("/metrics")
+def get_metrics():
+    cache_stats = result_cache.stats()
+    gauges = {
+        "result_cache_hits": ("Result cache hits since startup.", cache_stats["hits"]),
+        "result_cache_misses": ("Result cache misses since startup.", cache_stats["misses"]),
+        "result_cache_entries": ("Entries in the result cache.", cache_stats["entries"]),
+        "result_cache_size_bytes": ("Size of the result cache in bytes.", cache_stats["size_bytes"]),
+    }
+    return PlainTextResponse(prometheus_text(gauges=gauges), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    return result_cache.stats()
+
+@app.post("/api/jobs")
+async def submit_job(request: ScreeningJobRequest):
+    db_path, mzml_path = resolve_paths(request.module, request.mzml_file)
+    job_id = job_manager.submit(request.module, request.mzml_file, request.threshold, db_path, mzml_path)
+    return job_manager.get(job_id)
+
+@app.get("/api/jobs")
+async def list_jobs():
+    return {"jobs": job_manager.list_jobs()}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found.")
+    return job
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job(job_id: str):
+    if job_manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found.")
+
+    async def events():
+        last = None
+        while True:
+            job = job_manager.get(job_id)
+            if job != last:
+                yield format_event(job)
+                last = job
+            if job["status"] in FINISHED_STATES:
+                return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/api/jobs/{job_id}/report")
+async def get_job_report(job_id: str):
+    report_path = job_manager.report_path(job_id)
+    if report_path is None or not os.path.exists(report_path):
+        raise HTTPException(status_code=404, detail=f"No report available for job '{job_id}'.")
+    return FileResponse(report_path, media_type="text/csv", filename=f"screening_{job_id}.csv")
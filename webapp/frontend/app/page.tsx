@@ -6,7 +6,7 @@ import { useState, useEffect } from 'react';
 interface SearchResult {
   id: number;
   name: string;
-  mz: number;
+  mz: number | null;
   score: number;
 }
 
@@ -63,15 +63,7 @@ export default function Home() {
       }
 
       const data = await response.json();
-      // The backend returns a string, which might be JSON. Let's parse it.
-      try {
-        const parsedResults = JSON.parse(data.results);
-        setResults(parsedResults.results || []);
-      } catch (parseError) {
-        // If it's not JSON, it might be a simple message or an error.
-        console.error('Failed to parse results JSON:', parseError);
-        setError('Received malformed results from the backend.');
-      }
+      setResults(data.results || []);
 
     } catch (err) {
         if (err instanceof Error) {
@@ -149,7 +141,7 @@ export default function Home() {
                   <tr key={result.id}>
                     <td className="px-5 py-5 border-b border-gray-200 bg-white text-sm">{result.id}</td>
                     <td className="px-5 py-5 border-b border-gray-200 bg-white text-sm">{result.name}</td>
-                    <td className="px-5 py-5 border-b border-gray-200 bg-white text-sm">{result.mz.toFixed(4)}</td>
+                    <td className="px-5 py-5 border-b border-gray-200 bg-white text-sm">{result.mz !== null ? result.mz.toFixed(4) : '-'}</td>
                     <td className="px-5 py-5 border-b border-gray-200 bg-white text-sm">{result.score.toFixed(4)}</td>
                   </tr>
                 ))}